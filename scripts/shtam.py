@@ -91,9 +91,10 @@ class VoicemailApp(VoiceApp):
 
     def beginRecording(self, event):
         self.draftFile = os.path.join(self.draftDir,
-                                'vmdraft%s.raw'%draftTemp(self.destination))
+                                'vmdraft%s.rec'%draftTemp(self.destination))
         self.recordingTimeout = self.setTimer(self.maxDuration)
-        self.mediaRecord(self.draftFile)
+        # Keep the audio as it arrives - it's only decoded for the email
+        self.recording = self.mediaRecord(self.draftFile, encoded=True)
         return ( (CallEndedEvent, self.recordingDone),
                  (TimeoutEvent, self.recordingTooLong),
                )
@@ -106,18 +107,27 @@ class VoicemailApp(VoiceApp):
 
     def recordingDone(self, event):
         # Sweet. Recording is in self.draftFile, destination is self.destination
+        # (or will be, once the last of it is written)
+        _recordings[self.draftFile] = self.recording.close()
         self.returnResult((self.destination, self.sender, self.draftFile))
 
     def allDone(self, event):
         self.returnResult('other end closed without leaving a message')
 
 
+# draft file -> Deferred that fires when it's all on disk
+_recordings = {}
+
 def encodeAudio(infp, dest):
     import wave
+    from shtoom.audio.recording import Recording
     draft = os.path.join('/tmp','voicemail%s.wav'%draftTemp(dest))
     fp = wave.open(draft, 'wb')
     fp.setparams((1,2,8000,0,'NONE','NONE'))
-    fp.writeframes(infp.read())
+    recording = Recording(infp)
+    for audio in recording.decode():
+        fp.writeframes(audio)
+    recording.close()
     fp.close()
     return draft
 
@@ -149,7 +159,12 @@ class VoicemailApplication(DougApplication):
         else:
             dest, sender, draft = result
             print "message for %s from %s in %s"%(dest, sender, draft)
-            reactor.callInThread(lambda : sendVoicemail(dest, sender, draft))
+            d = _recordings.pop(draft, None)
+            if d is None:
+                from twisted.internet import defer
+                d = defer.succeed(None)
+            d.addCallback(lambda _: reactor.callInThread(
+                                lambda : sendVoicemail(dest, sender, draft)))
             log.msg("sent voicemail %r to %s"%(draft, dest))
 
 def main():
@@ -14,8 +14,8 @@ class DependencyFailed(Exception): pass
 class VersionCheckFailed(DependencyFailed): pass
 
 import sys, os
-if sys.version < '2.3':
-    raise VersionCheckFailed("Python 2.3 or later is required")
+if sys.version < '2.6':
+    raise VersionCheckFailed("Python 2.6 or later is required")
 
 try:
     import twisted
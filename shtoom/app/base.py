@@ -43,15 +43,15 @@ class BaseApplication:
             self._options.saveOptsFile()
 
     def connectSIP(self):
-        from twisted.internet import reactor
-        from shtoom import sip
+        from shtoom import sip, batchudp
         from shtoom.nat import getMapper
         p = sip.SipProtocol(self)
         self.sip = p
         lport = self.getPref('listenport')
         if lport is None:
             lport = 5060
-        self.sipListener = reactor.listenUDP(lport, p)
+        batchudp.configureFromPrefs(self)
+        self.sipListener = batchudp.listenUDP(lport, p, kind='sip')
         listenport = self.sipListener.getHost().port
         if lport == 0:
             self.getOptions().setValue('listenport', listenport, dynamic=True)
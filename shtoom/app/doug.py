@@ -24,6 +24,9 @@ class DougApplication(BaseApplication):
 
     configFileName = '.dougrc'
     needLogging = True
+    # The MediaClient for our media process, if we have one (see
+    # shtoom.doug.mediaserver)
+    media = None
 
     def __init__(self, voiceapp, ui=None, audio=None):
         # Mapping from callcookies to rtp object
@@ -40,17 +43,34 @@ class DougApplication(BaseApplication):
         if options is None:
             options = buildOptions(self)
         self.initOptions(options, args)
+        if self.getPref('media_process') and self.media is None:
+            # Before anything's listening - the media process doesn't
+            # come back from this
+            from shtoom.doug.mediaserver import forkMediaProcess
+            self.media = forkMediaProcess(self)
+        self.startLogging(self.getPref('logfile'))
+        self.configureMedia()
+        BaseApplication.boot(self)
+
+    def startLogging(self, logfile):
         if not self.needLogging:
             # Need to leave things alone when under trial
             pass
-        elif not self.getPref('logfile'):
+        elif not logfile:
             print "logging to stdout"
             shtoom.log.startLogging(sys.stdout)
         else:
-            file = open(self.getPref('logfile'), 'aU')
+            file = open(logfile, 'aU')
             #print "logging to file", file
             shtoom.log.startLogging(file)
-        BaseApplication.boot(self)
+
+    def configureMedia(self):
+        from shtoom import batchudp
+        cachesize = self.getPref('prompt_cache_size')
+        if cachesize is not None:
+            from shtoom.doug.promptcache import getPromptCache
+            getPromptCache().setMaxBytes(cachesize * 1024)
+        batchudp.configureFromPrefs(self)
 
     def start(self):
         "Start the application."
@@ -115,8 +135,14 @@ class DougApplication(BaseApplication):
         self.initVoiceapp(cookie, args)
         self._voiceapps[cookie].va_callstart(None, args)
 
-    def acceptCall(self, call):
+    def newLeg(self, cookie, dialog, voiceapp=None):
+        "A Leg for a call - a RemoteLeg, if we've a media process"
         from shtoom.doug.leg import Leg
+        if self.media is not None:
+            return self.media.newLeg(cookie, dialog, voiceapp)
+        return Leg(cookie, dialog, voiceapp)
+
+    def acceptCall(self, call):
         log.msg("acceptCall dialog is %r"%(call.dialog), system='doug')
         calltype = call.dialog.getDirection()
         if call.cookie is None:
@@ -135,7 +161,7 @@ class DougApplication(BaseApplication):
             self.initVoiceapp(cookie)
             d.addErrback(lambda x: self.rejectedCall(cookie, x))
             ad = defer.Deferred()
-            inbound = Leg(cookie, call.dialog)
+            inbound = self.newLeg(cookie, call.dialog)
             inbound.incomingCall(ad)
             self._voiceapps[cookie].va_callstart(inbound)
             d.addCallback(lambda x, ad=ad: ad)
@@ -151,7 +177,10 @@ class DougApplication(BaseApplication):
 
     def _createRTP(self, cookie, fromIP, withSTUN):
         from shtoom.rtp.protocol import RTPProtocol
-        rtp = RTPProtocol(self, cookie)
+        if self.media is not None:
+            rtp = self.media.newRTP(cookie)
+        else:
+            rtp = RTPProtocol(self, cookie)
         self._rtp[cookie] = rtp
         d = rtp.createRTPSocket(fromIP,withSTUN)
         return d
@@ -185,6 +214,10 @@ class DougApplication(BaseApplication):
         log.msg("call %s disconnected"%callcookie, reason, system='doug')
         if self._rtp.get(callcookie):
             rtp = self._rtp[callcookie]
+            if rtp.relay is not None:
+                log.msg("relay for call %s: %r"%(callcookie,
+                                rtp.relay.getStats()), system='doug')
+                rtp.relay.stop()
             rtp.stopSendingAndReceiving()
             del self._rtp[callcookie]
         if self._calls.get(callcookie):
@@ -195,29 +228,59 @@ class DougApplication(BaseApplication):
 
     def incomingRTP(self, callcookie, packet):
         from shtoom.rtp.formats import PT_NTE
-        v = self._voiceapps[callcookie]
         if packet.header.ct is PT_NTE:
             data = packet.data
             key = ord(data[0])
             start = (ord(data[1]) & 128) and True or False
-            if start:
-                #print "start inbound dtmf", key
-                v.va_startDTMFevent(nteMap[key], callcookie)
-            else:
-                #print "stop inbound dtmf", key
-                v.va_stopDTMFevent(nteMap[key], callcookie)
+            self.incomingDTMF(callcookie, nteMap[key], start)
             return
         try:
             self._voiceapps[callcookie].va_incomingRTP(packet, callcookie)
         except IOError:
             pass
 
+    def incomingDTMF(self, callcookie, key, start):
+        "An RFC 2833 event, for key, started or stopped"
+        v = self._voiceapps[callcookie]
+        if start:
+            #print "start inbound dtmf", key
+            v.va_startDTMFevent(key, callcookie)
+        else:
+            #print "stop inbound dtmf", key
+            v.va_stopDTMFevent(key, callcookie)
+
     def outgoingRTP(self, cookie, sample):
         #print "outgoingRTP", cookie, self._rtp.keys()
         rtp = self._rtp.get(cookie)
         if rtp:
             rtp.handle_media_sample(sample)
 
+    def getCallCount(self):
+        return len(self._calls)
+
+    def getMediaStats(self):
+        "The media clock's stats (see MediaClock.getStats)"
+        if self.media is not None:
+            return self.media.getStats()
+        from shtoom.audio.clock import getMediaClock
+        return getMediaClock().getStats()
+
+    def relayCalls(self, cookie1, cookie2):
+        """ Send each call's RTP straight out on the other call, without
+            decoding it (see shtoom.rtp.relay). Returns the RTPRelay,
+            or None if it's in the media process.
+        """
+        from shtoom.rtp.relay import RTPRelay
+        if self.media is not None:
+            return self.media.relayCalls(cookie1, cookie2)
+        return RTPRelay(self._rtp[cookie1], self._rtp[cookie2])
+
+    def relayRTP(self, cookie, packet):
+        "Send packet, received on another call, out on this call unchanged"
+        rtp = self._rtp.get(cookie)
+        if rtp:
+            rtp.handle_relayed_packet(packet)
+
     def placeCall(self, cookie, nleg, sipURL, fromURI=None):
         ncookie = self.getCookie()
         nleg.setCookie(ncookie)
@@ -269,10 +332,19 @@ class DougApplication(BaseApplication):
         import os.path
 
         from shtoom.Options import OptionGroup, StringOption, ChoiceOption
+        from shtoom.Options import NumberOption, BooleanOption
         app = OptionGroup('doug', 'doug')
         app.add(StringOption('logfile','log to this file'))
         app.add(StringOption('dougargs',
                                 'pass these arguments to the voiceapp'))
+        app.add(NumberOption('prompt_cache_size',
+                'keep this many KB of encoded prompts (0 to disable)'))
+        app.add(NumberOption('workers',
+                'fork this many worker processes, and share calls between them'))
+        app.add(NumberOption('worker_max_calls',
+                'give a worker with this many calls no more, if another has room'))
+        app.add(BooleanOption('media_process',
+                'run the RTP and audio in a process of their own', False))
         opts.add(app)
         if self.configFileName is not None:
             opts.setOptsFile(self.configFileName)
@@ -287,6 +359,10 @@ class DougApplication(BaseApplication):
         else:
             raise defer.fail(CallFailed("No auth available"))
 
+    def canSendNTE(self, cookie):
+        rtp = self._rtp.get(cookie)
+        return rtp is not None and rtp.canSendNTE()
+
     def startDTMF(self, cookie, digit):
         #print "app.startDTMF", cookie, digit
         rtp = self._rtp.get(cookie)
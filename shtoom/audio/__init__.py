@@ -52,6 +52,10 @@ _device = None
 def getAudioDevice(_testAudioInt=None):
     from shtoom.exceptions import NoAudioDevice
     global _device
+    try:
+        from __main__ import app
+    except:
+        app = None
     if _testAudioInt is not None:
         return MediaLayer(_testAudioInt.Device())
 
@@ -61,4 +65,7 @@ def getAudioDevice(_testAudioInt=None):
             raise NoAudioDevice("no working audio interface found")
         dev = audioint.Device()
         _device = MediaLayer(dev)
+        if app and app.getPref('playout') == 'adaptive':
+            from shtoom.audio.playout import AdaptivePlayout
+            _device.playoutFactory = AdaptivePlayout
     return _device
@@ -19,6 +19,9 @@ DEFAULT_ALSA_DEVICE = 'default'
 class ALSAAudioDevice(baseaudio.AudioDevice):
     writedev = None
     readdev = None
+    # Capture and playback run off the same sound card clock, so every
+    # period we read from the microphone, we pull a period to play.
+    pull = True
 
     def __repr__(self):
         return "ALSAAudioDevice %s" % (self.isOpen() and "open" or "closed")
@@ -57,11 +60,18 @@ class ALSAAudioDevice(baseaudio.AudioDevice):
     def _push_up_some_data(self):
         if self.readdev is None:
             return
-        (l, data,) = self.readdev.read()
-        if self.readchannels == 2:
-            data = audioop.tomono(data, 2, 1, 1)
-        if self.encoder and data:
-            self.encoder.handle_audio(data)
+        # Drain every period that's waiting, in case we were called late
+        while self.readdev is not None:
+            (l, data,) = self.readdev.read()
+            if l <= 0:
+                break
+            if self.readchannels == 2:
+                data = audioop.tomono(data, 2, 1, 1)
+            if self.encoder and data:
+                self.encoder.handle_audio(data)
+            out = self._pull_audio(l * 2)
+            if out:
+                self.write(out)
 
     def write(self, data):
         if not hasattr(self, 'LC'):
@@ -1,8 +1,18 @@
 # Copyright (C) 2004 Anthony Baxter
 
+# A pull-mode device keeps up to this much audio (two 20ms frames) queued
+# to play, to ride out a late timer.
+PULL_PRIME_BYTES = 640
+
 class AudioDevice(object):
     encoder = None
+    playout = None
     _closed = True
+    # Devices that know when they need more audio to play set this, and
+    # fetch it with _pull_audio(), rather than having write() called
+    # whenever the playout thinks they might be running low.
+    pull = False
+    _pullOwed = 0
 
     def __init__(self, mode='ignored'):
         self.openDev()
@@ -16,6 +26,29 @@ class AudioDevice(object):
         """
         self.encoder = encoder
 
+    def set_playout(self, playout):
+        """
+        For pull-mode devices, the playout object will subsequently
+        receive calls to its read(nbytes) method when the device wants
+        more audio to play.
+        """
+        self.playout = playout
+        self._pullOwed = PULL_PRIME_BYTES
+
+    def _pull_audio(self, nbytes):
+        """
+        Fetch audio to replace the nbytes the device has just played. If
+        the playout couldn't supply everything last time, the shortfall
+        (up to PULL_PRIME_BYTES) is asked for again, so the device's queue
+        is topped back up once the jitter buffer has refilled.
+        """
+        if self.playout is None:
+            return ''
+        want = nbytes + self._pullOwed
+        data = self.playout.read(want)
+        self._pullOwed = min(want - len(data), PULL_PRIME_BYTES)
+        return data
+
     def close(self):
         print "baseaudio CLOSE", self._closed
         if not self._closed:
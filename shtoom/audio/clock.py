@@ -0,0 +1,129 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" A single media clock for the whole process.
+
+    Rather than every leg, conference room and file audio device running
+    its own 20ms LoopingCall (thousands of out-of-phase timers on a busy
+    doug), everything that needs servicing once per frame registers with
+    the media clock. The clock ticks once per frame, and services all of
+    them in one batch, in priority order - mixers first (so that the mix
+    for this frame is ready), then sources (legs, devices) that read it,
+    then anything that batches up work the sources queued (encoding).
+"""
+
+import time
+
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+FRAME_SECONDS = 0.020
+
+# Lower priorities run first in each tick.
+PRIORITY_MIX = 0
+PRIORITY_SOURCE = 10
+PRIORITY_ENCODE = 20
+
+class MediaClock:
+    "Calls every registered callable once per media frame"
+
+    def __init__(self, interval=FRAME_SECONDS):
+        self.interval = interval
+        self._members = {}
+        self._order = ()
+        self._LC = None
+        self.resetStats()
+
+    def add(self, callable, priority=PRIORITY_SOURCE):
+        """ Register callable to be called once every tick. Starts the clock
+            if it's not already running.
+        """
+        self._members[callable] = priority
+        self._reorder()
+        if self._LC is None:
+            self._LC = LoopingCall(self.tick)
+            # Don't call anything from inside add()
+            self._LC.start(self.interval, now=False)
+
+    def remove(self, callable):
+        "Unregister callable. The clock stops when nothing is left"
+        if callable in self._members:
+            del self._members[callable]
+            self._reorder()
+        if not self._members and self._LC is not None:
+            LC, self._LC = self._LC, None
+            LC.stop()
+            self._lastTick = None
+
+    def isMember(self, callable):
+        return callable in self._members
+
+    def memberCount(self):
+        return len(self._members)
+
+    def isRunning(self):
+        return self._LC is not None
+
+    def _reorder(self):
+        order = [ (p, n, c) for (n, (c, p)) in
+                                    enumerate(self._members.items()) ]
+        order.sort()
+        self._order = tuple([ x[2] for x in order ])
+
+    def tick(self, t=time.time):
+        "Service every registered callable. Called by the LoopingCall"
+        start = t()
+        if self._lastTick is not None:
+            late = (start - self._lastTick) - self.interval
+            if late > self.interval:
+                # We missed (at least) a whole frame
+                self.stats['late'] += 1
+            if late > self.stats['maxLate']:
+                self.stats['maxLate'] = late
+        self._lastTick = start
+        # Take a reference - members may come and go during the tick
+        members = self._members
+        for callable in self._order:
+            if callable not in members:
+                # removed earlier in this tick
+                continue
+            try:
+                callable()
+            except:
+                log.err()
+                # Don't keep calling something that's broken
+                self.remove(callable)
+        took = t() - start
+        stats = self.stats
+        stats['ticks'] += 1
+        stats['lastTickTime'] = took
+        if took > stats['maxTickTime']:
+            stats['maxTickTime'] = took
+        if took > self.interval:
+            stats['overruns'] += 1
+            log.msg("media clock overrun: tick took %0.3fs for %d members"%(
+                                    took, len(self._order)), system='media')
+
+    def getStats(self):
+        """ Returns a dictionary of tick metrics: ticks, overruns (ticks
+            that took longer than a frame), late (ticks that fired more
+            than a frame late), lastTickTime, maxTickTime, maxLate and
+            members.
+        """
+        stats = self.stats.copy()
+        stats['members'] = len(self._members)
+        return stats
+
+    def resetStats(self):
+        self._lastTick = None
+        self.stats = { 'ticks': 0, 'overruns': 0, 'late': 0,
+                       'lastTickTime': 0.0, 'maxTickTime': 0.0,
+                       'maxLate': 0.0 }
+
+_clock = None
+
+def getMediaClock():
+    "Return the process-wide MediaClock"
+    global _clock
+    if _clock is None:
+        _clock = MediaClock()
+    return _clock
@@ -3,7 +3,7 @@ from shtoom.rtp.formats import PT_PCMU, PT_GSM, PT_SPEEX, PT_DVI4, PT_RAW
 from shtoom.rtp.formats import PT_PCMA, PT_ILBC
 from shtoom.rtp.formats import PT_CN, PT_xCN, AudioPTMarker
 from shtoom.avail import codecs
-from shtoom.audio import aufile, playout
+from shtoom.audio import aufile, playout, g711
 from shtoom.lwc import Interface, implements
 
 from twisted.python import log
@@ -73,20 +73,79 @@ class IAudioCodec:
     def decode(self, bytes):
         "decode bytes, a string of audio"
 
+class FrameBuffer:
+    """ Splits a stream of audio into fixed size frames.
+
+        Pending audio is kept in a bytearray with a read offset, so taking
+        frames off the front copies only those frames, not everything
+        behind them. The consumed space is reclaimed once it's more than
+        half the buffer.
+    """
+    def __init__(self, framesize):
+        self.framesize = framesize
+        self._buf = bytearray()
+        self._off = 0
+
+    def __len__(self):
+        return len(self._buf) - self._off
+
+    def write(self, bytes):
+        self._buf.extend(bytes)
+
+    def frames(self):
+        """ Remove all the complete frames waiting. Returns (data, count),
+            where data is the count frames as a single string.
+        """
+        count = len(self) // self.framesize
+        if not count:
+            return '', 0
+        start = self._off
+        end = start + count * self.framesize
+        data = str(self._buf[start:end])
+        if end * 2 >= len(self._buf):
+            del self._buf[:end]
+            self._off = 0
+        else:
+            self._off = end
+        return data, count
+
+def splitFrames(data, count):
+    "Split data into count equal sized frames"
+    size = len(data) // count
+    return [ data[i:i+size] for i in xrange(0, size * count, size) ]
+
 class _Codec:
     "Base class for codecs"
     implements(IAudioCodec)
+    # A codec that keeps no state between frames can be shared by every
+    # call (see CodecPool)
+    shared = False
+
     def __init__(self, samplesize):
         self.samplesize = samplesize
-        self.b = ''
+        self.b = FrameBuffer(samplesize)
 
-    def buffer_and_encode(self, bytes):
-        self.b += bytes
-        res = []
-        while len(self.b) >= self.samplesize:
-            sample, self.b = self.b[:self.samplesize], self.b[self.samplesize:]
-            res.append(self._encode(sample))
-        return res
+    def reset(self):
+        "Discard any buffered audio, before the codec's reused"
+        self.b = FrameBuffer(self.samplesize)
+
+    def buffer_and_encode(self, bytes, frames=None):
+        """ Buffer bytes, and encode any complete frames. A shared codec
+            must be passed the caller's own FrameBuffer in frames.
+        """
+        if frames is None:
+            frames = self.b
+        frames.write(bytes)
+        data, count = frames.frames()
+        if not count:
+            return []
+        return self._encode_frames(data, count)
+
+    def _encode_frames(self, data, count):
+        """ Encode count frames of audio, passed as one string. Codecs that
+            can encode a batch of frames in one call override this.
+        """
+        return [ self._encode(frame) for frame in splitFrames(data, count) ]
 
 class GSMCodec(_Codec):
     def __init__(self):
@@ -133,6 +192,7 @@ class SpeexCodec(_Codec):
 
 class MulawCodec(_Codec):
     "A codec for mulaw encoded audio (G.711U, PCMU)"
+    shared = True
 
     def __init__(self):
         _Codec.__init__(self, 320)
@@ -141,6 +201,9 @@ class MulawCodec(_Codec):
     def _encode(self, bytes):
         return audioop.lin2ulaw(bytes, 2)
 
+    def _encode_frames(self, data, count):
+        return splitFrames(g711.encode(PT_PCMU, data), count)
+
     def decode(self, bytes):
         if not bytes:
             return
@@ -161,6 +224,7 @@ class MulawCodec(_Codec):
 
 class AlawCodec(_Codec):
     "A codec for alaw encoded audio (G.711A, PCMA)"
+    shared = True
 
     def __init__(self):
         _Codec.__init__(self, 320)
@@ -168,6 +232,9 @@ class AlawCodec(_Codec):
     def _encode(self, bytes):
         return audioop.lin2alaw(bytes, 2)
 
+    def _encode_frames(self, data, count):
+        return splitFrames(g711.encode(PT_PCMA, data), count)
+
     def decode(self, bytes):
         if len(bytes) != 160:
             log.msg("alaw: short read on decode, %d != 160"%len(bytes),
@@ -176,6 +243,7 @@ class AlawCodec(_Codec):
 
 class NullCodec(_Codec):
     "A codec that consumes/emits nothing (e.g. for confort noise)"
+    shared = True
 
     def __init__(self):
         _Codec.__init__(self, 1)
@@ -188,41 +256,161 @@ class NullCodec(_Codec):
 
 class PassthruCodec(_Codec):
     "A codec that leaves it's input alone"
+    shared = True
     def __init__(self):
         _Codec.__init__(self, None)
     decode = lambda self, bytes: bytes
-    buffer_and_encode = lambda self, bytes: [bytes]
-
-def make_codec_set():
-    format_to_codec = {}
-    format_to_codec[PT_CN] = NullCodec()
-    format_to_codec[PT_xCN] = NullCodec()
-    format_to_codec[PT_RAW] = PassthruCodec()
+    buffer_and_encode = lambda self, bytes, frames=None: [bytes]
+
+def codec_classes():
+    "Returns a dictionary of payload type to codec class, for what we have"
+    format_to_class = {}
+    format_to_class[PT_CN] = NullCodec
+    format_to_class[PT_xCN] = NullCodec
+    format_to_class[PT_RAW] = PassthruCodec
     assert codecs.mulaw
     if codecs.mulaw is not None:
-        format_to_codec[PT_PCMU] = MulawCodec()
+        format_to_class[PT_PCMU] = MulawCodec
     if codecs.alaw is not None:
-        format_to_codec[PT_PCMA] = AlawCodec()
+        format_to_class[PT_PCMA] = AlawCodec
     if codecs.gsm is not None:
-        format_to_codec[PT_GSM] = GSMCodec()
+        format_to_class[PT_GSM] = GSMCodec
     if codecs.speex is not None:
-        format_to_codec[PT_SPEEX] = SpeexCodec()
+        format_to_class[PT_SPEEX] = SpeexCodec
     #if codecs.dvi4 is not None:
-    #    format_to_codec[PT_DVI4] = DVI4Codec()
+    #    format_to_class[PT_DVI4] = DVI4Codec
     #if codecs.ilbc is not None:
-    #    format_to_codec[PT_ILBC] = ILBCCodec()
+    #    format_to_class[PT_ILBC] = ILBCCodec
+    return format_to_class
+
+def make_codec_set():
+    "Returns a dictionary of payload type to a new instance of every codec"
+    format_to_codec = {}
+    for fmt, klass in codec_classes().items():
+        format_to_codec[fmt] = klass()
     return format_to_codec
 
-known_formats = (sets.ImmutableSet(make_codec_set().keys()) -
+known_formats = (sets.ImmutableSet(codec_classes().keys()) -
                                   sets.ImmutableSet([PT_CN, PT_xCN,]))
 
+# Most idle instances of each stateful codec kept for reuse
+MAX_POOLED_CODECS = 32
+
+class CodecPool:
+    """ Hands out codec instances, creating them only when they're first
+        needed. Codecs with no per-call state (codec.shared) are created
+        once and shared by every call. The rest (GSM and Speex keep
+        encoder/decoder state) are kept on a free list when a call's done
+        with them, ready for the next call.
+    """
+    def __init__(self, classes=None, maxFree=MAX_POOLED_CODECS):
+        if classes is None:
+            classes = codec_classes()
+        self.classes = classes
+        self.maxFree = maxFree
+        self._shared = {}
+        self._free = {}
+        self._created = 0
+
+    def acquire(self, fmt):
+        "Returns a codec for payload type fmt, or None if we can't do it"
+        klass = self.classes.get(fmt)
+        if klass is None:
+            return None
+        if klass.shared:
+            codec = self._shared.get(fmt)
+            if codec is None:
+                codec = self._shared[fmt] = klass()
+                self._created += 1
+            return codec
+        free = self._free.get(fmt)
+        if free:
+            return free.pop()
+        self._created += 1
+        return klass()
+
+    def release(self, fmt, codec):
+        "A call's finished with codec"
+        if codec.shared:
+            return
+        free = self._free.setdefault(fmt, [])
+        if len(free) < self.maxFree:
+            codec.reset()
+            free.append(codec)
+
+    def getStats(self):
+        """ Returns a dictionary with the number of codecs created, and
+            the number of idle ones in the pool.
+        """
+        free = 0
+        for l in self._free.values():
+            free += len(l)
+        return { 'created': self._created, 'free': free }
+
+_codecPool = None
+
+def getCodecPool():
+    global _codecPool
+    if _codecPool is None:
+        _codecPool = CodecPool()
+    return _codecPool
+
+class CodecSet:
+    """ The codecs one Codecker is using, by payload type. Codecs are
+        acquired from the pool on first use, and go back when the set is
+        released.
+    """
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = getCodecPool()
+        self.pool = pool
+        self._codecs = {}
+
+    def get(self, fmt, default=None):
+        codec = self._codecs.get(fmt)
+        if codec is None:
+            codec = self.pool.acquire(fmt)
+            if codec is None:
+                return default
+            self._codecs[fmt] = codec
+        return codec
+
+    def values(self):
+        return self._codecs.values()
+
+    def release(self):
+        for fmt, codec in self._codecs.items():
+            self.pool.release(fmt, codec)
+        self._codecs = {}
+
 class Codecker:
+    # Once closed, we've given our codecs back, and won't take any more
+    closed = False
+
     def __init__(self, format):
-        self.format_to_codec = make_codec_set()
         if not format in known_formats:
             raise ValueError("Can't handle codec %r"%format)
+        self.format_to_codec = CodecSet()
         self.format = format
         self.handler = None
+        # Our own buffer of audio waiting to be encoded, as the codec may
+        # be shared with other calls.
+        self._frames = None
+
+    def isShared(self):
+        """ Can the frames we encode be sent on more than one call? Only if
+            the codec keeps no state from one frame to the next.
+        """
+        if self.closed:
+            return False
+        codec = self.format_to_codec.get(self.format)
+        return codec is not None and codec.shared
+
+    def close(self):
+        "Give our codecs back to the pool. Nothing's coded after this."
+        self.closed = True
+        self.format_to_codec.release()
+        self._frames = None
 
     def set_handler(self, handler):
         """
@@ -235,12 +423,14 @@ class Codecker:
 
     def handle_audio(self, bytes):
         "Accept audio as bytes, emits MediaSamples."
-        if not bytes:
+        if not bytes or self.closed:
             return None
         codec = self.format_to_codec.get(self.format)
         if not codec:
             raise ValueError("can't encode format %r"%self.format)
-        encaudios = codec.buffer_and_encode(bytes)
+        if self._frames is None:
+            self._frames = FrameBuffer(codec.samplesize)
+        encaudios = codec.buffer_and_encode(bytes, self._frames)
         for encaudio in encaudios:
             samp = MediaSample(self.format, encaudio)
             if self.handler is not None:
@@ -248,9 +438,35 @@ class Codecker:
             else:
                 return samp
 
+    def handle_audio_batched(self, bytes, callback, batch=None):
+        """ Like handle_audio, but callback is called with each MediaSample
+            (or None, if there's no complete frame yet). G.711 isn't encoded
+            straight away, but queued on the G711Batch, to be done along
+            with every other call's audio at the end of this media tick.
+        """
+        if self.format not in (PT_PCMU, PT_PCMA) or self.closed:
+            callback(self.handle_audio(bytes))
+            return
+        codec = self.format_to_codec.get(self.format)
+        if self._frames is None:
+            self._frames = FrameBuffer(codec.samplesize)
+        if bytes:
+            self._frames.write(bytes)
+        data, count = self._frames.frames()
+        if not count:
+            callback(None)
+            return
+        if batch is None:
+            batch = g711.getBatch()
+        format = self.format
+        def _encoded(encaudio):
+            for frame in splitFrames(encaudio, count):
+                callback(MediaSample(format, frame))
+        batch.add(PT_RAW, format, data, _encoded)
+
     def decode(self, packet):
         "Accepts an RTPPacket, emits audio as bytes"
-        if not packet.data:
+        if not packet.data or self.closed:
             return None
         codec = self.format_to_codec.get(packet.header.ct)
         if not codec:
@@ -267,6 +483,8 @@ class MediaLayer(NullConv):
 
     _playfile_LC = None
     _playfile_fp = None
+    # The jitter buffer - see shtoom.audio.playout
+    playoutFactory = playout.Playout
 
     def __init__(self, device, *args, **kwargs):
         self.playout = None
@@ -283,10 +501,12 @@ class MediaLayer(NullConv):
             log.msg("write before reopen, discarding")
             return 0
         audio = self.codecker.decode(packet)
+        header = packet.header
         if audio:
-            return self.playout.write(audio, packet.header.seq)
+            return self.playout.write(audio, header.seq, header.ts,
+                                      header.marker)
         else:
-            self.playout.write('', packet.header.seq)
+            self.playout.write('', header.seq, header.ts, header.marker)
             return 0
 
     def selectDefaultFormat(self, fmts=[PT_PCMU,]):
@@ -313,6 +533,8 @@ class MediaLayer(NullConv):
         assert self.defaultFormat, "must call selectDefaultFormat()"+\
                                    "before (re-)opening the device."
 
+        if self.codecker is not None:
+            self.codecker.close()
         self.codecker = Codecker(self.defaultFormat)
         self._d.reopen()
         if mediahandler:
@@ -324,7 +546,10 @@ class MediaLayer(NullConv):
         if self.playout:
             log.msg("playout already started")
         else:
-            self.playout = playout.Playout(self)
+            self.playout = self.playoutFactory(self)
+            if getattr(self._d, 'pull', False):
+                self.playout.pullmode = True
+                self._d.set_playout(self.playout)
 
     def playWaveFile(self, fname):
         from twisted.internet.task import LoopingCall
@@ -357,19 +582,36 @@ class MediaLayer(NullConv):
             self._playfile_fp = None
 
     def close(self):
+        if self.playout is not None and self.playout.pullmode:
+            self._d.set_playout(None)
         self.playout = None
+        if self.codecker is not None:
+            self.codecker.close()
         self.codecker = None
-        self._d.set_encoder(nullencoder)
+        if self._d is not None:
+            self._d.set_encoder(nullencoder)
         NullConv.close(self)
 
 class DougConverter(MediaLayer):
     "Specialised converter for Doug."
     # XXX should be refactored away to just use a Codecker directly
+    # Set once the call's over - late packets aren't decoded, so they
+    # don't take codecs back out of the pool
+    closed = False
+
     def __init__(self, defaultFormat=PT_PCMU, *args, **kwargs):
+        self.playout = None
+        # The format we encode to (our codecker goes when we're closed)
+        self.format = defaultFormat
         self.codecker = Codecker(defaultFormat)
         self.convertInbound = self.codecker.decode
         self.convertOutbound = self.codecker.handle_audio
+        self.convertOutboundBatched = self.codecker.handle_audio_batched
         self.set_handler = self.codecker.set_handler
         if not kwargs.get('device'):
             kwargs['device'] = None
         NullConv.__init__(self, *args, **kwargs)
+
+    def close(self):
+        self.closed = True
+        MediaLayer.close(self)
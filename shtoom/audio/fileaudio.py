@@ -2,12 +2,14 @@
 
 from twisted.python import log
 from shtoom.audio import baseaudio
-from twisted.internet.task import LoopingCall
+from shtoom.audio.clock import getMediaClock
 
 # XXX TOFIX: use the audio pref to specify infile,outfile and kill two options
 class AudioFromFiles(baseaudio.AudioDevice):
     _infp = _outfp = None
-    LC = None
+    clock = None
+    # The output file takes a frame per tick of the media clock
+    pull = True
 
     def __init__(self):
         try:
@@ -29,6 +31,9 @@ class AudioFromFiles(baseaudio.AudioDevice):
         self.close()
 
     def _push_up_some_data(self):
+        out = self._pull_audio(320)
+        if out:
+            self.write(out)
         if not self.encoder or self._infp is None:
             return
         data = self._infp.read(320)
@@ -51,27 +56,26 @@ class AudioFromFiles(baseaudio.AudioDevice):
             self._outfp = None
 
     def _close(self):
-        #print "close called", self._closed, self.LC
+        #print "close called", self._closed, self.clock
         if self._infp is not None:
             self._infp.close()
         if self._outfp is not None:
             self._outfp.close()
         self._closed = True
         self._infp = self._outfp = None
-        self.LC.stop()
-        self.LC = None
+        self.clock.remove(self._push_up_some_data)
+        self.clock = None
 
     def openDev(self):
         from shtoom.util import stack
         self._getFiles()
-        #print "openDev called!", self._closed, self.LC, stack()
-        if self.LC is not None:
+        #print "openDev called!", self._closed, self.clock, stack()
+        if self.clock is not None:
             return
         if self._infp is None and self._outfp is None:
             self._getFiles()
-        self.LC = LoopingCall(self._push_up_some_data)
-        #print self, "creating LoopingCall", self.LC, stack()
-        self.LC.start(0.020)
+        self.clock = getMediaClock()
+        self.clock.add(self._push_up_some_data)
 
 
 Device = AudioFromFiles
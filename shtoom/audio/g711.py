@@ -0,0 +1,189 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" Batch G.711 transcoding.
+
+    With a lot of calls, the cost of G.711 is mostly the Python around
+    each 20ms frame, not the conversion itself. A G711Batch collects all
+    the conversions due in one tick of the media clock, from every call,
+    and does each kind (say, linear to mu-law) in a single pass over all
+    of them.
+
+    Conversions are table lookups: 256 entry tables for decoding and for
+    going straight between mu-law and A-law (str.translate does those at
+    C speed), and a 65536 entry table for encoding, which is used if
+    NumPy is available - otherwise encoding is one audioop call per
+    batch. The tables are built from audioop, so the results are
+    identical to the per-frame codecs.
+"""
+
+import audioop
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from twisted.python import log
+
+from shtoom.rtp.formats import PT_PCMU, PT_PCMA, PT_RAW
+from shtoom.audio.clock import getMediaClock, PRIORITY_ENCODE
+
+_allBytes = ''.join([ chr(x) for x in range(256) ])
+
+# 8 bit code -> 16 bit linear sample (native byte order, as audioop)
+ULAW_TO_LIN = audioop.ulaw2lin(_allBytes, 2)
+ALAW_TO_LIN = audioop.alaw2lin(_allBytes, 2)
+# 8 bit code -> 8 bit code, for str.translate
+ULAW_TO_ALAW = audioop.lin2alaw(ULAW_TO_LIN, 2)
+ALAW_TO_ULAW = audioop.lin2ulaw(ALAW_TO_LIN, 2)
+
+def _highBytes(table):
+    "8 bit code -> the top 8 bits of its 16 bit sample, for str.translate"
+    return ''.join([ chr((s >> 8) & 0xff) for s in
+                     struct.unpack('256h', table) ])
+_levelTables = {
+    PT_PCMU: _highBytes(ULAW_TO_LIN),
+    PT_PCMA: _highBytes(ALAW_TO_LIN),
+}
+
+if numpy is not None:
+    _decodeTables = {
+        PT_PCMU: numpy.fromstring(ULAW_TO_LIN, numpy.int16),
+        PT_PCMA: numpy.fromstring(ALAW_TO_LIN, numpy.int16),
+    }
+    # every 16 bit sample, in the order numpy.uint16 indexes them
+    _allSamples = numpy.arange(65536, dtype=numpy.uint16).tostring()
+    _encodeTables = {
+        PT_PCMU: numpy.fromstring(audioop.lin2ulaw(_allSamples, 2),
+                                  numpy.uint8),
+        PT_PCMA: numpy.fromstring(audioop.lin2alaw(_allSamples, 2),
+                                  numpy.uint8),
+    }
+    del _allSamples
+
+def ulaw2alaw(data):
+    "Convert mu-law to A-law directly"
+    return data.translate(ULAW_TO_ALAW)
+
+def alaw2ulaw(data):
+    "Convert A-law to mu-law directly"
+    return data.translate(ALAW_TO_ULAW)
+
+def decode(fmt, data):
+    "Decode G.711 (PT_PCMU or PT_PCMA) to 16 bit linear"
+    if numpy is not None:
+        codes = numpy.fromstring(data, numpy.uint8)
+        return _decodeTables[fmt][codes].tostring()
+    if fmt == PT_PCMU:
+        return audioop.ulaw2lin(data, 2)
+    else:
+        return audioop.alaw2lin(data, 2)
+
+def encode(fmt, data):
+    "Encode 16 bit linear to G.711 (PT_PCMU or PT_PCMA)"
+    if numpy is not None:
+        samples = numpy.fromstring(data, numpy.uint16)
+        return _encodeTables[fmt][samples].tostring()
+    if fmt == PT_PCMU:
+        return audioop.lin2ulaw(data, 2)
+    else:
+        return audioop.lin2alaw(data, 2)
+
+def level(fmt, data):
+    """ The RMS level of G.711 audio, roughly, without decoding it. Good
+        enough for deciding who's talking.
+    """
+    return audioop.rms(data.translate(_levelTables[fmt]), 1) << 8
+
+def transcode(src, dst, data):
+    """ Convert data from format src to dst, each one of PT_PCMU, PT_PCMA
+        or PT_RAW (16 bit linear).
+    """
+    if src == dst:
+        return data
+    if src == PT_RAW:
+        return encode(dst, data)
+    if dst == PT_RAW:
+        return decode(src, data)
+    if src == PT_PCMU:
+        return ulaw2alaw(data)
+    return alaw2ulaw(data)
+
+class G711Batch:
+    """ Conversions queued up for the end of this media clock tick.
+
+        add() a conversion, with a callback; when the batch runs (after
+        the sources have all had their turn in the tick), every queued
+        conversion of the same kind is done together, and the callbacks
+        get their own piece of the result.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        # (src, dst) -> [ (data, callback), ... ]
+        self._jobs = {}
+        self._idle = 0
+
+    def add(self, src, dst, data, callback):
+        "Convert data from src to dst; callback(result) is called later"
+        self._jobs.setdefault((src, dst), []).append((data, callback))
+        if self.clock is None:
+            self.clock = getMediaClock()
+        if not self.clock.isMember(self.run):
+            self.clock.add(self.run, PRIORITY_ENCODE)
+        self._idle = 0
+
+    def pending(self):
+        n = 0
+        for jobs in self._jobs.values():
+            n += len(jobs)
+        return n
+
+    def run(self):
+        "Do everything that's been queued. Called from the media clock"
+        jobs, self._jobs = self._jobs, {}
+        if not jobs:
+            # Stay on the clock while calls keep queueing work every tick
+            self._idle += 1
+            if self._idle > 1 and self.clock is not None:
+                self.clock.remove(self.run)
+            return
+        for (src, dst), work in jobs.items():
+            if len(work) == 1:
+                data, callback = work[0]
+                out = [ transcode(src, dst, data) ]
+            else:
+                out = self._convert(src, dst, [ x[0] for x in work ])
+            for (data, callback), result in zip(work, out):
+                try:
+                    callback(result)
+                except:
+                    log.err()
+
+    def _convert(self, src, dst, datas):
+        "Convert a list of strings in one pass, returns the list of results"
+        result = transcode(src, dst, ''.join(datas))
+        # Each output is a fixed multiple (or fraction) of its input size
+        if src == PT_RAW:
+            scale = 0.5
+        elif dst == PT_RAW:
+            scale = 2
+        else:
+            scale = 1
+        out = []
+        offset = 0
+        for data in datas:
+            n = int(len(data) * scale)
+            out.append(result[offset:offset+n])
+            offset += n
+        return out
+
+_batch = None
+
+def getBatch():
+    "The G711Batch for the process' media clock"
+    global _batch
+    if _batch is None:
+        _batch = G711Batch()
+    return _batch
@@ -10,6 +10,8 @@ opened = None
 
 class OSSAudioDevice(baseaudio.AudioDevice):
     dev = None
+    # For every chunk read from the microphone, a chunk is pulled to play
+    pull = True
 
     def openDev(self):
         try:
@@ -53,6 +55,10 @@ class OSSAudioDevice(baseaudio.AudioDevice):
             data = tomono(data, 2, 1, 1)
         if self.encoder and data:
             self.encoder.handle_audio(data)
+        if data:
+            out = self._pull_audio(len(data))
+            if out:
+                self.write(out)
 
     def write(self, data):
         from audioop import tostereo
@@ -1,6 +1,6 @@
 # from the Python Standard Library
-from bisect import bisect
 import sys
+from collections import deque
 
 # from the Twisted library
 from twisted.internet import reactor
@@ -10,22 +10,16 @@ from twisted.python import log
 #  * think about persistent clock skew (the RTP book by Perkins has an extensive discussion and sophisticated algorithm for this)
 #  * measure (callLater lag, jitter, clock skew,)
 #  * add more livetests
-#  * minimize playout buffer. The only reason for the large size
-#  of PLAYOUT_BUFFER -- currently 0.8 seconds (!!!) is because we
-#  didn't have a precise way to get our Python called *just* before
-#  the audio output FIFO underran, on Mac. Such a precise way has been
-#  added on Mac thanks to Bob Ippolito. The thing to do on Mac is use
-#  the callback Bob provided, which means "the audio output buffer
-#  is on the verge of running dry" to move the next packet's worth
-#  of audio from jitter buffer to output device FIFO. That is: call
-#  "consider_playing_out_sample()" from the audio device's "I'm about to
-#  run dry" callback, instead of from a reactor.callLater(). Hopefully
-#  similar things could be done on Linux and w32 as well. This *might*
-#  trigger a cleanup of this code, because the event that comes from the
-#  audio device saying "okay I've just about finished playing those 20
-#  ms you gave me" and the event that comes from "hey a network packet
-#  arrived with some audio data in it" could be probably be completely
-#  separate from each other and each could probably be simpler...
+#  * minimize playout buffer on devices that can't pull audio. Devices
+#  which can say "I'm about to run dry" (AudioDevice.pull - ALSA, OSS,
+#  file and TCP audio) call Playout.read() for exactly what they need, so
+#  there's no playout buffer and no scheduled checks for them. The rest
+#  get pushed to from reactor.callLater(), and the only reason for the
+#  large size of PLAYOUT_BUFFER -- currently 0.8 seconds (!!!) on Mac --
+#  is because we didn't have a precise way to get our Python called
+#  *just* before the audio output FIFO underran. Such a precise way has
+#  been added on Mac thanks to Bob Ippolito; the osxaudio device should
+#  be moved over to pulling from its coreaudio callback.
 
 if 'darwin' in sys.platform.lower():
     # stuff up to this many seconds worth of packets into the audio output buffer
@@ -46,23 +40,23 @@ import time
 DEBUG=False
 #DEBUG=True
 
-def is_run(packets, i, runsecs):
-    """
-        Returns True iff packets contains a run of sequential packets starting at
-        index i and extending at least runsecs seconds in aggregate length.
+# The jitter buffer is a ring indexed by (extended) sequence number. It
+# must hold at least CATCHUP_TRIGGER_SECONDS worth of 20ms packets; it's
+# a power of two so the index is just a mask.
+RING_SIZE = 512
+RING_MASK = RING_SIZE - 1
+
+# 16000 bytes of 16 bit, 8KHz audio per second
+BYTES_PER_SECOND = 16000
+
+def seqdiff(a, b):
+    """ Returns the difference a - b between two 16 bit RTP sequence
+        numbers, allowing for wraparound - a result in -32768..32767.
     """
-    runbytes = runsecs * 16000
-    firstseq = packets[i][0]
-    runbytessofar = 0
-    i2 = 0
-    while runbytessofar < runbytes:
-        if len(packets) <= i + i2:
-            return False
-        if packets[i + i2][0] != firstseq + i2:
-            return False
-        runbytessofar += len(packets[i + i2][1])
-        i2 += 1
-    return True
+    d = (a - b) & 0xffff
+    if d >= 0x8000:
+        d -= 0x10000
+    return d
 
 class Playout:
     """
@@ -78,6 +72,16 @@ class Playout:
     have JITTER_BUFFER_SECONDS worth of sequential, in-order data ready, and
     then switch to playout mode.
 
+    The jitter buffer is a ring of RING_SIZE slots indexed by sequence
+    number. Sequence numbers are extended past 16 bits (relative to the
+    next packet to be played, self.head) so wraparound just works. Rather
+    than rescanning the buffer for runs of sequential packets, we keep
+    track of two runs as packets arrive - the one starting at self.head
+    (which is what we'd play next), and the one ending at the newest
+    packet (which is what we switch to if the head run has a hole in it
+    that never gets filled). Each packet extends a run at most once, so
+    the cost per packet is O(1) amortised.
+
     There's an added complication because this code doesn't currently have a
     nice clean way to say "write this 20 milliseconds worth of audio to the
     output device\'s FIFO, and then run the following method *just* before those
@@ -87,10 +91,30 @@ class Playout:
     more packets before it underruns, even when reactor.callLater() sometimes
     gets called 110 milliseconds later than we wanted.  This happens on Mac.
     See TODO item about playout buffer in comments above.
+
+    If the audio device can tell us when it needs more audio, none of that
+    is needed: in pull mode (self.pullmode) write() only fills the jitter
+    buffer, and the device calls read() for the next chunk of audio just
+    before its FIFO runs out.
     """
     def __init__(self, medialayer):
         self.medialayer = medialayer
-        self.b = [] # (seqno, bytes,)
+        # slot -> (extended seqno, bytes,)
+        self.ring = [None] * RING_SIZE
+        # the extended sequence number of the next packet to go to the
+        # output device, or None if we've not seen any packets yet
+        self.head = None
+        # the run of sequential packets starting at head: its end (the
+        # first missing seqno) and its length in bytes
+        self.runend = None
+        self.runbytes = 0
+        # the run of sequential packets ending at the newest packet
+        self.tailstart = None
+        self.tailbytes = 0
+        self.newest = None
+        # Has anything been played (or thrown away) since the buffer was
+        # started? If not, a packet from before head can still be used.
+        self.consumed = False
         # the sequence number of the (most recent) packet which has gone to
         # the output device
         self.s = 0
@@ -100,10 +124,83 @@ class Playout:
         self.nextcheckscheduled = None
         self.st = time.time()
         self.stopping = False
+        self._jitterbytes = JITTER_BUFFER_SECONDS * BYTES_PER_SECOND
+        self._catchupbytes = CATCHUP_TRIGGER_SECONDS * BYTES_PER_SECOND
+        # set by the MediaLayer when the device pulls audio from read()
+        self.pullmode = False
+        # the part of a packet that didn't fit in the last read()
+        self._partial = ''
 
     def close(self):
         self.stopping = True
 
+    def __len__(self):
+        "The number of packets in the jitter buffer"
+        if self.head is None:
+            return 0
+        return len([ x for x in self.ring if x is not None ])
+
+    def _get(self, ext):
+        slot = self.ring[ext & RING_MASK]
+        if slot is not None and slot[0] == ext:
+            return slot[1]
+        return None
+
+    def _reset(self, ext):
+        "Empty the jitter buffer, and start again at ext"
+        self.ring = [None] * RING_SIZE
+        self.head = self.runend = self.tailstart = self.newest = ext
+        self.runbytes = self.tailbytes = 0
+        self.consumed = False
+
+    def _drop_head(self):
+        "Discard the packet at head, returns its bytes (or None)"
+        ring, head = self.ring, self.head
+        i = head & RING_MASK
+        slot = ring[i]
+        if slot is not None and slot[0] == head:
+            ring[i] = None
+            bytes = slot[1]
+        else:
+            bytes = None
+        self.head = head + 1
+        self.consumed = True
+        if self.runend > head:
+            self.runbytes -= len(bytes)
+        else:
+            # we've stepped over a hole - the run starts afresh
+            self.runend = self.head
+            self.runbytes = 0
+            self._extend_run()
+        if self.tailstart <= head:
+            if bytes is not None:
+                self.tailbytes -= len(bytes)
+            self.tailstart = self.head
+        if self.newest < self.head:
+            self.newest = self.head
+        return bytes
+
+    def _skip_to(self, ext):
+        "Discard everything before ext"
+        while self.head < ext:
+            self._drop_head()
+
+    def _extend_run(self):
+        get = self._get
+        bytes = get(self.runend)
+        while bytes is not None:
+            self.runbytes += len(bytes)
+            self.runend += 1
+            bytes = get(self.runend)
+
+    def _extend_tail_backwards(self):
+        get = self._get
+        bytes = get(self.tailstart - 1)
+        while bytes is not None and self.tailstart > self.head:
+            self.tailbytes += len(bytes)
+            self.tailstart -= 1
+            bytes = get(self.tailstart - 1)
+
     def _schedule_next_check(self, delta, t=time.time):
         if self.nextcheckscheduled:
             return
@@ -123,44 +220,46 @@ class Playout:
         self._consider_playing_out_sample()
 
     def _consider_playing_out_sample(self, t=time.time, newsampseqno=None):
-        if not self.b or self.b[0][0] != (self.s + 1):
+        if self.head is None or self.runend == self.head:
             # We don't have a packet ready to play out.
             if t() >= self.drytime:
                 self._switch_to_refill_mode()
             return
 
         if self.drytime and (t() >= self.drytime) and ((not newsampseqno) or
-                                                    (newsampseqno != (self.s + 1))):
+                                                    (newsampseqno != self.head)):
             log.msg(("output device ran dry unnecessarily! now: %0.3f, "+
                     "self.drytime: %s, nextseq: %s, newsampseqno: %s") %
-                    (t() - self.st, self.drytime - self.st, self.b[0][0], newsampseqno,))
+                    (t() - self.st, self.drytime - self.st, self.head & 0xffff,
+                    newsampseqno,))
 
         # While the output device would run dry within PLAYOUT_BUFFER_SECONDS from
         # now, then play out another sample.
         while ((t() + PLAYOUT_BUFFER_SECONDS >= self.drytime)
-                            and self.b and self.b[0][0] == (self.s + 1)):
-            (seq, bytes,) = self.b.pop(0)
+                            and self.runend > self.head):
+            seq = self.head & 0xffff
+            bytes = self._drop_head()
             self.medialayer._d.write(bytes)
             self.s = seq
-            packetlen = len(bytes) / float(16000)
+            packetlen = len(bytes) / float(BYTES_PER_SECOND)
             if self.drytime is None:
                 self.drytime = t() + packetlen
             else:
                 self.drytime = max(self.drytime + packetlen, t() + packetlen)
             if DEBUG:
-                log.msg("xxxxx %0.3f played %s, playbuflen ~= %0.3f, jitterbuf: %d:%s"
+                log.msg("xxxxx %0.3f played %s, playbuflen ~= %0.3f, jitterbuf: %d"
                         % (t() - self.st, seq, self.drytime and
-                        (self.drytime - t()) or 0, len(self.b),
-                        [x[0] for x in self.b],))
+                        (self.drytime - t()) or 0, len(self),))
 
         # If we filled the playout buffer then come back and consider refilling it
         # after it has an open slot big enough to hold the next packet.  (If we
         # didn't just fill it then when the next packet comes in from the network
         # self.write() will invoke self._consider_playing_out_sample().)
-        if self.b and self.b[0][0] == (self.s + 1):
+        if self.runend > self.head:
             # Come back and consider playing out again after we've played out an
             # amount of audio equal to the next packet.
-            self._schedule_next_check(len(self.b[0][1]) / float(16000) + EPSILON)
+            self._schedule_next_check(len(self._get(self.head)) /
+                                      float(BYTES_PER_SECOND) + EPSILON)
 
 
     def _switch_to_refill_mode(self):
@@ -169,47 +268,220 @@ class Playout:
 
     def _consider_switching_to_play_mode(self):
         # If we have enough sequential packets ready, then we'll make them be the
-        # current packets and switch to play mode.
-        for i in range(len(self.b) - 1):
-            if is_run(self.b, i, JITTER_BUFFER_SECONDS):
-                self.b = self.b[i:]
-                self.s = self.b[0][0] - 1 # prime it for the next packet
-                self.refillmode = False
-                self._consider_playing_out_sample()
-                return
+        # current packets and switch to play mode. The run at the head is
+        # preferred, but if there's a hole in it, the run of packets ending at
+        # the newest one will do.
+        if self.runbytes >= self._jitterbytes:
+            pass
+        elif self.tailbytes >= self._jitterbytes:
+            self._skip_to(self.tailstart)
+        else:
+            return
+        self.s = (self.head - 1) & 0xffff # prime it for the next packet
+        self.refillmode = False
+        if not self.pullmode:
+            self._consider_playing_out_sample()
+
+    def read(self, nbytes):
+        """ Pull mode: the audio device wants nbytes more audio to play.
+            Returns up to that much - less, or nothing, if the jitter buffer
+            runs out (in which case we're back in refill mode).
+        """
+        if self.refillmode:
+            return ''
+        out = []
+        if self._partial:
+            out.append(self._partial[:nbytes])
+            self._partial = self._partial[nbytes:]
+            nbytes -= len(out[0])
+        while nbytes > 0:
+            if self.runend == self.head:
+                # Underrun
+                self._switch_to_refill_mode()
+                if self.refillmode:
+                    break
+                continue
+            seq = self.head & 0xffff
+            bytes = self._drop_head()
+            self.s = seq
+            if len(bytes) > nbytes:
+                bytes, self._partial = bytes[:nbytes], bytes[nbytes:]
+            out.append(bytes)
+            nbytes -= len(bytes)
+        return ''.join(out)
 
-    def write(self, bytes, seq, t=time.time):
+    def write(self, bytes, seq, ts=None, marker=0, t=time.time):
         assert isinstance(bytes, basestring)
 
         if not bytes:
             return 0
 
-        i = bisect(self.b, (seq, bytes,))
-        if i > 0 and self.b[i-1][0] == seq:
-            log.msg("xxx duplicate packet %s" % seq)
-            return
+        if self.head is None:
+            self._reset(seq)
+        ext = self.head + seqdiff(seq, self.head & 0xffff)
+        if ext < self.head:
+            if not self.consumed and ext > self.newest - RING_SIZE:
+                # Nothing's been played from before this packet, so just
+                # start the buffer earlier.
+                self.head = self.runend = ext
+                self.runbytes = 0
+            else:
+                log.msg("xxx late packet %s" % seq)
+                return
+        elif ext >= self.head + RING_SIZE:
+            # A huge jump forward - the other end must have restarted.
+            log.msg("xxx sequence jumped to %s, flushing" % seq)
+            self._reset(ext)
+            self.refillmode = True
 
-        self.b.insert(i, (seq, bytes,))
+        i = ext & RING_MASK
+        slot = self.ring[i]
+        if slot is not None:
+            if slot[0] == ext:
+                log.msg("xxx duplicate packet %s" % seq)
+                return
+            # Stale packet from a lap of the ring ago - drop it
+        self.ring[i] = (ext, bytes,)
+
+        # Update the runs
+        if ext == self.runend:
+            self._extend_run()
+        if ext > self.newest:
+            if ext != self.newest + 1 or self._get(self.newest) is None:
+                self.tailstart, self.tailbytes = ext, 0
+            self.newest = ext
+            self.tailbytes += len(bytes)
+        elif ext == self.newest:
+            self.tailstart, self.tailbytes = ext, len(bytes)
+        elif ext == self.tailstart - 1:
+            self._extend_tail_backwards()
 
         if DEBUG:
-            log.msg("xxxxx %0.3f added  %s, playbuflen ~= %0.3f, jitterbuf: %d:%s"
+            log.msg("xxxxx %0.3f added  %s, playbuflen ~= %0.3f, jitterbuf: %d"
                 % (t() - self.st, seq, self.drytime and (self.drytime - t()) or 0,
-                len(self.b), [x[0] for x in self.b],))
+                len(self),))
         if self.refillmode:
             self._consider_switching_to_play_mode()
         else:
-            self._consider_playing_out_sample(newsampseqno=seq)
-            if (self.b and (self.b[0][0] == self.s + 1) and
-                        is_run(self.b, 0, CATCHUP_TRIGGER_SECONDS)):
-                (seq, bytes,) = self.b.pop(0) # catch up
+            if not self.pullmode:
+                self._consider_playing_out_sample(newsampseqno=ext)
+            if self.runend > self.head and self.runbytes >= self._catchupbytes:
+                seq = self.head & 0xffff
+                self._drop_head() # catch up
                 log.msg("xxxxxxx catchup! dropping %s" % seq)
-                self.s = self.b[0][0] - 1 # prime it for the next packet
+                self.s = (self.head - 1) & 0xffff # prime it for the next packet
+
+# Adaptive playout. The sizes here are in seconds of audio.
+# Never buffer less than this
+ADAPTIVE_MIN_SECONDS = 0.04
+# ... or more than the fixed-size buffer would
+ADAPTIVE_MAX_SECONDS = JITTER_BUFFER_SECONDS
+# until we know better
+ADAPTIVE_INITIAL_SECONDS = 0.1
+# size the buffer so this fraction of packets arrive in time
+ADAPTIVE_PERCENTILE = 0.95
+# estimate the delay percentile over this many packets
+ADAPTIVE_WINDOW = 250
+# all our codecs have an 8KHz RTP clock
+RTP_CLOCK = 8000
+
+class JitterEstimator:
+    """ Keeps the RFC 3550 interarrival jitter estimate (section 6.4.1
+        and appendix A.8), and a window of recent transit times, from
+        which a playout delay that covers a given percentile of packets
+        can be calculated.
+    """
+    def __init__(self, clock=RTP_CLOCK, window=ADAPTIVE_WINDOW):
+        self.clock = clock
+        self.window = window
+        self.jitter = 0.0
+        self.transit = None
+        self._transits = deque()
+
+    def update(self, ts, arrival):
+        "A packet with RTP timestamp ts arrived at time arrival (seconds)"
+        transit = int(arrival * self.clock) - ts
+        if self.transit is not None:
+            d = abs(transit - self.transit)
+            if d > 0x7fffffff:
+                # The RTP timestamp wrapped, or the sender restarted.
+                self._transits.clear()
+            else:
+                self.jitter += (d - self.jitter) / 16.0
+        self.transit = transit
+        self._transits.append(transit)
+        if len(self._transits) > self.window:
+            self._transits.popleft()
+
+    def getJitter(self):
+        "The interarrival jitter, in seconds"
+        return self.jitter / self.clock
+
+    def getDelay(self, percentile=ADAPTIVE_PERCENTILE):
+        """ How long (seconds) the packets in the window arrived after the
+            fastest one, for the given fraction of packets.
+        """
+        if not self._transits:
+            return None
+        transits = list(self._transits)
+        transits.sort()
+        i = int(round(percentile * (len(transits) - 1)))
+        return (transits[i] - transits[0]) / float(self.clock)
+
+class AdaptivePlayout(Playout):
+    """ A Playout whose jitter buffer is sized from the measured network
+        jitter, rather than always being JITTER_BUFFER_SECONDS.
+
+        The size is only changed at the start of a talkspurt (a packet with
+        the marker bit set, which the sender sets on the first packet after
+        silence), where changing the delay of the audio won't be heard. If
+        the buffer needs to grow, we go back to refill mode to let it fill;
+        if it needs to shrink, the catch-up logic drops the excess.
+    """
+    def __init__(self, medialayer):
+        Playout.__init__(self, medialayer)
+        self.estimator = JitterEstimator()
+        self._setTarget(ADAPTIVE_INITIAL_SECONDS)
+
+    def _setTarget(self, delay):
+        delay = min(max(delay, ADAPTIVE_MIN_SECONDS), ADAPTIVE_MAX_SECONDS)
+        self.target = delay
+        self._jitterbytes = delay * BYTES_PER_SECOND
+        # Catch up once we're more than a couple of packets over
+        self._catchupbytes = self._jitterbytes + max(self._jitterbytes,
+                                                     3 * 320)
+
+    def getTargetDelay(self):
+        "The current size of the jitter buffer, in seconds"
+        return self.target
+
+    def _adapt(self):
+        delay = self.estimator.getDelay()
+        if delay is None:
+            return
+        # plus one packet's worth, as the delay is measured from arrival
+        self._setTarget(delay + 0.02)
+        if DEBUG:
+            log.msg("adaptive playout: jitter %0.3fs, target %0.3fs"%(
+                            self.estimator.getJitter(), self.target))
+        if not self.refillmode and self.runbytes < self._jitterbytes:
+            self.refillmode = True
+            if self.nextcheckscheduled:
+                self.nextcheckscheduled.cancel()
+                self.nextcheckscheduled = None
+
+    def write(self, bytes, seq, ts=None, marker=0, t=time.time):
+        if ts is not None:
+            self.estimator.update(ts, t())
+        if marker and bytes:
+            self._adapt()
+        return Playout.write(self, bytes, seq, ts, marker, t)
 
 class NullPlayout:
     def __init__(self, medialayer):
         self.medialayer = medialayer
 
-    def write(self, bytes, seq, t=time.time):
+    def write(self, bytes, seq, ts=None, marker=0, t=time.time):
         self.medialayer._d.write(bytes)
 
 #Playout=NullPlayout
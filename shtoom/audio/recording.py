@@ -0,0 +1,177 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" Recordings of encoded audio.
+
+    Rather than decoding every received packet to 16 bit PCM and writing
+    that to disk, a recording can keep the payload just as it came off
+    the wire (a quarter of the size, for G.711, and less again for GSM),
+    and only decode it when it's played back or exported.
+
+    The file is:
+        MAGIC
+        frames: a header (timestamp, codec, length) then the payload.
+                The timestamp is in samples from the start of the
+                recording, so gaps (lost packets, silence suppression)
+                can be filled back in on playback.
+        index:  (timestamp, file offset) of a frame every INDEX_INTERVAL
+                samples, for seeking
+        trailer: the offset of the index, and MAGIC again
+    A recording that was never finished (no trailer) can still be read -
+    it just has no index.
+"""
+
+import struct
+from bisect import bisect_right
+
+from shtoom.rtp.formats import PT_PCMU, PT_PCMA, PT_GSM, PT_SPEEX, PT_RAW
+
+MAGIC = 'SHTMREC1'
+
+# Codecs we can record, by their id in the file. Only ever append to this.
+RECORD_CODECS = (PT_PCMU, PT_PCMA, PT_GSM, PT_SPEEX, PT_RAW)
+_codecIds = {}
+for _i, _ct in enumerate(RECORD_CODECS):
+    _codecIds[_ct] = _i
+del _i, _ct
+
+_frameHeader = struct.Struct('!IBH')
+_indexEntry = struct.Struct('!II')
+_trailer = struct.Struct('!I8s')
+
+# An index entry every second
+INDEX_INTERVAL = 8000
+# Don't fill in gaps of more than this many samples with silence
+MAX_GAP = 8000 * 60
+
+class RecordingWriter:
+    """ Formats frames into a recording. Each piece of the file is passed
+        to write(bytes), which should return False if it had to drop it
+        (it's then left out of the index).
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self.offset = 0
+        self.index = []
+        self.frames = 0
+        self._start = None
+        self._nextIndex = 0
+        self._emit(MAGIC)
+
+    def _emit(self, bytes, write=None):
+        if write is None:
+            write = self._write
+        if write(bytes) is False:
+            return False
+        self.offset += len(bytes)
+        return True
+
+    def addFrame(self, ct, ts, data):
+        """ Add a frame of payload data, in codec ct, with RTP timestamp
+            ts. Returns False if the codec can't be recorded.
+        """
+        codec = _codecIds.get(ct)
+        if codec is None or not data:
+            return False
+        if self._start is None:
+            self._start = ts
+        ts = (ts - self._start) & 0xffffffff
+        offset = self.offset
+        if self._emit(_frameHeader.pack(ts, codec, len(data)) + data):
+            self.frames += 1
+            if ts >= self._nextIndex and ts < 0x80000000:
+                self.index.append((ts, offset))
+                self._nextIndex = ts + INDEX_INTERVAL
+        return True
+
+    def finish(self, write=None):
+        "Write the index and trailer - through write, if it's given"
+        index = [ _indexEntry.pack(ts, offset) for (ts, offset) in self.index ]
+        self._emit(''.join(index) + _trailer.pack(self.offset, MAGIC), write)
+
+def _signed(n):
+    n &= 0xffffffff
+    if n >= 0x80000000:
+        n -= 0x100000000
+    return n
+
+class Recording:
+    "Reads a recording of encoded audio"
+
+    def __init__(self, fp):
+        if isinstance(fp, basestring):
+            fp = open(fp, 'rb')
+        self._fp = fp
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a recording")
+        self.index = []
+        fp.seek(0, 2)
+        size = fp.tell()
+        self._end = size
+        if size >= len(MAGIC) + _trailer.size:
+            fp.seek(size - _trailer.size)
+            indexOffset, magic = _trailer.unpack(fp.read(_trailer.size))
+            if magic == MAGIC and indexOffset < size:
+                self._end = indexOffset
+                fp.seek(indexOffset)
+                data = fp.read(size - _trailer.size - indexOffset)
+                for i in range(0, len(data), _indexEntry.size):
+                    self.index.append(_indexEntry.unpack_from(data, i))
+
+    def close(self):
+        self._fp.close()
+
+    def frames(self, start=0):
+        """ Yields (timestamp, codec, payload) for every frame, starting
+            at (or just before) start samples into the recording.
+        """
+        fp = self._fp
+        offset = len(MAGIC)
+        if start and self.index:
+            i = bisect_right(self.index, (start, 0xffffffff)) - 1
+            if i >= 0:
+                offset = self.index[i][1]
+        fp.seek(offset)
+        hsize = _frameHeader.size
+        while offset + hsize <= self._end:
+            ts, codec, length = _frameHeader.unpack(fp.read(hsize))
+            if offset + hsize + length > self._end:
+                # cut short - the recording was never finished
+                break
+            data = fp.read(length)
+            offset += hsize + length
+            yield ts, RECORD_CODECS[codec], data
+
+    def decode(self, start=0):
+        """ Yields the recording as chunks of 16 bit PCM. Gaps in the
+            timestamps are filled with silence.
+        """
+        from shtoom.audio.converters import CodecSet
+        codecs = CodecSet()
+        expected = None
+        try:
+            for ts, ct, data in self.frames(start):
+                audio = codecs.get(ct).decode(data)
+                if not audio:
+                    continue
+                if expected is not None:
+                    gap = _signed(ts - expected)
+                    if 0 < gap <= MAX_GAP:
+                        yield '\0' * (gap * 2)
+                expected = ts + len(audio) // 2
+                yield audio
+        finally:
+            codecs.release()
+
+    def export(self, fp):
+        "Write the recording to fp as 16 bit PCM"
+        for audio in self.decode():
+            fp.write(audio)
+
+def isRecording(path):
+    "Is the file at path a recording of encoded audio?"
+    fp = open(path, 'rb')
+    try:
+        return fp.read(len(MAGIC)) == MAGIC
+    finally:
+        fp.close()
@@ -18,6 +18,7 @@ class TCPAudioProtocol(Protocol):
     def dataReceived(self, data):
         if self.readbuffer is not None:
             self.readbuffer += data
+        self.factory.device.remoteAudio(len(data))
 
     def write(self, data):
         self.transport.write(data)
@@ -40,6 +41,9 @@ class TCPAudioFactory(Factory):
 
 
 class TCPAudioDevice(baseaudio.AudioDevice):
+    # The far end's sound card is the clock - it sends us its microphone
+    # audio as it's recorded, and we send back as much audio to play.
+    pull = True
 
     def __init__(self, port=SHTOOM_PORT):
         self.connection = None
@@ -60,6 +64,12 @@ class TCPAudioDevice(baseaudio.AudioDevice):
             return ''
         return self.connection.read(320)
 
+    def remoteAudio(self, nbytes):
+        "The far end has recorded (and so played) nbytes of audio"
+        out = self._pull_audio(nbytes)
+        if out:
+            self.write(out)
+
     def write(self, data):
 #        print 'write'
         if self.connection is None:
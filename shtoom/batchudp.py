@@ -0,0 +1,115 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" UDP ports that drain the socket in batches.
+
+    Each time the reactor says the socket is readable, BatchPort reads
+    every datagram that's waiting (up to a budget), and hands the lot to
+    the protocol's datagramsReceived(batch) in one go, where batch is a
+    list of (datagram, addr). Protocols without datagramsReceived get
+    datagramReceived() per datagram, as usual.
+
+    Socket buffer sizes (SO_RCVBUF/SO_SNDBUF) can be set per kind of
+    socket ('sip', 'rtp') - a big receive buffer on RTP sockets stops
+    packets being dropped when a tick of the media clock runs long.
+"""
+
+import socket
+
+from twisted.internet import reactor, udp
+from twisted.python import log
+from twisted.python.runtime import platformType
+
+if platformType == 'win32':
+    from errno import WSAEWOULDBLOCK as EWOULDBLOCK
+    from errno import WSAEINTR as EINTR
+    from errno import WSAECONNREFUSED as ECONNREFUSED
+    from errno import WSAECONNRESET
+    EAGAIN = EWOULDBLOCK
+else:
+    from errno import EWOULDBLOCK, EINTR, ECONNREFUSED, EAGAIN
+    WSAECONNRESET = None
+
+# Most datagrams read in one reactor wakeup
+DEFAULT_READ_BUDGET = 64
+
+# kind -> (rcvbuf, sndbuf). None means leave the OS default alone.
+_bufferSizes = { 'sip': (None, None),
+                 'rtp': (None, None),
+               }
+_readBudget = DEFAULT_READ_BUDGET
+
+class BatchPort(udp.Port):
+    "A UDP port that reads everything that's waiting on each wakeup"
+
+    readBudget = DEFAULT_READ_BUDGET
+    rcvbuf = sndbuf = None
+
+    def _bindSocket(self):
+        udp.Port._bindSocket(self)
+        if self.rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   self.rcvbuf)
+        if self.sndbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                   self.sndbuf)
+
+    def doRead(self):
+        "Called when my socket is ready for reading."
+        batch = []
+        recvfrom = self.socket.recvfrom
+        size = self.maxPacketSize
+        for i in xrange(self.readBudget):
+            try:
+                batch.append(recvfrom(size))
+            except socket.error, se:
+                no = se.args[0]
+                if no in (EAGAIN, EINTR, EWOULDBLOCK):
+                    break
+                if no in (ECONNREFUSED, WSAECONNRESET):
+                    if self._connectedAddr:
+                        self.protocol.connectionRefused()
+                else:
+                    raise
+        if not batch:
+            return
+        protocol = self.protocol
+        handler = getattr(protocol, 'datagramsReceived', None)
+        if handler is not None:
+            try:
+                handler(batch)
+            except:
+                log.deferr()
+        else:
+            for data, addr in batch:
+                try:
+                    protocol.datagramReceived(data, addr)
+                except:
+                    log.deferr()
+
+def setBufferSizes(kind, rcvbuf=None, sndbuf=None):
+    "Set the SO_RCVBUF/SO_SNDBUF used for new sockets of this kind"
+    _bufferSizes[kind] = (rcvbuf, sndbuf)
+
+def setReadBudget(budget):
+    "Set the most datagrams read from a socket in one wakeup"
+    global _readBudget
+    _readBudget = budget
+
+def configureFromPrefs(app):
+    "Pick up the udp_read_budget and {sip,rtp}_{rcv,snd}buf preferences"
+    budget = app.getPref('udp_read_budget')
+    if budget:
+        setReadBudget(budget)
+    for kind in _bufferSizes.keys():
+        setBufferSizes(kind, app.getPref('%s_rcvbuf'%kind),
+                             app.getPref('%s_sndbuf'%kind))
+
+def listenUDP(port, protocol, interface='', maxPacketSize=8192, kind=None):
+    """ Like reactor.listenUDP, but returns a BatchPort, with the socket
+        buffer sizes for kind.
+    """
+    p = BatchPort(port, protocol, interface, maxPacketSize, reactor)
+    p.readBudget = _readBudget
+    p.rcvbuf, p.sndbuf = _bufferSizes.get(kind, (None, None))
+    p.startListening()
+    return p
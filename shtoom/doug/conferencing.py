@@ -1,11 +1,18 @@
 "Conferencing code"
 
-# XXX A relatively simple enhancement to this would be to store the 
-# volumes for each source in the conference, and use an exponential
-# decay type algorithm to determine the "loudest". 
+import audioop
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from shtoom.doug.source import Source
-from twisted.internet.task import LoopingCall
+from shtoom.audio.clock import getMediaClock, PRIORITY_MIX
+from shtoom.audio.converters import Codecker, CodecSet
+from shtoom.audio import g711
+from shtoom.rtp.formats import PT_PCMU, PT_PCMA, PT_RAW
 from twisted.python import log
 from sets import Set
 
@@ -16,32 +23,98 @@ class ConferenceMemberNotFoundError(ConferenceError): pass
 CONFDEBUG = True
 CONFDEBUG = False
 
+# 20ms of 16 bit, 8KHz audio
+FRAME_BYTES = 320
+# Members' audio is queued as G.711, if that's what it arrived as, or
+# 16 bit audio (PT_RAW). A frame of each:
+FRAME_SIZES = { PT_PCMU: 160, PT_PCMA: 160, PT_RAW: FRAME_BYTES }
+# Frames a member can have waiting to go into the room
+MAX_PENDING_FRAMES = 3
+
+# Each member's level is smoothed: a fast attack, so a new speaker is
+# heard straight away, and a slow decay, so a speaker isn't dropped in
+# a pause, and a short burst of noise doesn't take over.
+ENERGY_ATTACK = 0.5
+ENERGY_DECAY = 0.05
+# Members quieter than this aren't mixed, or even decoded
+VAD_THRESHOLD = 200
+# A new speaker only displaces a current one if this much louder
+SWITCH_RATIO = 1.5
+
+def frameLevel(format, frame):
+    "The RMS level of a queued frame"
+    if format == PT_RAW:
+        return audioop.rms(frame, 2)
+    return g711.level(format, frame)
+
+def fitFrame(bytes, size=FRAME_BYTES):
+    "Pad bytes out with silence, or cut it short, to be size bytes long"
+    if len(bytes) < size:
+        return bytes + '\0' * (size - len(bytes))
+    return bytes[:size]
+
+if numpy is not None:
+    def _mix(frames):
+        wide = numpy.fromstring(''.join(frames), numpy.int16)
+        wide = wide.astype(numpy.int32).reshape(len(frames), -1)
+        total = wide.sum(axis=0)
+        # Every speaker's mix in one go: the total, less their own audio
+        others = numpy.clip(total - wide, -32768, 32767).astype(numpy.int16)
+        total = numpy.clip(total, -32768, 32767).astype(numpy.int16)
+        return total.tostring(), [ o.tostring() for o in others ]
+else:
+    def _mix(frames):
+        # Widen each sample to 32 bits, scaled down just enough that
+        # adding up all the frames can't saturate. Every step is exact,
+        # so it's the same as summing at full width.
+        headroom = 1
+        while headroom < len(frames):
+            headroom *= 2
+        scale = 1.0 / headroom
+        wide = [ audioop.mul(audioop.lin2lin(f, 2, 4), 4, scale)
+                                                        for f in frames ]
+        total = reduce(lambda x, y: audioop.add(x, y, 4), wide)
+        def narrow(w):
+            # mul saturates, so this is where the clipping happens
+            return audioop.lin2lin(audioop.mul(w, 4, headroom), 4, 2)
+        others = [ narrow(audioop.add(total, audioop.mul(w, 4, -1), 4))
+                                                        for w in wide ]
+        return narrow(total), others
+
+def mixMinusOne(frames, size=FRAME_BYTES):
+    """ Mix a list of frames of 16 bit audio. Returns (total, others),
+        where total is all the frames added together, and others[i] is
+        everything but frames[i] - what the speaker of frames[i] hears.
+        The frames are summed once, at 32 bits, and each result is
+        clipped to 16 bits at the end. Frames are padded with silence or
+        cut short to size bytes.
+    """
+    if not frames:
+        return '', []
+    frames = [ fitFrame(f, size) for f in frames ]
+    if len(frames) == 1:
+        return frames[0], ['']
+    return _mix(frames)
+
 class ConfSource(Source):
     "A ConfSource connects a voiceapp, and via that, a leg, to a room"
 
-    def __init__(self, room, leg):
-        self._user = leg.getDialog().getRemoteTag().getURI()
+    # G.711 is only decoded if we're one of the speakers
+    wantsEncoded = True
+
+    def __init__(self, room, leg, user=None):
+        if user is None:
+            user = leg.getDialog().getRemoteTag().getURI()
+        self._user = user
         self._room = room
-        self._room.addMember(self)
         self._quiet = False
-        self.makeBuffer()
+        self._pending = ''
+        self._pendingFormat = PT_RAW
+        self._codecs = None
+        self.energy = 0.0
+        self._room.addMember(self)
         super(ConfSource, self).__init__()
 
-    def makeBuffer(self):
-        try: 
-            from collections import deque
-        except ImportError:
-            # not optimal, but the queue isn't large
-            self.deque = list()
-            self.popleft = lambda: self.deque.pop(0)
-        else:
-            self.deque = deque()
-            self.popleft = self.deque.popleft
-
-    def truncBuffer(self):
-        while len(self.deque) > 3:
-            self.popleft()
-
     def isPlaying(self):
         return True
 
@@ -53,30 +126,85 @@ class ConfSource(Source):
             ret = self._room.readAudio(self)
         except ConferenceClosedError:
             return self.app._va_sourceDone(self)
-        if not ret:
+        self._heard(ret)
+        return ret
+
+    def readShared(self, format):
+        # Everyone listening gets the same mix - the room encodes it once
+        sample = self._room.readEncoded(self, format)
+        if sample is not None:
+            self._heard(sample)
+        return sample
+
+    def _heard(self, audio):
+        if not audio:
             if not self._quiet:
                 log.msg("%r is now receiving silence"%(self))
                 self._quiet = True
         elif self._quiet:
             log.msg("%r has stopped receiving silence"%(self))
             self._quiet = False
-        return ret
 
     def close(self):
-        self._room.removeMember(self)
+        if self._codecs is not None:
+            self._codecs.release()
+            self._codecs = None
+        if self._room.isMember(self):
+            self._room.removeMember(self)
 
     def write(self, bytes):
-        self.deque.append(bytes)
-        self.truncBuffer()
+        self._queue(PT_RAW, bytes)
+
+    def writeEncoded(self, packet):
+        ct = packet.header.ct
+        if ct in (PT_PCMU, PT_PCMA):
+            self._queue(ct, packet.data)
+            return
+        # Other codecs keep state between frames, so every frame has to
+        # be decoded, whether or not it's mixed.
+        if self._codecs is None:
+            self._codecs = CodecSet()
+        codec = self._codecs.get(ct)
+        if codec is None or not packet.data:
+            # comfort noise, or something we can't decode
+            return
+        audio = codec.decode(packet.data)
+        if audio:
+            self._queue(PT_RAW, audio)
+
+    def _queue(self, format, bytes):
+        # Packets needn't be a frame long - the room takes a frame at a
+        # time. Keep at most MAX_PENDING_FRAMES, dropping the oldest.
+        if format != self._pendingFormat:
+            self._pending = ''
+            self._pendingFormat = format
+        pending = self._pending + bytes
+        limit = FRAME_SIZES[format] * MAX_PENDING_FRAMES
+        if len(pending) > limit:
+            pending = pending[-limit:]
+        self._pending = pending
         if not self._room.isOpen():
             self.app._va_sourceDone(self)
-
-    def getAudioForRoom(self):
-        "get audio into the room"
-        # XXX tofix - might not have enough data (short packets). rock on.
-        if len(self.deque):
-            bytes = self.popleft()
-            return bytes
+        else:
+            self._room.memberActive(self)
+
+    def getFrameForRoom(self):
+        """ Take (up to) a frame of audio for the room. Returns (format,
+            frame), where format is PT_RAW, PT_PCMU or PT_PCMA, or None.
+        """
+        if self._pending:
+            size = FRAME_SIZES[self._pendingFormat]
+            frame = self._pending[:size]
+            self._pending = self._pending[size:]
+            return self._pendingFormat, frame
+
+    def updateEnergy(self, level):
+        "Fold this frame's level into our smoothed level, and return it"
+        if level > self.energy:
+            self.energy += (level - self.energy) * ENERGY_ATTACK
+        else:
+            self.energy += (level - self.energy) * ENERGY_DECAY
+        return self.energy
 
     def __repr__(self):
         return "<ConferenceUser %s in room %s at %x>"%(self._user,
@@ -89,23 +217,31 @@ class Room:
     """
 
     # Theory of operation. Rather than rely on the individual sources
-    # timer loops (which would be, well, horrid), we trigger off our
-    # own timer.
+    # timer loops (which would be, well, horrid), we mix once per tick
+    # of the media clock, before any of the legs read their audio.
     # This means we don't have to worry about the end systems not
-    # contributing during a window.
+    # contributing during a window. Only members that have sent audio
+    # recently are looked at each tick, so a big room that's mostly
+    # quiet costs little more than a small one.
     _open = False
 
-    def __init__(self, name, MaxSpeakers=4):
+    def __init__(self, name, MaxSpeakers=4, VADThreshold=VAD_THRESHOLD):
         self._name = name
         self._members = Set()
+        # Members who've sent audio, and aren't quiet yet
+        self._live = Set()
+        self._speakers = Set()
+        self._vadThreshold = VADThreshold
         self._audioOut = {}
         self._audioOutDefault = ''
+        # The default mix, encoded, by format - redone every tick
+        self._encodedOut = {}
+        self._encoders = {}
         self._maxSpeakers = MaxSpeakers
         self.start()
 
     def start(self):
-        self._audioCalcLoop = LoopingCall(self.mixAudio)
-        self._audioCalcLoop.start(0.020)
+        getMediaClock().add(self.mixAudio, PRIORITY_MIX)
         self._open = True
 
     def getName(self):
@@ -120,13 +256,16 @@ class Room:
                                             len(self._members))
 
     def shutdown(self):
-        if hasattr(self._audioCalcLoop, 'cancel'):
-            self._audioCalcLoop.cancel()
-        else:
-            self._audioCalcLoop.stop()
+        getMediaClock().remove(self.mixAudio)
         # XXX close down any running sources!
         self._members = Set()
+        self._live = Set()
+        self._speakers = Set()
         del self._audioOut
+        self._encodedOut = {}
+        for encoder in self._encoders.values():
+            encoder.close()
+        self._encoders = {}
         self._open = False
         removeRoom(self._name)
 
@@ -140,6 +279,8 @@ class Room:
     def removeMember(self, confsource):
         if len(self._members) and confsource in self._members:
             self._members.remove(confsource)
+            self._live.discard(confsource)
+            self._speakers.discard(confsource)
             if CONFDEBUG:
                 print "removed", confsource, "from", self
         else:
@@ -149,6 +290,11 @@ class Room:
                 print "No members left, shutting down"
             self.shutdown()
 
+    def memberActive(self, confsource):
+        "confsource has queued audio for the room"
+        if confsource in self._members:
+            self._live.add(confsource)
+
     def isMember(self, confsource):
         return confsource in self._members
 
@@ -164,83 +310,98 @@ class Room:
         else:
             raise ConferenceClosedError()
 
+    def readEncoded(self, confsource, format):
+        """ Returns this tick's mix for a member who's listening, not
+            speaking, as a MediaSample encoded in format. It's encoded once
+            per format, for every listener. Returns None for speakers (who
+            each hear their own mix), for silence, or if the codec keeps
+            state between frames - each leg must encode those itself.
+        """
+        if (not self._open or not self._audioOutDefault or
+                confsource in self._audioOut):
+            return None
+        if format in self._encodedOut:
+            return self._encodedOut[format]
+        encoder = self._encoders.get(format)
+        if encoder is None:
+            encoder = self._encoders[format] = Codecker(format)
+        if encoder.isShared():
+            sample = encoder.handle_audio(self._audioOutDefault)
+        else:
+            sample = None
+        self._encodedOut[format] = sample
+        return sample
+
     def mixAudio(self):
-        # XXX see the comment above about storing a decaying number for the
-        # volume. For instance, each time round the loop, take the calculated
-        # volume, and the stored volume, and do something like:
-        # newStoredVolume = (oldStoredVolume * 0.33) + (thisPacketVolume * 0.66)
-        import audioop
         self._audioOut = {}
+        self._encodedOut = {}
         if not self._open:
             log.msg('mixing closed room %r'%(self,), system='doug')
             return
-        audioIn = {}
-        for m in self._members:
-            bytes = m.getAudioForRoom()
-            if bytes: audioIn[m] = bytes
+        frames = {}
+        active = []
+        for m in list(self._live):
+            frame = m.getFrameForRoom()
+            if frame is None:
+                level = 0
+            else:
+                frames[m] = frame
+                level = frameLevel(*frame)
+            energy = m.updateEnergy(level)
+            if energy >= self._vadThreshold:
+                active.append((energy, m))
+            elif frame is None and energy < 1:
+                # Gone quiet - we'll hear about it if they start again
+                self._live.discard(m)
         if CONFDEBUG:
             print "room %r has %d members"%(self, len(self._members))
-            print "got %d samples this time"%len(audioIn)
-            print "samples: %r"%(audioIn.items(),)
+            print "got %d samples this time, %d active"%(len(frames),
+                                                           len(active))
         # short-circuit this case
         if len(self._members) < 2:
             if CONFDEBUG:
                 print "less than 2 members, no sound"
             self._audioOutDefault = ''
             return
-        # Samples is (confsource, audio)
-        samples = audioIn.items()
-        # power is three-tuples of (rms,audio,confsource)
-        power = [ (audioop.rms(x[1],2),x[1], x[0]) for x in samples ]
-        power.sort(); power.reverse()
+        speakers = self._chooseSpeakers(active)
         if CONFDEBUG:
-            for rms,audio,confsource in power:
-                print confsource, rms
-        # Speakers is a list of the _maxSpeakers loudest speakers
-        speakers = Set([x[2] for x in power[:self._maxSpeakers]])
-        # First we calculate the 'default' audio. Used for everyone who's
-        # not a speaker in the room.
-        samples = [ x[1] for x in power[:self._maxSpeakers] ]
-        scaledsamples = [ audioop.mul(x, 2, 1.0/len(samples)) for x in samples ]
-        if scaledsamples:
-            # ooo. a use of reduce. first time for everything...
-            try:
-                combined = reduce(lambda x,y: audioop.add(x, y, 2), scaledsamples)
-            except audioop.error, exc:
-                # XXX tofix!
-                print "combine got error %s"%(exc,)
-                print "lengths", [len(x) for x in scaledsamples]
-                combined = ''
-        else:
-            combined = ''
-        self._audioOutDefault = combined
-        # Now calculate output for each speaker.
-        allsamples = {}
-        for p,sample,speaker in power:
-            allsamples[speaker] = p, sample
-        for s in speakers:
-            # For each speaker, take the set of (other speakers), grab
-            # the top N speakers, and combine them. Add to the _audioOut
-            # dictionary
-            all = allsamples.copy()
-            del all[s]
-            power = all.values()
-            power.sort() ; power.reverse()
-            samples = [ x[1] for x in power[:self._maxSpeakers] ]
-            if samples:
-                scaled = [ audioop.mul(x, 2, 1.0/len(samples)) for x in samples]
-                try:
-                    out = reduce(lambda x,y: audioop.add(x, y, 2), scaled)
-                except audioop.error, exc:
-                    # XXX tofix!
-                    print "combine got error %s"%(exc,)
-                    print "lengths", [len(x) for x in scaled]
-                    out = ''
+            for m in speakers:
+                print m, m.energy
+        # Only the speakers' frames are decoded. Everyone who's not a
+        # speaker hears all of the speakers. Each speaker hears all of
+        # the others.
+        mixed = [ m for m in speakers if m in frames ]
+        audio = [ g711.transcode(frames[m][0], PT_RAW, frames[m][1])
+                                                        for m in mixed ]
+        total, others = mixMinusOne(audio)
+        self._audioOutDefault = total
+        for speaker, out in zip(mixed, others):
+            self._audioOut[speaker] = out
+
+    def _chooseSpeakers(self, active):
+        """ Pick up to MaxSpeakers speakers from active, a list of (energy,
+            member). The current speakers keep their place while they're
+            active, unless someone else is SWITCH_RATIO times louder than
+            the quietest of them.
+        """
+        n = self._maxSpeakers
+        speakers, others = [], []
+        for x in active:
+            if x[1] in self._speakers:
+                speakers.append(x)
             else:
-                out = ''
-            if CONFDEBUG:
-                print "calc for", s, "is", audioop.rms(out, 2)
-            self._audioOut[s] = out
+                others.append(x)
+        speakers.sort()
+        for x in heapq.nlargest(n, others):
+            if len(speakers) < n:
+                speakers.append(x)
+            elif speakers and x[0] > speakers[0][0] * SWITCH_RATIO:
+                speakers[0] = x
+            else:
+                break
+            speakers.sort()
+        self._speakers = Set([ m for (energy, m) in speakers ])
+        return self._speakers
 
 _RegisterOfAllRooms = {}
 
@@ -251,10 +412,14 @@ def removeRoom(roomname):
     if roomname in _RegisterOfAllRooms and roomname not in _StickyRoomNames:
         del _RegisterOfAllRooms[roomname]
 
-def newConferenceMember(roomname, leg):
+def newConferenceMember(roomname, leg, user=None):
     global _RegisterOfAllRooms
 
+    if getattr(leg, 'media', None) is not None:
+        # The leg's audio is in a media process - the room is there, too
+        from shtoom.doug.mediaserver import RemoteConfMember
+        return RemoteConfMember(roomname, leg)
     if not roomname in _RegisterOfAllRooms:
         _RegisterOfAllRooms[roomname] = Room(roomname)
     room = _RegisterOfAllRooms[roomname]
-    return ConfSource(room, leg)
+    return ConfSource(room, leg, user)
@@ -1,20 +1,15 @@
 """
-    DTMF generation and detection code. This replaces the old nasty
-    code with something a bit nicer (but a bit slower, too :-(
+    DTMF generation and detection code.
 """
 
 # DTMF tones (aka "the beeps when you hit a keypad consist of a pair
 # of sine waves. The table of the sine waves is:
 
-#             1209   1336   1477   1633    scaled
-#         697   1      2      3      A     27.88
-#         770   4      5      6      B     30.8
-#         852   7      8      9      C     34.08
-#         941   *      0      #      D     37.64
-# scaled      48.36  53.44  59.08  65.32
-
-# 'scaled' is the number divided by 25 - since we're examining
-# 40ms of audio at a time (1/25th of a second).
+#             1209   1336   1477   1633
+#         697   1      2      3      A
+#         770   4      5      6      B
+#         852   7      8      9      C
+#         941   *      0      #      D
 
 HZ = 8000.0
 SAMPLETIME = 0.040
@@ -43,21 +38,84 @@ def getSineWave(freq, samplecount=320):
         generated at 8khz. The first 'samplecount' samples will be
         returned.
     """
-    from numarray import sin, arange
-    from math import pi
-    sine = sin(arange(HZ)/(HZ/freq) * 2.0 * pi)
-    sine = sine[:samplecount]
-    return sine
+    from math import sin, pi
+    w = 2.0 * pi * freq / HZ
+    return [ sin(w * n) for n in range(samplecount) ]
+
+
+# The detector looks at WINDOW samples (40ms) at a time. Rather than an
+# FFT of the whole window, it measures just the eight DTMF frequencies -
+# what a Goertzel filter gives you. Each is the window's correlation with
+# a sine and a cosine at that frequency; audioop.findfactor does those in
+# C, or, with NumPy, a single matrix multiply does a whole batch of
+# windows at once.
+WINDOW = 320
+WINDOW_BYTES = WINDOW * 2
+
+rowFrequencies = (697, 770, 852, 941)
+colFrequencies = (1209, 1336, 1477, 1633)
+
+# The row and column tones together must be this much of the window's
+# energy - anything else (speech, mostly) and it's not a digit.
+TONE_ENERGY_RATIO = 0.7
+# Each of the two tones must be this many times stronger than the other
+# frequencies in its group
+GROUP_PEAK_RATIO = 4.0
+# The column tone may be up to 8dB stronger than the row ("normal
+# twist"), or 4dB weaker ("reverse twist")
+NORMAL_TWIST = 10 ** (8/10.0)
+REVERSE_TWIST = 10 ** (4/10.0)
+# Quieter than this (mean power per sample, about -45dBm0) is silence
+MIN_POWER = 8000.0
+
+import audioop, math, struct
+
+from twisted.python import log
 
+from shtoom.audio.clock import getMediaClock, PRIORITY_ENCODE
+
+REFERENCE_AMPLITUDE = 16384
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _reference(freq, fn):
+    """ fn (sin or cos) at freq, for a window, as 16 bit audio. Returns
+        the audio, and what audioop.findfactor(x, audio) - that's
+        sum(x * audio) / sum(audio * audio) - must be multiplied by to get
+        sum(x * fn(w * n)).
+    """
+    w = 2.0 * math.pi * freq / HZ
+    samples = [ int(round(REFERENCE_AMPLITUDE * fn(w * n)))
+                                                for n in range(WINDOW) ]
+    energy = 0.0
+    for s in samples:
+        energy += s * s
+    return (struct.pack('%dh'%WINDOW, *samples),
+            energy / REFERENCE_AMPLITUDE)
 
 class DtmfDetector:
     "This class detects DTMF tones from an audio stream."
+
     def __init__(self):
-        # Store away pre-calculated FFTs for each of the eight frequencies.
-        self.freqmatch = {}
         self.dtmf = freq2dtmf
-        for val in frequencies:
-            self.freqmatch[int(val/SCALING)+1] = val
+        self.frequencies = rowFrequencies + colFrequencies
+        # (reference, multiplier) for each frequency's cos and sin
+        self._refs = []
+        for f in self.frequencies:
+            self._refs.append((_reference(f, math.cos),
+                               _reference(f, math.sin)))
+        if numpy is not None:
+            # WINDOW x 16: the cos and sin of each frequency, as columns
+            basis = []
+            for f in self.frequencies:
+                w = 2.0 * math.pi * f / HZ
+                n = numpy.arange(WINDOW)
+                basis.append(numpy.cos(w * n))
+                basis.append(numpy.sin(w * n))
+            self._basis = numpy.array(basis).transpose()
 
     def detect(self, sample):
         """ Test for DTMF in a sample. Returns either a string with the
@@ -66,82 +124,124 @@ class DtmfDetector:
             samples (host endianness). This is _two_ samples at normal
             shtoom sampling rates.
         """
-        import numarray
-        from sets import Set
-        a = numarray.fromstring(sample, numarray.Int16)
-        if len(a) != 320:
-            raise ValueError("samples length %d != 320 (40ms)"%len(a))
-        peaks = self.getpeaks(a)
-        matched = Set()
-        for p in peaks:
-            m = self.freqmatch.get(p)
-            if m is None:
-                if p-1 in self.freqmatch:
-                    m = self.freqmatch.get(p-1)
-                elif p+1 in self.freqmatch:
-                    m = self.freqmatch.get(p+1)
-            matched.add(m)
-        # If we got a None, that means there was a significant component
-        # that wasn't a DTMF frequency.
-        if None in matched:
+        if len(sample) != WINDOW_BYTES:
+            raise ValueError("samples length %d != 320 (40ms)"%(
+                                                        len(sample)//2))
+        total = float(audioop.rms(sample, 2)) ** 2
+        if total < MIN_POWER:
             return ''
-        else:
-            m = list(matched)
-            m.sort()
-            return self.dtmf.get(tuple(m), '')
-
-    def getpeaks(self, sample):
-        from numarray import nonzero
-        from numarray.fft import real_fft
-        fft = abs(real_fft(sample))
-        # We compare each point to the point on either side - we must be
-        # greater than both.
-        # To do this, we left-shift and right-shift the array by one to
-        # compare.
-        peaks = nonzero((fft[1:-1] > fft[:-2]) * (fft[1:-1] > fft[2:]))
-        if not len(peaks) or not len(peaks[0]):
-            return ()
-        # Avoiding 'zip; sort; reverse' will give a big speedup.
-        try:
-            peakvals = zip(fft[1:-1].take(peaks)[0], peaks[0])
-        except:
-            print "pppp", peaks
-            raise
-        peakvals.sort(); peakvals.reverse()
-        if len(peakvals) > 2:
-            (val1,ind1),(val2,ind2),(val3,ind3) = peakvals[:3]
-            # Peak 3 should be no more than 2/3 the size of peak 2
-            # For GSM/Speex mangled audio, peak3 is about 0.55 * peak2
-            # at the worst case.
-            if val2 > 1.5*val3:
-                # Add one to the index because we took [1:-1] before
-                return (ind2+1,ind1+1)
+        energies = []
+        for (cos, cosM), (sin, sinM) in self._refs:
+            re = audioop.findfactor(sample, cos) * cosM
+            im = audioop.findfactor(sample, sin) * sinM
+            energies.append(re * re + im * im)
+        return self.classify(energies, total)
+
+    def detectMany(self, samples):
+        """ Like detect, for a list of samples - windows from many calls,
+            say. Returns a list of digits (or empty strings). With NumPy,
+            all of them are measured in one go.
+        """
+        if numpy is None or not samples:
+            return [ self.detect(s) for s in samples ]
+        for s in samples:
+            if len(s) != WINDOW_BYTES:
+                raise ValueError("samples length %d != 320 (40ms)"%(
+                                                            len(s)//2))
+        a = numpy.fromstring(''.join(samples), numpy.int16)
+        a = a.reshape(len(samples), WINDOW).astype(numpy.float64)
+        totals = (a * a).sum(axis=1) / WINDOW
+        parts = numpy.dot(a, self._basis)
+        parts = parts * parts
+        energies = parts[:, 0::2] + parts[:, 1::2]
+        out = []
+        for i in range(len(samples)):
+            if totals[i] < MIN_POWER:
+                out.append('')
             else:
-                return ()
-        elif len(peakvals) == 2:
-            (val2,ind2),(val1,ind1) = peakvals
-            # Add one to the index because we took [1:-1] before
-            return (ind2+1,ind1+1)
-        else:
-            (val1,ind1), = peakvals
-            return (ind1,0)
+                out.append(self.classify(energies[i].tolist(), totals[i]))
+        return out
 
-def dtmfGenerator(key, duration=160):
-    import struct
-    f = dtmf2freq.get(key)
-    if not f:
-        raise ValueError('dtmf key %s not recognised!'%(key))
-    f1, f2 = f
-    s1 = getSineWave(f1, duration)
-    s2 = getSineWave(f2, duration)
-    # combine them and make louder
-    s = [ (2**13)*(s1[x]+s2[x]) for x in range(duration) ]
-    # turn into a string
-    s = struct.pack('%dh'%duration, *s)
-    return s
+    def classify(self, energies, total):
+        """ Given the energy at each of the eight frequencies (as
+            |sum(x * e^-jwn)|^2), and the mean power of the window,
+            return the digit, or ''.
+        """
+        # For a pure tone of amplitude A, the energy at its frequency is
+        # (A*WINDOW/2)^2, and its mean power A^2/2 - scale to match.
+        scale = 2.0 / (WINDOW * WINDOW)
+        rows, cols = energies[:4], energies[4:]
+        row = max(rows)
+        col = max(cols)
+        if (row + col) * scale < TONE_ENERGY_RATIO * total:
+            return ''
+        if col > row * NORMAL_TWIST or row > col * REVERSE_TWIST:
+            return ''
+        for group, peak in (rows, row), (cols, col):
+            if sorted(group)[-2] * GROUP_PEAK_RATIO > peak:
+                return ''
+        f = (rowFrequencies[rows.index(row)], colFrequencies[cols.index(col)])
+        return self.dtmf.get(f, '')
+
+class DtmfBatch:
+    """ Windows to be checked for DTMF, from every call, at the end of
+        this media clock tick. With NumPy, they're all measured in one go
+        (see DtmfDetector.detectMany).
+    """
 
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.detector = DtmfDetector()
+        # [ (window, callback), ... ]
+        self._jobs = []
+        self._idle = 0
 
+    def add(self, window, callback):
+        "Check window for DTMF; callback(digit) is called later"
+        self._jobs.append((window, callback))
+        if self.clock is None:
+            self.clock = getMediaClock()
+        if not self.clock.isMember(self.run):
+            self.clock.add(self.run, PRIORITY_ENCODE)
+        self._idle = 0
 
+    def pending(self):
+        return len(self._jobs)
+
+    def run(self):
+        "Check everything that's been queued. Called from the media clock"
+        jobs, self._jobs = self._jobs, []
+        if not jobs:
+            # Stay on the clock while calls keep queueing work every tick
+            self._idle += 1
+            if self._idle > 1 and self.clock is not None:
+                self.clock.remove(self.run)
+            return
+        digits = self.detector.detectMany([ x[0] for x in jobs ])
+        for (window, callback), digit in zip(jobs, digits):
+            try:
+                callback(digit)
+            except:
+                log.err()
+
+_batch = None
+
+def getDtmfBatch():
+    "The DtmfBatch for the process' media clock"
+    global _batch
+    if _batch is None:
+        _batch = DtmfBatch()
+    return _batch
+
+def dtmfGenerator(key, duration=160):
+    """ Returns duration samples of the tone for key, as 16 bit audio.
+        The tones come from the ToneBank, so they're only made once.
+    """
+    from shtoom.doug.tones import getToneBank, FRAME_SAMPLES
+    if key not in dtmf2freq:
+        raise ValueError('dtmf key %s not recognised!'%(key))
+    frames = (duration + FRAME_SAMPLES - 1) // FRAME_SAMPLES
+    return ''.join(getToneBank().getPCM(key, frames))[:duration * 2]
 
 
 def test():
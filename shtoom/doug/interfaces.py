@@ -24,11 +24,15 @@ class IVoiceApp:
             any open files will be handed back closed
         """
 
-    def mediaRecord(self, destination):
+    def mediaRecord(self, destination, encoded=False):
         """ Record audio to a destination. 'destination' is either a
             filename or an open file-like object - the latter should
             support 'write()' and 'close()'
 
+            If encoded is set, a file is written with the audio as it
+            was received, not decoded (see shtoom.audio.recording).
+            Playing it with mediaPlay decodes it.
+
             Calling this when we're already recording is an error,
             call mediaStop first
 
@@ -9,11 +9,14 @@
 """
 
 from shtoom.doug.source import Source, SilenceSource, convertToSource
-from shtoom.audio.converters import DougConverter
+from shtoom.audio.converters import DougConverter, CodecSet
 from shtoom.doug.events import CallAnsweredEvent, CallRejectedEvent
 from shtoom.doug.events import MediaPlayContentDoneEvent, DTMFReceivedEvent
+from shtoom.audio.clock import getMediaClock
+from shtoom.doug.promptcache import getPromptCache
+from shtoom.doug import dtmf
+from shtoom.doug.dtmf import DtmfDetector, getDtmfBatch, WINDOW_BYTES
 from twisted.python import log
-from twisted.internet.task import LoopingCall
 
 class Leg(object):
 
@@ -21,6 +24,10 @@ class Leg(object):
     _cookie = None
     _acceptDeferred = None
     _voiceapp = None
+    clock = None
+    # The MediaClient for the media process that has our audio, if it's
+    # not here (see shtoom.doug.mediaserver)
+    media = None
 
     def __init__(self, cookie, dialog, voiceapp=None):
         """ Create a new leg
@@ -43,21 +50,45 @@ class Leg(object):
 
     def _startAudio(self):
         #print self, "starting audio"
-        self.LC = LoopingCall(self._get_some_audio)
-        self.LC.start(0.020)
+        self.clock = getMediaClock()
+        self.clock.add(self._get_some_audio)
 
     def _stopAudio(self):
-        if self.LC is not None:
-            #print self, "stopping audio", self.LC, self.LC.call
-            self.LC.stop()
-            self.LC = None
+        if self.clock is not None:
+            #print self, "stopping audio"
+            self.clock.remove(self._get_some_audio)
+            self.clock = None
 
     def _get_some_audio(self):
         if self._voiceapp is not None:
-            data = self.__connected.read()
-            sample = self.__converter.convertOutbound(data)
+            source = self.__connected
+            if source.passthrough:
+                return
+            format = self.__converter.format
+            if source.encoded is not None and source.encoded == format:
+                self._sendSample(source.readEncoded())
+                return
+            sample = source.readShared(format)
+            if sample is not None:
+                self._sendSample(sample)
+            else:
+                data = source.read()
+                self.__converter.convertOutboundBatched(data,
+                                                        self._sendSample)
+
+    def _sendSample(self, sample):
+        if self._voiceapp is not None:
             self._voiceapp.va_outgoingRTP(sample, self._cookie)
 
+    def _relayPacket(self, packet):
+        "Send packet, received on another leg, without re-encoding it"
+        if self._voiceapp is not None:
+            self._voiceapp.va_relayRTP(packet, self._cookie)
+
+    def getFormat(self):
+        "The format we're sending audio in"
+        return self.__converter.format
+
     def getDialog(self):
         return self._dialog
 
@@ -123,12 +154,14 @@ class Leg(object):
 
     def hangupCall(self):
         self._stopAudio()
+        self.__converter.close()
         if self._voiceapp:
             self._voiceapp.va_hangupCall(self._cookie)
 
-    def sendDTMF(self, digits, duration=0.1, delay=0.05):
+    def sendDTMF(self, digits, duration=0.1, delay=0.05, inband=None):
         self._voiceapp.sendDTMF(digits, cookie=self._cookie,
-                                duration=duration, delay=delay)
+                                duration=duration, delay=delay,
+                                inband=inband)
 
     def _playNextItem(self):
         if not self.__playoutList:
@@ -136,6 +169,11 @@ class Leg(object):
             self._voiceapp._triggerEvent(MediaPlayContentDoneEvent(last, self))
         else:
             next = self.__playoutList.pop(0)
+            if isinstance(next, basestring):
+                cache = getPromptCache()
+                if cache.maxBytes:
+                    format = self.__converter.format
+                    next = cache.getSource(next, format)
             next = convertToSource(next, 'r')
             self._connectSource(next)
 
@@ -150,6 +188,10 @@ class Leg(object):
             old.leg = None
         return old
 
+    def _sinkDone(self, sink):
+        if self.__sink is sink:
+            self._connectSink(None)
+
     def _connectSink(self, target):
         if target:
             target.leg = self
@@ -169,9 +211,10 @@ class Leg(object):
         self.__playoutList.extend(playlist)
         self._maybeStartPlaying()
 
-    def mediaRecord(self, dest):
-        dest = convertToSource(dest, 'w')
+    def mediaRecord(self, dest, encoded=False):
+        dest = convertToSource(dest, 'w', encoded)
         self._connectSink(dest)
+        return dest
 
     def mediaStop(self):
         old = self._connectSource(self.__silenceSource)
@@ -182,7 +225,7 @@ class Leg(object):
     def mediaStopRecording(self):
         old = self._connectSink(None)
         if old and old.isRecording():
-            old.close()
+            return old.close()
 
     def leg_startDTMFevent(self, dtmf):
         c = self.__currentDTMFKey
@@ -216,11 +259,18 @@ class Leg(object):
         self.__converter.set_handler(handler)
 
     def leg_incomingRTP(self, packet):
+        sink = self.__sink
+        if sink and sink.wantsEncoded:
+            sink.writeEncoded(packet)
+            if self.__inbandDTMFdetector is None:
+                # No one needs the audio decoded
+                return
+            sink = None
         data = self.__converter.convertInbound(packet)
         if self.__inbandDTMFdetector is not None:
             self.__inbandDTMFdetector(data)
-        if self.__sink:
-            self.__sink.write(data)
+        if sink:
+            sink.write(data)
 
     def isPlaying(self):
         return self.__connected.isPlaying()
@@ -231,10 +281,12 @@ class Leg(object):
     def dtmfMode(self, single=False, inband=False, timeout=0):
         self.__dtmfSingleMode = single
         if inband:
-            if numarray is None:
-                raise RuntimeError, "need numarray to do inband DTMF"
+            if dtmf.numpy is not None:
+                batch = getDtmfBatch()
             else:
-                self.__inbandDTMFdetector = InbandDtmfDetector(self)
+                # Nothing to gain from waiting for the rest of the tick
+                batch = None
+            self.__inbandDTMFdetector = InbandDtmfDetector(self, batch)
         else:
             self.__inbandDTMFdetector = None
         # XXX handle timeout
@@ -244,16 +296,38 @@ class Leg(object):
 
 
 class BridgeSource(Source):
-    "A BridgeSource connects a leg to another leg via a bridge"
+    """ A BridgeSource connects a leg to another leg via a bridge. It's
+        both the leg's source and its sink: the audio the leg receives is
+        written to it and copied to the other leg, to be read and sent
+        from there.
+
+        If the packets the leg receives are in the codec the other leg
+        sends, none of that is done - each is sent straight on by the
+        other leg, payload and all, as soon as it arrives.
+    """
 
     # We want DTMF
     wantsDTMF = True
 
+    # We look at each packet, to see if it can be passed straight through
+    wantsEncoded = True
+
     def __init__(self, bridge):
         self.bridge = bridge
         self._readbuffer = ''
+        self.other = None
+        self._codecs = None
+        # Are the packets we're written being sent on as they are?
+        self._relaying = False
         super(BridgeSource, self).__init__()
 
+    def _isPassthrough(self):
+        # The other leg's packets are being sent on by our leg, so there's
+        # nothing for our leg to read
+        return self.other is not None and self.other._relaying
+
+    passthrough = property(_isPassthrough)
+
     def connect(self, other):
         self.other = other
 
@@ -275,9 +349,32 @@ class BridgeSource(Source):
         if self.other is not None:
             self.other.copyData(bytes)
 
+    def writeEncoded(self, packet):
+        other = self.other
+        if other is None or other.leg is None:
+            return
+        ct = packet.header.ct
+        if ct == other.leg.getFormat():
+            self._relaying = True
+            other.leg._relayPacket(packet)
+            return
+        # Different codecs: decode it, for the other leg to re-encode
+        if self._codecs is None:
+            self._codecs = CodecSet()
+        codec = self._codecs.get(ct)
+        if codec is None or not packet.data:
+            # comfort noise, or something we can't decode
+            return
+        self._relaying = False
+        other.copyData(codec.decode(packet.data))
+
     def close(self):
+        if self._codecs is not None:
+            self._codecs.release()
+            self._codecs = None
         if self.bridge is not None:
-            self.leg._sourceDone(self)
+            if self.leg is not None:
+                self.leg._sourceDone(self)
             self.bridge.closeBridge(self)
             self.bridge = None
             self.other.close()
@@ -288,6 +385,8 @@ class Bridge:
        the other. It creates two Source objects, that are connected to
        each leg"""
     def __init__(self, leg1, leg2):
+        # BridgeSource -> the leg it's connected to
+        self._legs = {}
         self.connectLegs(leg1, leg2)
 
     def connectLegs(self, l1, l2):
@@ -295,42 +394,54 @@ class Bridge:
         bs2 = BridgeSource(self)
         bs1.connect(bs2)
         bs2.connect(bs1)
-        l1._connectSource(bs1)
-        l2._connectSource(bs2)
+        for leg, bs in (l1, bs1), (l2, bs2):
+            leg._connectSource(bs)
+            leg._connectSink(bs)
+            self._legs[bs] = leg
 
     def closeBridge(self, bs):
-        # Nothing for now.
-        pass
-
-
-
-try:
-    import numarray
-except ImportError:
-    numarray = None
-
-if numarray is not None:
-    class InbandDtmfDetector:
-        def __init__(self, leg):
-            from shtoom.doug.dtmf import DtmfDetector
-            self.leg = leg
-            self.prev = None
-            self.D = DtmfDetector()
-            self.digit = ''
-        def __call__(self, samp):
-            if self.prev is None:
-                self.prev = samp
-                return
-            nd = self.D.detect(self.prev+samp)
-            if nd != self.digit:
-                if self.digit == '':
-                    self.digit = nd
-                    self.leg.leg_startDTMFevent(nd)
-                elif nd == '':
-                    old, self.digit = self.digit, nd
-                    self.leg.leg_stopDTMFevent(old)
-                else:
-                    old, self.digit = nd, self.digit
-                    self.leg.leg_stopDTMFevent(old)
-                    self.leg.leg_startDTMFevent(self.digit)
-            self.prev = samp
+        # The source has already been disconnected (it may be what's
+        # closing us), but the leg is probably still sending it audio.
+        leg = self._legs.pop(bs, None)
+        if leg is not None:
+            leg._sinkDone(bs)
+
+class InbandDtmfDetector:
+    """ Looks for DTMF in a leg's incoming audio. A 40ms window is checked
+        every 20ms, whatever size the packets are. With a batch, the
+        windows are checked at the end of the media tick, along with
+        every other call's.
+    """
+
+    def __init__(self, leg, batch=None):
+        self.leg = leg
+        self.batch = batch
+        self.D = DtmfDetector()
+        self.digit = ''
+        self._buf = ''
+
+    def __call__(self, samp):
+        if not samp:
+            return
+        buf = self._buf + samp
+        while len(buf) >= WINDOW_BYTES:
+            window = buf[:WINDOW_BYTES]
+            buf = buf[WINDOW_BYTES//2:]
+            if self.batch is None:
+                self.gotDigit(self.D.detect(window))
+            else:
+                self.batch.add(window, self.gotDigit)
+        self._buf = buf
+
+    def gotDigit(self, nd):
+        if nd != self.digit:
+            if self.digit == '':
+                self.digit = nd
+                self.leg.leg_startDTMFevent(nd)
+            elif nd == '':
+                old, self.digit = self.digit, nd
+                self.leg.leg_stopDTMFevent(old)
+            else:
+                old, self.digit = self.digit, nd
+                self.leg.leg_stopDTMFevent(old)
+                self.leg.leg_startDTMFevent(nd)
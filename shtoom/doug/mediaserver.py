@@ -0,0 +1,866 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" Running the media in a process of its own.
+
+    A DougApplication normally does everything in the one reactor: SIP,
+    the voiceapps' state machines, and every call's RTP, codecs, playout
+    and mixing. Anything slow on the signaling side - a burst of INVITEs,
+    a voiceapp callback that takes its time - holds up the media clock,
+    and every call's audio with it.
+
+    With the media_process preference set, DougApplication.boot forks a
+    media process before anything else is started. The media process
+    has the RTP sockets, and a Leg for each call, with everything a Leg
+    does - prompts, tones, recording, codecs, DTMF detection - along with
+    bridges, RTP relays and conference rooms, all driven by a media clock
+    that nothing else competes with. The signaling process keeps SIP and
+    the voiceapps. Its legs are RemoteLegs, and its RTPProtocols are
+    RemoteRTPs: the same interfaces, but each call on them becomes a
+    command to the media process, and the media process's events come
+    back to the voiceapps as a Leg's would.
+
+    The two processes talk over a socketpair made before the fork - there's
+    no listening socket for anything else to connect to - one command or
+    event per line, each word %-quoted:
+
+        <verb> <call cookie> <argument> ...
+
+    Commands, from the signaling process:
+
+        open cookie localip stun        create the call's RTP socket
+        sdp cookie sdp                  the call's negotiated SDP
+        start cookie host port          start sending to the far end
+        end cookie                      the call's over
+        hangup cookie                   the voiceapp's hung up: stop the
+                                        call's audio now, not at the end
+        play cookie file ...            queue prompts
+        tones cookie loop name frames ...   queue a ToneSource ('-' is
+                                        silence)
+        playsource cookie id            queue a source made earlier
+        stop cookie                     stop playing, and empty the queue
+        record cookie id encoded file   record the call to a file
+        conf cookie id room user        join a conference room
+        recordsource cookie id          send the call's audio to a source
+        close cookie id                 close a source
+        dtmfmode cookie single inband
+        startdtmf cookie digit          send an RFC 2833 event
+        stopdtmf cookie digit
+        bridge cookie other             join two calls' audio (a Bridge)
+        relay cookie other              relay two calls' RTP (an RTPRelay)
+
+    Events, from the media process:
+
+        opened cookie host port mux format
+                                        the RTP socket's ready, and the
+                                        call's leg sends in format (named
+                                        as in shtoom.rtp.formats)
+        failed cookie exception message
+        played cookie count             the queue's finished, after count
+                                        items - see RemoteLeg.isPlaying
+        digits cookie digits            DTMF heard in the call's audio
+        keydown cookie key              RFC 2833 events received
+        keyup cookie key
+        closed cookie id                a source is closed (and, for a
+                                        recording, on disk)
+        drop cookie                     the far end's gone
+        load name value ...             the media clock's stats, every
+                                        STATS_INTERVAL seconds
+
+    Only what can be named can be played or recorded: files, tones and
+    conference rooms. A voiceapp with Sources of its own (an EchoSource,
+    say) needs its media in the same process.
+
+    A thread with a reactor of its own would have been lighter than a
+    process, but Twisted has one reactor per process.
+"""
+
+import os, socket
+from urllib import quote, unquote
+
+from twisted.internet import defer, reactor, tcp
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from shtoom.doug.leg import Leg, Bridge
+from shtoom.doug.events import MediaPlayContentDoneEvent, DTMFReceivedEvent
+from shtoom.doug.source import Source, convertToSource
+from shtoom.doug.tones import ToneSource
+from shtoom.rtp import formats
+from shtoom.rtp.formats import PT_NTE
+
+# How often the media process reports its clock's stats
+STATS_INTERVAL = 1.0
+
+# The stats in a load event (see MediaClock.getStats)
+_intStats = ('ticks', 'overruns', 'late', 'members')
+_floatStats = ('lastTickTime', 'maxTickTime', 'maxLate')
+
+def packLine(verb, *args):
+    return ' '.join([verb] + [ quote(str(a), safe='') for a in args ])
+
+def unpackLine(line):
+    return [ unquote(w) for w in line.split(' ') ]
+
+def formatName(fmt):
+    "fmt's name in shtoom.rtp.formats, e.g. 'PT_PCMU'"
+    for name, value in vars(formats).items():
+        if value is fmt and name.startswith('PT_'):
+            return name
+    raise ValueError("%r isn't in shtoom.rtp.formats"%(fmt,))
+
+def formatFromName(name):
+    fmt = getattr(formats, name, None)
+    if not (name.startswith('PT_') and
+            isinstance(fmt, formats.AudioPTMarker)):
+        raise ValueError("no audio format %r"%(name,))
+    return fmt
+
+class MediaChannel(LineReceiver):
+    """ One end of the link between the signaling and media processes.
+        Each line received is passed to the method named for its verb,
+        with the prefix (cmd_ or event_).
+    """
+
+    delimiter = '\n'
+    prefix = None
+
+    def __init__(self):
+        # Lines sent before we're connected
+        self._unsent = []
+
+    def connectionMade(self):
+        unsent, self._unsent = self._unsent, []
+        for line in unsent:
+            self.sendLine(line)
+
+    def send(self, verb, *args):
+        line = packLine(verb, *args)
+        if self.transport is None:
+            self._unsent.append(line)
+        else:
+            self.sendLine(line)
+
+    def lineReceived(self, line):
+        words = unpackLine(line)
+        handler = getattr(self, self.prefix + words[0], None)
+        if handler is None:
+            log.msg("unknown media channel message %r"%(line,),
+                                                        system='media')
+            return
+        try:
+            handler(*words[1:])
+        except:
+            log.err()
+
+# The media process
+
+class MediaCall:
+    """ A call, in the media process: its RTPProtocol, and a Leg. To the
+        Leg, we're its voiceapp.
+    """
+
+    def __init__(self, server, cookie):
+        from shtoom.rtp.protocol import RTPProtocol
+        self.server = server
+        self.cookie = cookie
+        self.rtp = RTPProtocol(server, cookie)
+        self.leg = Leg(cookie, None, voiceapp=self)
+        # Sources the signaling process has named: id -> Source
+        self.sources = {}
+        # The named source the leg's audio goes to, if any
+        self.sink = None
+        # How many items have been queued to play
+        self.queued = 0
+        # Set when the signaling process hangs up
+        self.hungUp = False
+
+    def va_outgoingRTP(self, sample, cookie=None):
+        if self.rtp.sending:
+            self.rtp.handle_media_sample(sample)
+
+    def va_relayRTP(self, packet, cookie=None):
+        self.rtp.handle_relayed_packet(packet)
+
+    def va_hangupCall(self, cookie):
+        # The signaling process is already dropping the call, if it hung up
+        if not self.hungUp:
+            self.server.send('drop', self.cookie)
+
+    def hangup(self):
+        self.hungUp = True
+        self.leg.hangupCall()
+
+    def _triggerEvent(self, event):
+        if isinstance(event, MediaPlayContentDoneEvent):
+            self.server.send('played', self.cookie, self.queued)
+        elif isinstance(event, DTMFReceivedEvent):
+            self.server.send('digits', self.cookie, event.digits)
+
+    def play(self, items):
+        self.queued += len(items)
+        self.leg.mediaPlay(items)
+
+    def connectSink(self, source):
+        self.sink = source
+        self.leg._connectSink(source)
+
+    def closeSource(self, id):
+        source = self.sources.pop(id, None)
+        if source is None:
+            d = None
+        else:
+            if source is self.sink:
+                self.sink = None
+                self.leg._connectSink(None)
+            d = source.close()
+        if not isinstance(d, defer.Deferred):
+            d = defer.succeed(d)
+        d.addErrback(log.err)
+        d.addCallback(lambda x: self.server.send('closed', self.cookie, id))
+
+    def end(self):
+        rtp = self.rtp
+        if rtp.relay is not None:
+            log.msg("relay for call %s: %r"%(self.cookie,
+                                rtp.relay.getStats()), system='media')
+            rtp.relay.stop()
+        rtp.stopSendingAndReceiving()
+        leg = self.leg
+        leg._stopAudio()
+        for id in self.sources.keys():
+            self.closeSource(id)
+        leg.mediaStop()
+        leg.mediaStopRecording()
+
+class MediaServer(MediaChannel):
+    """ The media process's end of the link. It's also the app its calls'
+        RTPProtocols talk to.
+    """
+
+    prefix = 'cmd_'
+
+    def __init__(self, app):
+        MediaChannel.__init__(self)
+        self.app = app
+        self.calls = {}
+        self._reporter = None
+
+    def getPref(self, pref, default=None):
+        value = self.app.getPref(pref, default)
+        if pref == 'logfile' and value:
+            value = value + '.media'
+        return value
+
+    def startReporting(self):
+        self._reporter = LoopingCall(self.report)
+        self._reporter.start(STATS_INTERVAL, now=False)
+
+    def report(self):
+        from shtoom.audio.clock import getMediaClock
+        stats = getMediaClock().getStats()
+        args = []
+        for name in _intStats + _floatStats:
+            args.extend([name, stats[name]])
+        self.send('load', *args)
+
+    def connectionLost(self, reason):
+        log.msg("signaling process has gone, stopping", system='media')
+        for call in self.calls.values():
+            call.end()
+        self.calls = {}
+        if self._reporter is not None:
+            self._reporter.stop()
+            self._reporter = None
+        if reactor.running:
+            reactor.stop()
+
+    def _getCall(self, cookie):
+        call = self.calls.get(cookie)
+        if call is None:
+            log.msg("no media for call %s"%(cookie,), system='media')
+        return call
+
+    # What an RTPProtocol wants of its app
+
+    def selectDefaultFormat(self, cookie, sdp):
+        md = sdp.getMediaDescription('audio')
+        ptlist = [ x[1] for x in md.rtpmap.values() ]
+        self.calls[cookie].leg.selectDefaultFormat(ptlist)
+
+    def incomingRTP(self, cookie, packet):
+        from shtoom.app.doug import nteMap
+        call = self.calls.get(cookie)
+        if call is None:
+            return
+        if packet.header.ct is PT_NTE:
+            data = packet.data
+            key = nteMap[ord(data[0])]
+            if ord(data[1]) & 128:
+                self.send('keydown', cookie, key)
+            else:
+                self.send('keyup', cookie, key)
+            return
+        try:
+            call.leg.leg_incomingRTP(packet)
+        except IOError:
+            pass
+
+    def dropCall(self, cookie):
+        self.send('drop', cookie)
+
+    # Commands
+
+    def cmd_open(self, cookie, localip, stun):
+        call = self.calls[cookie] = MediaCall(self, cookie)
+        d = call.rtp.createRTPSocket(localip, stun == '1')
+        d.addCallbacks(self._opened, self._openFailed,
+                       errbackArgs=(cookie,))
+
+    def _opened(self, cookie):
+        call = self.calls.get(cookie)
+        if call is None:
+            return
+        host, port = call.rtp.getVisibleAddress()
+        self.send('opened', cookie, host, port, int(call.rtp.rtcpMux),
+                  formatName(call.leg.getFormat()))
+
+    def _openFailed(self, failure, cookie):
+        call = self.calls.pop(cookie, None)
+        if call is not None:
+            call.leg._stopAudio()
+        self.send('failed', cookie, failure.type.__name__,
+                  failure.getErrorMessage())
+
+    def cmd_sdp(self, cookie, text):
+        from shtoom.sdp import SDP
+        call = self._getCall(cookie)
+        if call is not None:
+            call.rtp.setSDP(SDP(text))
+
+    def cmd_start(self, cookie, host, port):
+        call = self._getCall(cookie)
+        if call is not None:
+            call.rtp.start((host, int(port)))
+
+    def cmd_end(self, cookie):
+        call = self.calls.pop(cookie, None)
+        if call is not None:
+            call.end()
+
+    def cmd_hangup(self, cookie):
+        call = self._getCall(cookie)
+        if call is not None:
+            call.hangup()
+
+    def cmd_play(self, cookie, *files):
+        call = self._getCall(cookie)
+        if call is not None:
+            call.play(list(files))
+
+    def cmd_tones(self, cookie, loop, *tones):
+        call = self._getCall(cookie)
+        if call is None:
+            return
+        sequence = []
+        for i in range(0, len(tones), 2):
+            name, frames = tones[i:i+2]
+            if name == '-':
+                name = None
+            if frames == '-':
+                frames = None
+            else:
+                frames = int(frames)
+            sequence.append((name, frames))
+        call.play([ToneSource(sequence, loop=(loop == '1'))])
+
+    def cmd_playsource(self, cookie, id):
+        call = self._getCall(cookie)
+        if call is not None and id in call.sources:
+            call.play([call.sources[id]])
+
+    def cmd_stop(self, cookie):
+        call = self._getCall(cookie)
+        if call is not None:
+            call.leg.mediaStop()
+
+    def cmd_record(self, cookie, id, encoded, file):
+        call = self._getCall(cookie)
+        if call is None:
+            return
+        source = convertToSource(file, 'w', encoded == '1')
+        call.sources[id] = source
+        call.connectSink(source)
+
+    def cmd_conf(self, cookie, id, room, user):
+        from shtoom.doug.conferencing import newConferenceMember
+        call = self._getCall(cookie)
+        if call is not None:
+            call.sources[id] = newConferenceMember(room, call.leg, user)
+
+    def cmd_recordsource(self, cookie, id):
+        call = self._getCall(cookie)
+        if call is not None and id in call.sources:
+            call.connectSink(call.sources[id])
+
+    def cmd_close(self, cookie, id):
+        call = self.calls.get(cookie)
+        if call is None:
+            # The call's ended, and closed it already
+            self.send('closed', cookie, id)
+        else:
+            call.closeSource(id)
+
+    def cmd_dtmfmode(self, cookie, single, inband):
+        call = self._getCall(cookie)
+        if call is not None:
+            call.leg.dtmfMode(single == '1', inband == '1')
+
+    def cmd_startdtmf(self, cookie, digit):
+        call = self._getCall(cookie)
+        if call is not None:
+            call.rtp.startDTMF(digit)
+
+    def cmd_stopdtmf(self, cookie, digit):
+        call = self._getCall(cookie)
+        if call is not None:
+            call.rtp.stopDTMF(digit)
+
+    def cmd_bridge(self, cookie, other):
+        call1, call2 = self._getCall(cookie), self._getCall(other)
+        if call1 is not None and call2 is not None:
+            Bridge(call1.leg, call2.leg)
+
+    def cmd_relay(self, cookie, other):
+        from shtoom.rtp.relay import RTPRelay
+        call1, call2 = self._getCall(cookie), self._getCall(other)
+        if call1 is not None and call2 is not None:
+            call1.leg._stopAudio()
+            call2.leg._stopAudio()
+            RTPRelay(call1.rtp, call2.rtp)
+
+# The signaling process
+
+class RemoteRTP:
+    """ Stands in for a call's RTPProtocol in the signaling process. The
+        socket is in the media process.
+    """
+
+    # Relays are in the media process, too
+    relay = None
+    rtcpMux = False
+
+    def __init__(self, media, cookie):
+        self.media = media
+        self.cookie = cookie
+        self.ptdict = {}
+        self._socketCompleteDef = None
+        self._extIP = self._extRTPPort = None
+
+    def createRTPSocket(self, locIP, needSTUN=False):
+        d = self._socketCompleteDef = defer.Deferred()
+        self.media.send('open', self.cookie, locIP, int(bool(needSTUN)))
+        return d
+
+    def _opened(self, host, port, mux):
+        self._extIP, self._extRTPPort = host, port
+        self.rtcpMux = mux
+        d, self._socketCompleteDef = self._socketCompleteDef, None
+        d.callback(self.cookie)
+
+    def _failed(self, exc):
+        d, self._socketCompleteDef = self._socketCompleteDef, None
+        d.errback(exc)
+
+    def getVisibleAddress(self):
+        return (self._extIP, self._extRTPPort)
+
+    def getSDP(self, othersdp=None):
+        from shtoom.rtp.formats import SDPGenerator
+        sdp = SDPGenerator().getSDP(self)
+        if othersdp:
+            sdp.intersect(othersdp)
+        self.setSDP(sdp)
+        return sdp
+
+    def setSDP(self, sdp):
+        from shtoom.rtp.protocol import sdpPTDict
+        self.ptdict = sdpPTDict(sdp)
+        self.media.send('sdp', self.cookie, sdp.show())
+
+    def start(self, dest):
+        self.media.send('start', self.cookie, dest[0], dest[1])
+
+    def stopSendingAndReceiving(self):
+        self.media.endCall(self.cookie)
+
+    def canSendNTE(self):
+        return PT_NTE in self.ptdict
+
+    def startDTMF(self, digit):
+        self.media.send('startdtmf', self.cookie, digit)
+
+    def stopDTMF(self, digit):
+        self.media.send('stopdtmf', self.cookie, digit)
+
+class RemoteSource(Source):
+    "A Source in the media process, named by an id"
+
+    def __init__(self, leg):
+        super(RemoteSource, self).__init__()
+        self.leg = leg
+        self.media = leg.media
+        self.id = self.media._addSource(self)
+        self._closing = False
+        self._closeWaiters = []
+
+    def isPlaying(self):
+        return False
+
+    def isRecording(self):
+        return not self._closing
+
+    def close(self):
+        """ Close the source in the media process. Returns a Deferred that
+            fires when that's done.
+        """
+        if not self._closing:
+            self._closing = True
+            self.media.send('close', self.leg.getCookie(), self.id)
+        if self._closeWaiters is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._closeWaiters.append(d)
+        return d
+
+    def _closed(self):
+        self._closing = True
+        waiters, self._closeWaiters = self._closeWaiters, None
+        for d in waiters:
+            d.callback(None)
+
+class RemoteRecording(RemoteSource):
+    "A recording to a file, made in the media process"
+
+    def __init__(self, leg, filename, encoded=False):
+        super(RemoteRecording, self).__init__(leg)
+        self.filename = filename
+        self.media.send('record', leg.getCookie(), self.id, int(encoded),
+                        filename)
+
+    def __repr__(self):
+        return '<RemoteRecording %s at %x>'%(self.filename, id(self))
+
+class RemoteConfMember(RemoteSource):
+    "A conference room member (see newConferenceMember) in the media process"
+
+    def __init__(self, roomname, leg):
+        super(RemoteConfMember, self).__init__(leg)
+        self.roomname = roomname
+        user = leg.getDialog().getRemoteTag().getURI()
+        self.media.send('conf', leg.getCookie(), self.id, roomname, user)
+
+    def isPlaying(self):
+        return not self._closing
+
+    def __repr__(self):
+        return '<RemoteConfMember in room %s at %x>'%(self.roomname,
+                                                      id(self))
+
+class RemoteLeg(Leg):
+    """ A Leg in the signaling process, when the media is in a media
+        process. There's no audio here: playing, recording, bridging and
+        DTMF are all commands to the media process, and its events come
+        back to the voiceapp as if from a Leg.
+    """
+
+    def __init__(self, cookie, dialog, voiceapp=None, media=None):
+        self._cookie = cookie
+        self._dialog = dialog
+        self._acceptDeferred = None
+        self._voiceapp = voiceapp
+        self.media = media
+        # How many items we've queued to play, and how many of them the
+        # media process has finished (or we've stopped)
+        self._queued = 0
+        self._played = 0
+        self._last = None
+        self._sink = None
+        # Kept from the media process, once the call's over
+        self._format = None
+        if cookie is not None:
+            media._addLeg(self)
+
+    def setCookie(self, cookie):
+        Leg.setCookie(self, cookie)
+        self.media._addLeg(self)
+
+    def _startAudio(self):
+        pass
+
+    def _stopAudio(self):
+        # The media process stops its leg when the call ends
+        pass
+
+    def getFormat(self):
+        "The format the media process's leg sends audio in"
+        if self._format is not None:
+            return self._format
+        fmt = self.media._formats.get(self._cookie)
+        if fmt is None:
+            raise ValueError("call %s has no format until the media process "
+                             "has opened its RTP"%(self._cookie,))
+        return fmt
+
+    def hangupCall(self):
+        # Otherwise, the media process's leg would keep sending until the
+        # far end answers the BYE
+        self.media.send('hangup', self._cookie)
+        if self._voiceapp:
+            self._voiceapp.va_hangupCall(self._cookie)
+
+    def selectDefaultFormat(self, ptlist):
+        # The media process's leg chooses, from the SDP it's sent
+        pass
+
+    def mediaPlay(self, playlist):
+        if isinstance(playlist, basestring):
+            playlist = [playlist]
+        for item in playlist:
+            if not (isinstance(item, (basestring, ToneSource)) or
+                    (isinstance(item, RemoteSource) and item.isPlaying())):
+                raise ValueError("can't play %r in the media process"%(item,))
+        cookie = self._cookie
+        files = []
+        for item in playlist:
+            if isinstance(item, basestring):
+                files.append(item)
+                continue
+            if files:
+                self.media.send('play', cookie, *files)
+                files = []
+            if isinstance(item, ToneSource):
+                args = []
+                for name, frames in item.sequence:
+                    if name is None:
+                        name = '-'
+                    if frames is None:
+                        frames = '-'
+                    args.extend([name, frames])
+                self.media.send('tones', cookie, int(item.loop), *args)
+            else:
+                self.media.send('playsource', cookie, item.id)
+        if files:
+            self.media.send('play', cookie, *files)
+        if playlist:
+            self._queued += len(playlist)
+            self._last = playlist[-1]
+
+    def _playedTo(self, count):
+        "The media process has played everything we queued, up to count"
+        if count == self._queued and self._played != count:
+            self._played = count
+            if self._voiceapp is not None:
+                self._voiceapp._triggerEvent(
+                            MediaPlayContentDoneEvent(self._last, self))
+
+    def isPlaying(self):
+        return self._played < self._queued
+
+    def mediaStop(self):
+        if self.isPlaying():
+            self._played = self._queued
+            self.media.send('stop', self._cookie)
+
+    def mediaRecord(self, dest, encoded=False):
+        if isinstance(dest, basestring):
+            dest = RemoteRecording(self, dest, encoded)
+        elif isinstance(dest, RemoteSource):
+            self.media.send('recordsource', self._cookie, dest.id)
+        else:
+            raise ValueError("can't record to %r in the media process"%(
+                                                                dest,))
+        self._sink = dest
+        return dest
+
+    def mediaStopRecording(self):
+        old, self._sink = self._sink, None
+        if old and old.isRecording():
+            return old.close()
+
+    def isRecording(self):
+        return self._sink is not None and self._sink.isRecording()
+
+    def dtmfMode(self, single=False, inband=False, timeout=0):
+        self.media.send('dtmfmode', self._cookie, int(bool(single)),
+                        int(bool(inband)))
+
+    def _gotDigits(self, digits):
+        if self._voiceapp is not None:
+            self._voiceapp._triggerEvent(DTMFReceivedEvent(digits, self))
+
+    def __repr__(self):
+        return '<RemoteLeg at %x connected to %r>'%(id(self), self._voiceapp)
+
+class MediaClient(MediaChannel):
+    "The signaling process's end of the link to the media process"
+
+    prefix = 'event_'
+
+    def __init__(self, app, pid=None):
+        MediaChannel.__init__(self)
+        self.app = app
+        self.pid = pid
+        # cookie -> RemoteRTP, RemoteLeg, and the format the media
+        # process's leg sends in
+        self._rtps = {}
+        self._legs = {}
+        self._formats = {}
+        # id -> RemoteSource
+        self._sources = {}
+        self._nextID = 0
+        # Until the media process reports
+        self._stats = {}
+        for name in _intStats:
+            self._stats[name] = 0
+        for name in _floatStats:
+            self._stats[name] = 0.0
+
+    def newRTP(self, cookie):
+        rtp = self._rtps[cookie] = RemoteRTP(self, cookie)
+        return rtp
+
+    def newLeg(self, cookie, dialog, voiceapp=None):
+        return RemoteLeg(cookie, dialog, voiceapp, media=self)
+
+    def _addLeg(self, leg):
+        self._legs[leg.getCookie()] = leg
+
+    def _addSource(self, source):
+        self._nextID += 1
+        id = str(self._nextID)
+        self._sources[id] = source
+        return id
+
+    def endCall(self, cookie):
+        self._rtps.pop(cookie, None)
+        leg = self._legs.pop(cookie, None)
+        fmt = self._formats.pop(cookie, None)
+        if leg is not None and fmt is not None:
+            leg._format = fmt
+        self.send('end', cookie)
+
+    def bridgeLegs(self, leg1, leg2):
+        self.send('bridge', leg1.getCookie(), leg2.getCookie())
+
+    def relayCalls(self, cookie1, cookie2):
+        self.send('relay', cookie1, cookie2)
+
+    def getStats(self):
+        "The media clock's stats, as last reported"
+        return self._stats.copy()
+
+    def connectionLost(self, reason):
+        log.msg("lost the media process: %s"%(reason.getErrorMessage()),
+                                                        system='media')
+        if reactor.running:
+            reactor.stop()
+
+    # Events
+
+    def event_opened(self, cookie, host, port, mux, format):
+        rtp = self._rtps.get(cookie)
+        if rtp is not None:
+            self._formats[cookie] = formatFromName(format)
+            rtp._opened(host, int(port), mux == '1')
+
+    def event_failed(self, cookie, kind, message):
+        import shtoom.exceptions
+        from shtoom.exceptions import CallFailed
+        rtp = self._rtps.pop(cookie, None)
+        if rtp is None:
+            return
+        exc = getattr(shtoom.exceptions, kind, None)
+        if not (isinstance(exc, type) and issubclass(exc, CallFailed)):
+            exc = CallFailed
+        rtp._failed(exc(message))
+
+    def event_played(self, cookie, count):
+        leg = self._legs.get(cookie)
+        if leg is not None:
+            leg._playedTo(int(count))
+
+    def event_digits(self, cookie, digits):
+        leg = self._legs.get(cookie)
+        if leg is not None:
+            leg._gotDigits(digits)
+
+    def event_keydown(self, cookie, key):
+        self.app.incomingDTMF(cookie, key, True)
+
+    def event_keyup(self, cookie, key):
+        self.app.incomingDTMF(cookie, key, False)
+
+    def event_closed(self, cookie, id):
+        source = self._sources.pop(id, None)
+        if source is not None:
+            source._closed()
+
+    def event_drop(self, cookie):
+        self.app.dropCall(cookie)
+
+    def event_load(self, *args):
+        stats = {}
+        for i in range(0, len(args), 2):
+            name, value = args[i:i+2]
+            if name in _intStats:
+                stats[name] = int(value)
+            elif name in _floatStats:
+                stats[name] = float(value)
+        self._stats = stats
+
+class _PairConnection(tcp.Connection):
+    "Our end of the socketpair to the other process"
+
+    def __init__(self, skt, protocol, name):
+        tcp.Connection.__init__(self, skt, protocol, reactor)
+        self.logstr = name
+        self.connected = 1
+        self.startReading()
+        protocol.makeConnection(self)
+
+def forkMediaProcess(app):
+    """ Fork the media process for app (a DougApplication). In the parent,
+        returns the MediaClient that talks to it. The child runs until the
+        parent goes away, then exits.
+    """
+    if not hasattr(os, 'fork'):
+        raise RuntimeError("a media process needs os.fork()")
+    # Connected before the fork, and to nothing else
+    parentEnd, childEnd = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        from shtoom.doug.supervisor import cleanForkedReactor
+        parentEnd.close()
+        cleanForkedReactor()
+        _runMediaProcess(MediaServer(app), childEnd)
+    childEnd.close()
+    client = MediaClient(app, pid)
+    _PairConnection(parentEnd, client, 'MediaClient')
+    return client
+
+def _runMediaProcess(server, skt):
+    "In the child: run the media until the signaling process goes"
+    status = 0
+    try:
+        _PairConnection(skt, server, 'MediaServer')
+        app = server.app
+        app.startLogging(server.getPref('logfile'))
+        app.configureMedia()
+        server.startReporting()
+        log.msg("media process started", system='media')
+        reactor.run()
+    except:
+        log.err()
+        status = 1
+    os._exit(status)
@@ -0,0 +1,231 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" A cache of pre-encoded prompts.
+
+    An IVR plays the same few announcements to every caller. Rather than
+    reading each file and encoding it afresh for every call, the frames
+    encoded for the first call to play a file all the way through are
+    kept here, keyed by (path, mtime, codec), for every later call to
+    stream straight into RTP. Nothing is encoded that the first call
+    wouldn't have encoded anyway, so filling the cache costs the media
+    clock no more than playing the file. The least recently used prompts
+    are dropped when the cache goes over its size; a prompt bigger than
+    the whole cache is just played from the file, every time.
+"""
+
+import os
+
+from twisted.python import log
+
+from shtoom.audio.converters import Codecker, CodecSet, MediaSample
+from shtoom.doug.source import Source, RecordedSource, convertToSource
+
+# Default size of the cache, in bytes of encoded audio
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+class EncodedSource(Source):
+    "An EncodedSource plays a list of already-encoded frames"
+
+    def __init__(self, frames, format):
+        super(EncodedSource, self).__init__()
+        self.encoded = format
+        self._frames = frames
+        self._pos = 0
+        self._codecs = None
+
+    def isPlaying(self):
+        return True
+
+    def isRecording(self):
+        return False
+
+    def close(self):
+        if self._codecs is not None:
+            self._codecs.release()
+            self._codecs = None
+
+    def readEncoded(self):
+        "Returns the next frame, as a MediaSample"
+        if self._pos >= len(self._frames):
+            self.leg._sourceDone(self)
+            return None
+        frame = self._frames[self._pos]
+        self._pos += 1
+        return MediaSample(self.encoded, frame)
+
+    def read(self):
+        # For anyone that wants audio, not frames
+        sample = self.readEncoded()
+        if sample is None:
+            return None
+        if self._codecs is None:
+            self._codecs = CodecSet()
+        return self._codecs.get(self.encoded).decode(sample.data)
+
+    def write(self, bytes):
+        pass
+
+class CachingSource(Source):
+    """ A CachingSource plays a prompt that isn't in the cache yet. Each
+        frame is encoded as it's played, and kept - if the prompt is
+        played to the end, the frames go in the cache.
+    """
+
+    def __init__(self, cache, key, source):
+        super(CachingSource, self).__init__()
+        self.encoded = key[2]
+        self._cache = cache
+        self._key = key
+        # The file's audio - it calls our _sourceDone when it runs out
+        self._source = source
+        source.leg = self
+        self._ended = False
+        self._codecker = Codecker(self.encoded)
+        self._frames = []
+        self._size = 0
+
+    def isPlaying(self):
+        return True
+
+    def isRecording(self):
+        return False
+
+    def _sourceDone(self, source):
+        self._ended = True
+
+    def readEncoded(self):
+        "Returns the next frame, as a MediaSample"
+        if self._source is None:
+            return None
+        audio = self._source.read()
+        if self._ended:
+            if self._frames is not None:
+                self._cache._add(self._key, self._frames, self._size)
+            self.close()
+            self.leg._sourceDone(self)
+            return None
+        sample = self._codecker.handle_audio(audio)
+        if sample is not None and self._frames is not None:
+            self._frames.append(sample.data)
+            self._size += len(sample.data)
+            if self._size > self._cache.maxBytes:
+                self._cache._add(self._key, None, self._size)
+                self._frames = None
+        return sample
+
+    def read(self):
+        # For anyone that wants audio, not frames - there's nothing to
+        # cache, then
+        self._frames = None
+        if self._source is None:
+            return ''
+        audio = self._source.read()
+        if self._ended:
+            self.close()
+            self.leg._sourceDone(self)
+            return None
+        return audio
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+            self._codecker.close()
+            self._frames = None
+
+    def write(self, bytes):
+        pass
+
+class PromptCache:
+    """ Encoded prompts, keyed by (path, mtime, format). Holds at most
+        maxBytes of encoded audio - a prompt bigger than that is played
+        from the file, rather than kept.
+    """
+
+    def __init__(self, maxBytes=DEFAULT_MAX_BYTES):
+        self.maxBytes = maxBytes
+        # key -> [frames, size, last used]
+        self._prompts = {}
+        self._bytes = 0
+        self._clock = 0
+        # keys of the prompts too big to keep
+        self._tooBig = {}
+        self.stats = { 'hits': 0, 'misses': 0, 'evictions': 0,
+                       'uncached': 0 }
+
+    def setMaxBytes(self, maxBytes):
+        self.maxBytes = maxBytes
+        self._tooBig = {}
+        self._evict()
+
+    def getSource(self, path, format):
+        """ Returns a Source that plays the file at path, encoded as
+            format - from the cache, if it's there. Recordings of encoded
+            audio aren't cached: they're decoded as they're played.
+        """
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime, format)
+        self._clock += 1
+        entry = self._prompts.get(key)
+        if entry is not None:
+            self.stats['hits'] += 1
+            entry[2] = self._clock
+            return EncodedSource(entry[0], format)
+        source = convertToSource(path, 'r')
+        if isinstance(source, RecordedSource):
+            return source
+        if key in self._tooBig:
+            self.stats['uncached'] += 1
+            return source
+        self.stats['misses'] += 1
+        return CachingSource(self, key, source)
+
+    def _add(self, key, frames, size):
+        "A CachingSource has encoded the whole of a prompt"
+        if size > self.maxBytes:
+            if key not in self._tooBig:
+                log.msg("prompt %s is too big to cache"%(key[0],),
+                                                        system='doug')
+                self._tooBig[key] = None
+            return
+        if key in self._prompts:
+            # Someone else got there first
+            return
+        self._prompts[key] = [frames, size, self._clock]
+        self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.maxBytes and self._prompts:
+            lru = None
+            for key, entry in self._prompts.items():
+                if lru is None or entry[2] < self._prompts[lru][2]:
+                    lru = key
+            log.msg("prompt cache full, dropping %s"%(lru[0],),
+                                                        system='doug')
+            self._bytes -= self._prompts[lru][1]
+            del self._prompts[lru]
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        self._prompts = {}
+        self._bytes = 0
+        self._tooBig = {}
+
+    def getStats(self):
+        """ Returns a dictionary with the cache's hits, misses, evictions,
+            plays of prompts too big to cache (uncached), and the number
+            of prompts and bytes held.
+        """
+        stats = self.stats.copy()
+        stats['prompts'] = len(self._prompts)
+        stats['bytes'] = self._bytes
+        return stats
+
+_cache = None
+
+def getPromptCache():
+    global _cache
+    if _cache is None:
+        _cache = PromptCache()
+    return _cache
@@ -4,14 +4,29 @@ class DougService:
     configFileName = ''
 
 
-    def __init__(self, voiceappClass):
+    def __init__(self, voiceappClass, workers=None):
         self.voiceappClass = voiceappClass
+        # How many worker processes to run - if None, it's the 'workers'
+        # preference. See shtoom.doug.supervisor
+        self.workers = workers
+        self.supervisor = None
 
     def startService(self, mainhack=False, args=None):
         from shtoom.app.doug import DougApplication
         self.app = DougApplication(self.voiceappClass)
         if self.configFileName != '':
             self.app.configFileName = self.configFileName
+        workers = self.workers
+        if workers is None:
+            self.app.initOptions(args=args)
+            workers = self.app.getPref('workers')
+        if workers:
+            from shtoom.doug.supervisor import DougSupervisor
+            self.supervisor = DougSupervisor(self.voiceappClass, workers,
+                                             self.configFileName, args,
+                                             mainhack)
+            self.supervisor.start()
+            return
         if mainhack:
             import __main__
             __main__.app = self.app
@@ -22,4 +37,7 @@ class DougService:
         self.app.start()
 
     def stopService(self):
-        self.app.shutdown()
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        else:
+            self.app.shutdown()
@@ -1,4 +1,9 @@
-import sys
+import sys, os, mmap, time
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from shtoom.audio.recording import RecordingWriter, Recording, isRecording
 
 class Source(object):
     "A Source object is a source and sink of audio data"
@@ -6,6 +11,18 @@ class Source(object):
     # Can this Source handle DMTF?
     wantsDTMF = False
 
+    # If the Source produces already-encoded frames (from readEncoded())
+    # rather than audio, the format they're in
+    encoded = None
+
+    # Does the Source want the leg's received packets, still encoded,
+    # passed to writeEncoded() rather than audio to write()?
+    wantsEncoded = False
+
+    # Does the Source send the leg's packets itself, as they arrive? If
+    # so, the leg has nothing to read from it on the media clock's ticks.
+    passthrough = False
+
     def __init__(self):
         self.leg = None
 
@@ -21,6 +38,13 @@ class Source(object):
     def read(self):
         return NotImplementedError
 
+    def readShared(self, format):
+        """ If this frame's audio is going to several legs, return it as
+            a MediaSample already encoded in format, so it's only encoded
+            the once. Otherwise None, and the leg read()s it as usual.
+        """
+        return None
+
     def close(self):
         return NotImplementedError
 
@@ -116,14 +140,326 @@ class FileSource(Source):
                 print "write failed %s: %r"%(e,v)
                 self.leg._sourceDone(self)
 
-def convertToSource(thing, mode='r'):
+# Write to disk in blocks of this many bytes (about a second of audio)
+RECORD_BLOCK_BYTES = 16000
+# Most audio to hold waiting for the disk (about a minute)
+RECORD_MAX_QUEUED_BYTES = 1000000
+
+class RecordingSource(Source):
+    """ A RecordingSource records to a file without ever writing to it
+        from the reactor thread. Audio is buffered in memory, and written
+        in blocks from the reactor's thread pool, one block at a time.
+
+        If the disk falls so far behind that more than maxQueued bytes
+        are waiting, new audio is thrown away (and counted in the stats)
+        until the queue drains - the reactor is never held up waiting
+        for the disk.
+    """
+
+    def __init__(self, fp, blockSize=RECORD_BLOCK_BYTES,
+                 maxQueued=RECORD_MAX_QUEUED_BYTES):
+        super(RecordingSource, self).__init__()
+        self._fp = fp
+        self.blockSize = blockSize
+        self.maxQueued = maxQueued
+        self.runInThread = threads.deferToThread
+        self._pending = []
+        self._pendingBytes = 0
+        # when the oldest pending audio arrived
+        self._pendingSince = None
+        self._writing = 0
+        self._closing = False
+        self._closed = False
+        self._closeWaiters = []
+        self._failed = False
+        self.stats = { 'written': 0, 'blocks': 0, 'dropped': 0,
+                       'maxQueued': 0, 'lastLag': 0.0, 'maxLag': 0.0 }
+
+    def isPlaying(self):
+        return False
+
+    def isRecording(self):
+        return not self._closing
+
+    def read(self):
+        return ''
+
+    def write(self, bytes):
+        self._queue(bytes)
+
+    def _queue(self, bytes, force=False, t=time.time):
+        """ Queue bytes to be written. Returns False if they were dropped.
+            If force is set, they're never dropped.
+        """
+        if self._closing or self._failed:
+            return False
+        if not bytes:
+            return True
+        queued = self._pendingBytes + self._writing
+        if queued + len(bytes) > self.maxQueued and not force:
+            self.stats['dropped'] += len(bytes)
+            return False
+        if self._pendingSince is None:
+            self._pendingSince = t()
+        self._pending.append(bytes)
+        self._pendingBytes += len(bytes)
+        if self._pendingBytes + self._writing > self.stats['maxQueued']:
+            self.stats['maxQueued'] = self._pendingBytes + self._writing
+        if self._pendingBytes >= self.blockSize:
+            self._flush()
+        return True
+
+    def _flush(self):
+        if self._writing or not self._pending:
+            return
+        data = ''.join(self._pending)
+        since = self._pendingSince
+        self._pending = []
+        self._pendingBytes = 0
+        self._pendingSince = None
+        self._writing = len(data)
+        d = self.runInThread(self._fp.write, data)
+        d.addCallbacks(self._written, self._writeFailed,
+                       callbackArgs=(since,))
+
+    def _written(self, result, since, t=time.time):
+        lag = t() - since
+        self.stats['lastLag'] = lag
+        if lag > self.stats['maxLag']:
+            self.stats['maxLag'] = lag
+        self.stats['written'] += self._writing
+        self.stats['blocks'] += 1
+        self._writing = 0
+        if self._closing:
+            if self._pending:
+                self._flush()
+            else:
+                self._closeFile()
+        elif self._pendingBytes >= self.blockSize:
+            self._flush()
+
+    def _writeFailed(self, failure):
+        log.err(failure)
+        self._failed = True
+        self._writing = 0
+        self._pending = []
+        self._pendingBytes = 0
+        if self.leg is not None:
+            self.leg._sourceDone(self)
+        if self._closing:
+            self._closeFile()
+
+    def _closeFile(self):
+        d = self.runInThread(self._fp.close)
+        d.addErrback(log.err)
+        d.addCallback(self._fileClosed)
+
+    def _fileClosed(self, result):
+        self._closed = True
+        waiters, self._closeWaiters = self._closeWaiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def whenClosed(self):
+        "Returns a Deferred that fires once the file's written and closed"
+        d = defer.Deferred()
+        if self._closed:
+            d.callback(None)
+        else:
+            self._closeWaiters.append(d)
+        return d
+
+    def close(self):
+        """ Write out whatever's left, then close the file. Returns a
+            Deferred that fires when that's done.
+        """
+        if self._closing:
+            return self.whenClosed()
+        self._closing = True
+        d = self.whenClosed()
+        if not self._writing:
+            if self._pending:
+                self._flush()
+            else:
+                self._closeFile()
+        return d
+
+    def getStats(self):
+        """ Returns a dictionary of bytes written and dropped, blocks
+            written, bytes queued now and at most, and the lag (seconds
+            from audio arriving to it being on disk) of the last block
+            and the worst one.
+        """
+        stats = self.stats.copy()
+        stats['queued'] = self._pendingBytes + self._writing
+        return stats
+
+class EncodedRecordingSource(RecordingSource):
+    """ An EncodedRecordingSource records the payload of the packets the
+        leg receives, still encoded, rather than decoded audio - see
+        shtoom.audio.recording. Frames dropped because the disk is behind
+        are dropped whole.
+    """
+
+    wantsEncoded = True
+
+    def __init__(self, fp, **kwargs):
+        super(EncodedRecordingSource, self).__init__(fp, **kwargs)
+        self._recording = RecordingWriter(self._queue)
+
+    def write(self, bytes):
+        # We only record the encoded audio
+        pass
+
+    def writeEncoded(self, packet):
+        "Record the payload of an RTPPacket"
+        if not self._closing:
+            self._recording.addFrame(packet.header.ct, packet.header.ts,
+                                     packet.data)
+
+    def close(self):
+        if not self._closing:
+            # The index mustn't be dropped, even if the disk is behind
+            self._recording.finish(lambda bytes: self._queue(bytes, True))
+        return super(EncodedRecordingSource, self).close()
+
+class RecordedSource(Source):
+    "A RecordedSource plays back a recording of encoded audio"
+
+    def __init__(self, path):
+        super(RecordedSource, self).__init__()
+        self._recording = Recording(path)
+        self._audio = self._recording.decode()
+        self._buffer = ''
+
+    def isPlaying(self):
+        return True
+
+    def isRecording(self):
+        return False
+
+    def close(self):
+        if self._recording is not None:
+            self._audio = None
+            self._recording.close()
+            self._recording = None
+
+    def read(self):
+        if self._recording is None:
+            return ''
+        while len(self._buffer) < 320:
+            try:
+                self._buffer += self._audio.next()
+            except StopIteration:
+                break
+        if not self._buffer:
+            self.close()
+            self.leg._sourceDone(self)
+            return None
+        bytes, self._buffer = self._buffer[:320], self._buffer[320:]
+        return bytes
+
+    def write(self, bytes):
+        pass
+
+class FileMapping:
+    "A read-only memory mapping of a file, shared by everyone playing it"
+
+    def __init__(self, path, key):
+        self.key = key
+        self.size = key[2]
+        fp = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(fp.fileno(), self.size,
+                                 access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        self.refs = 0
+
+# (path, mtime, size) -> FileMapping
+_mappings = {}
+
+def mapFile(path):
+    """ Returns the FileMapping for the file at path, mapping it if no one
+        else has. Call releaseMapping() when done with it.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    mapping = _mappings.get(key)
+    if mapping is None:
+        mapping = _mappings[key] = FileMapping(path, key)
+    mapping.refs += 1
+    return mapping
+
+def releaseMapping(mapping):
+    mapping.refs -= 1
+    if mapping.refs <= 0 and _mappings.get(mapping.key) is mapping:
+        del _mappings[mapping.key]
+        mapping.map.close()
+
+class MappedFileSource(Source):
+    """ A MappedFileSource plays a file through a memory mapping that's
+        shared with every other leg playing the same file. Each frame is
+        a string sliced from the mapping, so there's no read() call per
+        frame.
+
+        Leg.mediaPlay only plays a file with one of these when the
+        prompt cache is turned off (prompt_cache_size 0), or the file's
+        too big for the cache. Otherwise, the file's played from the
+        cache - and, the first time, encoded into it from one of these.
+    """
+
+    def __init__(self, path):
+        super(MappedFileSource, self).__init__()
+        self._mapping = mapFile(path)
+        self._map = self._mapping.map
+        self._size = self._mapping.size
+        self._pos = 0
+
+    def isPlaying(self):
+        return True
+
+    def isRecording(self):
+        return False
+
+    def close(self):
+        if self._mapping is not None:
+            releaseMapping(self._mapping)
+            self._mapping = None
+
+    def read(self):
+        if self._mapping is None:
+            return ''
+        pos = self._pos
+        if pos >= self._size:
+            self.close()
+            self.leg._sourceDone(self)
+            return None
+        self._pos = pos + 320
+        return self._map[pos:pos+320]
+
+    def write(self, bytes):
+        pass
+
+def convertToSource(thing, mode='r', encoded=False):
+    """ Returns a Source for thing - a Source, or a file name. If encoded
+        is set, a file opened for writing records the encoded audio.
+    """
     if isinstance(thing, Source):
         return thing
     elif isinstance(thing, basestring):
         if mode == 'r':
+            if os.path.exists(thing) and os.path.getsize(thing):
+                if isRecording(thing):
+                    return RecordedSource(thing)
+                return MappedFileSource(thing)
+            # can't map an empty file
             fp = open(thing, 'rb')
         elif mode == 'w':
-            fp = open(thing, 'wb')
+            if encoded:
+                return EncodedRecordingSource(open(thing, 'wb'))
+            return RecordingSource(open(thing, 'wb'))
         else:
             raise ValueError("mode must be r or w")
     else:
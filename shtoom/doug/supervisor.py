@@ -0,0 +1,539 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" Multi-process Doug.
+
+    A DougApplication runs in one reactor, so it can only use one core.
+    In supervisor mode (the 'workers' preference), DougService forks that
+    many worker processes, each a DougApplication with its own slice of
+    the RTP port range, and the parent process becomes a SIP dispatcher:
+
+      - The dispatcher owns the public SIP port. Each datagram that
+        arrives on it is passed to a worker, along with the address it
+        came from. Everything a worker sends goes out via the dispatcher,
+        from the public port, so the far end only ever sees the one
+        address.
+      - A new dialog goes to the worker picked by hashing its Call-ID, or
+        if that worker is overloaded, the next one along that isn't. The
+        dispatcher remembers which worker has each Call-ID, so the rest
+        of the dialog (ACK, BYE, re-INVITE) goes to the same worker.
+        Dialogs that a worker starts are learnt from the requests it
+        sends out.
+      - Each worker reports its call count and media clock load every
+        REPORT_INTERVAL seconds. A worker that stops reporting gets no
+        new calls.
+
+    The dispatcher and the workers talk over UDP on the loopback
+    interface. Each datagram starts with a line saying what it is:
+        "SIP <host> <port>" and a SIP message, from or to host:port
+        "LOAD <worker> <calls> <tickload> <overruns>", a worker's report
+
+    The workers are forked before the reactor starts, so they can run
+    voiceapps defined in a script's __main__. Each one closes the sockets
+    it inherits from the parent, and makes its own reactor waker, before
+    it starts up. A worker that dies isn't replaced - its calls are lost,
+    and new calls go to the others.
+"""
+
+import os, re, time, zlib
+
+from twisted.internet import reactor
+from twisted.internet.address import IPv4Address
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from shtoom.app.doug import DougApplication
+
+# Workers report their load this often (seconds)
+REPORT_INTERVAL = 1.0
+# A worker that hasn't reported for this long is presumed stuck
+HEALTH_TIMEOUT = 3 * REPORT_INTERVAL
+# A worker whose media clock ticks take this fraction of a frame or more
+# is overloaded
+OVERLOAD_TICKLOAD = 0.8
+# How long a finished dialog's Call-ID is remembered, for retransmissions
+# and the ACK - 64*T1, from RFC 3261
+TRANSACTION_TIMEOUT = 32.0
+
+def cleanForkedReactor():
+    """ Call in a child process, straight after the fork. The reactor
+        stops watching (and closes) the sockets inherited from the
+        parent, and gets a waker pipe of its own - a thread waking the
+        reactor in one process could otherwise wake the other instead.
+    """
+    for selectable in reactor.removeAll():
+        sock = getattr(selectable, 'socket', None)
+        if sock is not None:
+            sock.close()
+    waker = getattr(reactor, 'waker', None)
+    if waker is not None:
+        reactor.removeReader(waker)
+        waker.connectionLost(None)
+        reactor.waker = None
+        reactor.installWaker()
+
+_callIDre = re.compile(r'^(?:call-id|i)[ \t]*:[ \t]*(\S+)', re.I | re.M)
+_cseqRe = re.compile(r'^cseq[ \t]*:[ \t]*\d+[ \t]+(\w+)', re.I | re.M)
+_endOfHeaders = re.compile(r'\r?\n\r?\n')
+
+def packSIP(addr, message):
+    return 'SIP %s %d\n%s'%(addr[0], addr[1], message)
+
+def unpackFrame(frame):
+    "Returns (kind, [args], body)"
+    nl = frame.find('\n')
+    if nl == -1:
+        raise ValueError("bad frame %r"%(frame[:40],))
+    header = frame[:nl].split()
+    if not header:
+        raise ValueError("bad frame %r"%(frame[:40],))
+    return header[0], header[1:], frame[nl+1:]
+
+def parseSIP(message):
+    """ Pick out just what the dispatcher needs from a SIP message:
+        (method, code, Call-ID, CSeq method). method is None for a
+        response, code is None for a request.
+    """
+    m = _endOfHeaders.search(message)
+    if m is not None:
+        message = message[:m.start()]
+    first = message.split('\n', 1)[0].split()
+    method = code = None
+    if first and first[0].startswith('SIP/'):
+        try:
+            code = int(first[1])
+        except (IndexError, ValueError):
+            code = 0
+    elif first:
+        method = first[0].upper()
+    m = _callIDre.search(message)
+    callid = m and m.group(1)
+    m = _cseqRe.search(message)
+    cseq = m and m.group(1).upper()
+    return method, code, callid, cseq
+
+def splitPortRange(low, high, n):
+    """ Split the RTP port range low-high into n ranges, one per worker.
+        Each range starts on an even port, as RTP wants.
+    """
+    size = ((high - low) // n) & ~1
+    if size < 2:
+        raise ValueError("RTP port range %d-%d too small for %d workers"%(
+                                                            low, high, n))
+    if low % 2:
+        low += 1
+    return [ (low + i*size, low + (i+1)*size) for i in range(n) ]
+
+class WorkerInfo:
+    "What the supervisor knows about a worker"
+
+    def __init__(self, index, pid=None, maxCalls=None):
+        self.index = index
+        self.pid = pid
+        self.maxCalls = maxCalls
+        # The worker's loopback address - from its first report
+        self.addr = None
+        self.lastReport = None
+        self.dead = False
+        self.calls = 0
+        self.tickload = 0.0
+        self.overruns = 0
+
+    def gotReport(self, addr, calls, tickload, overruns, now):
+        self.addr = addr
+        self.lastReport = now
+        self.calls = calls
+        self.tickload = tickload
+        self.overruns = overruns
+
+    def isHealthy(self, now):
+        return (not self.dead and self.lastReport is not None and
+                now - self.lastReport < HEALTH_TIMEOUT)
+
+    def isOverloaded(self):
+        if self.maxCalls and self.calls >= self.maxCalls:
+            return True
+        return self.tickload >= OVERLOAD_TICKLOAD or self.overruns > 0
+
+    def load(self):
+        return (self.tickload, self.calls)
+
+    def __repr__(self):
+        return '<Worker %d pid %s, %d calls>'%(self.index, self.pid,
+                                                self.calls)
+
+class _WorkerSide(DatagramProtocol):
+    "The dispatcher's loopback socket, that the workers talk to"
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def datagramReceived(self, datagram, addr):
+        self.dispatcher.workerDatagramReceived(datagram, addr)
+
+class SipDispatcher(DatagramProtocol):
+    "Passes SIP between the public port and the workers, by Call-ID"
+
+    def __init__(self, workers, clock=time.time):
+        self.workers = workers
+        self.clock = clock
+        self.workerSide = _WorkerSide(self)
+        # worker's loopback address -> WorkerInfo
+        self._byAddr = {}
+        # Call-ID -> [worker, confirmed, expires]. expires is None until
+        # the dialog ends (or for INVITEs, fails).
+        self._dialogs = {}
+        self.stats = { 'in': 0, 'out': 0, 'rejected': 0, 'bad': 0 }
+
+    def dialogCount(self):
+        return len(self._dialogs)
+
+    def getWorkerFor(self, callid):
+        "The worker that has callid, or None"
+        d = self._dialogs.get(callid)
+        if d is not None:
+            return d[0]
+
+    def chooseWorker(self, callid):
+        """ The worker for a new Call-ID: the one it hashes to, or if
+            that's overloaded, the next that isn't - or if they all are,
+            the least loaded. None if there are no healthy workers.
+        """
+        n = len(self.workers)
+        now = self.clock()
+        start = (zlib.crc32(callid) & 0xffffffff) % n
+        best = None
+        for i in range(n):
+            w = self.workers[(start + i) % n]
+            if not w.isHealthy(now):
+                continue
+            if not w.isOverloaded():
+                return w
+            if best is None or w.load() < best.load():
+                best = w
+        return best
+
+    def _track(self, callid, worker, method):
+        d = [worker, False, None]
+        if method != 'INVITE':
+            # Not a dialog - just keep it for the transaction
+            d[2] = self.clock() + TRANSACTION_TIMEOUT
+        self._dialogs[callid] = d
+
+    def _sawResponse(self, callid, code, cseq):
+        d = self._dialogs.get(callid)
+        if d is None or code < 200:
+            return
+        if cseq == 'INVITE':
+            if code < 300:
+                d[1], d[2] = True, None
+            elif not d[1]:
+                # The call never got going
+                d[2] = self.clock() + TRANSACTION_TIMEOUT
+        elif cseq in ('BYE', 'CANCEL'):
+            d[2] = self.clock() + TRANSACTION_TIMEOUT
+
+    def datagramReceived(self, datagram, addr):
+        "A datagram from the outside world"
+        method, code, callid, cseq = parseSIP(datagram)
+        if not callid:
+            self.stats['bad'] += 1
+            return
+        worker = self.getWorkerFor(callid)
+        if worker is None or worker.dead:
+            worker = self.chooseWorker(callid)
+            if worker is None:
+                if method == 'INVITE':
+                    self._reject(datagram, addr)
+                else:
+                    self.stats['rejected'] += 1
+                return
+            if method is not None:
+                self._track(callid, worker, method)
+        if code is not None:
+            self._sawResponse(callid, code, cseq)
+        self.stats['in'] += 1
+        self.workerSide.transport.write(packSIP(addr, datagram), worker.addr)
+
+    def workerDatagramReceived(self, datagram, addr):
+        "A datagram from one of the workers"
+        try:
+            kind, args, body = unpackFrame(datagram)
+            if kind == 'SIP':
+                dest = (args[0], int(args[1]))
+            elif kind == 'LOAD':
+                self._gotReport(addr, int(args[0]), int(args[1]),
+                                float(args[2]), int(args[3]))
+                return
+            else:
+                raise ValueError(kind)
+        except (ValueError, IndexError):
+            self.stats['bad'] += 1
+            log.msg("bad frame from worker at %s:%d"%addr, system='dispatch')
+            return
+        worker = self._byAddr.get(addr)
+        if worker is None:
+            self.stats['bad'] += 1
+            return
+        method, code, callid, cseq = parseSIP(body)
+        if callid:
+            if method is not None and callid not in self._dialogs:
+                # The worker's placing a call
+                self._track(callid, worker, method)
+            elif code is not None:
+                self._sawResponse(callid, code, cseq)
+        self.stats['out'] += 1
+        self.transport.write(body, dest)
+
+    def _gotReport(self, addr, index, calls, tickload, overruns):
+        if not 0 <= index < len(self.workers):
+            raise ValueError(index)
+        worker = self.workers[index]
+        if worker.addr != addr:
+            if worker.addr is not None:
+                del self._byAddr[worker.addr]
+            self._byAddr[addr] = worker
+        worker.gotReport(addr, calls, tickload, overruns, self.clock())
+
+    def _reject(self, message, addr):
+        "Tell the far end we can't take the call"
+        m = _endOfHeaders.search(message)
+        if m is not None:
+            message = message[:m.start()]
+        lines = [ 'SIP/2.0 503 Service Unavailable' ]
+        for line in message.splitlines()[1:]:
+            name = line.split(':', 1)[0].strip().lower()
+            if name in ('via', 'v', 'from', 'f', 'to', 't', 'call-id', 'i',
+                        'cseq'):
+                lines.append(line)
+        lines.append('Retry-After: 5')
+        lines.append('Content-Length: 0')
+        self.stats['rejected'] += 1
+        log.msg("no workers available, rejecting call from %s:%d"%addr,
+                                                        system='dispatch')
+        self.transport.write('\r\n'.join(lines) + '\r\n\r\n', addr)
+
+    def expireDialogs(self):
+        now = self.clock()
+        for callid, (worker, confirmed, expires) in self._dialogs.items():
+            if worker.dead or (expires is not None and expires < now):
+                del self._dialogs[callid]
+
+class _DispatchedTransport:
+    "What a worker's SipProtocol sees as its transport (cf shtoom.rtp.mux)"
+
+    def __init__(self, channel, host, port):
+        self.channel = channel
+        self.host = IPv4Address('UDP', host, port)
+
+    def write(self, datagram, addr=None):
+        return self.channel.sendSIP(datagram, addr)
+
+    def getHost(self):
+        # The public port, so it's what goes into our Via and Contact
+        return self.host
+
+class WorkerChannel(DatagramProtocol):
+    "A worker's end of its link to the dispatcher"
+
+    def __init__(self, app, index, dispatcher):
+        self.app = app
+        self.index = index
+        self.dispatcher = dispatcher
+        self._overruns = 0
+
+    def datagramReceived(self, datagram, addr):
+        if addr != self.dispatcher:
+            return
+        try:
+            kind, args, body = unpackFrame(datagram)
+            if kind != 'SIP':
+                raise ValueError(kind)
+            src = (args[0], int(args[1]))
+        except (ValueError, IndexError):
+            log.msg("bad frame from dispatcher", system='worker')
+            return
+        self.app.sip.datagramReceived(body, src)
+
+    def sendSIP(self, message, addr):
+        self.transport.write(packSIP(addr, str(message)), self.dispatcher)
+
+    def report(self):
+        from shtoom.audio.clock import FRAME_SECONDS
+        # From the media process, if the worker has one
+        stats = self.app.getMediaStats()
+        overruns = stats['overruns'] - self._overruns
+        self._overruns = stats['overruns']
+        if stats['members']:
+            tickload = stats['lastTickTime'] / FRAME_SECONDS
+        else:
+            tickload = 0.0
+        self.transport.write('LOAD %d %d %0.3f %d\n'%(self.index,
+                                    self.app.getCallCount(), tickload,
+                                    overruns), self.dispatcher)
+
+class DougWorkerApplication(DougApplication):
+    """ A DougApplication that gets its SIP from a dispatcher, rather than
+        a port of its own.
+    """
+
+    _NATMapping = False
+
+    def __init__(self, voiceapp, index, dispatcher, portRange=None,
+                 muxPort=None):
+        DougApplication.__init__(self, voiceapp)
+        self.workerIndex = index
+        self.dispatcher = dispatcher
+        self.portRange = portRange
+        self.muxPort = muxPort
+
+    def getPref(self, pref, default=None):
+        value = DougApplication.getPref(self, pref, default)
+        if pref == 'logfile' and value:
+            # Each worker has a log of its own
+            value = '%s.%d'%(value, self.workerIndex)
+        return value
+
+    def initOptions(self, options=None, args=None):
+        DougApplication.initOptions(self, options, args)
+        # Set before boot() forks any media process
+        opts = self.getOptions()
+        if self.portRange is not None:
+            opts.setValue('rtp_port_min', self.portRange[0], dynamic=True)
+            opts.setValue('rtp_port_max', self.portRange[1], dynamic=True)
+        if self.muxPort is not None:
+            opts.setValue('rtp_mux_port', self.muxPort, dynamic=True)
+
+    def connectSIP(self):
+        from shtoom import sip, batchudp
+        self.sip = sip.SipProtocol(self)
+        batchudp.configureFromPrefs(self)
+        self.channel = WorkerChannel(self, self.workerIndex,
+                                     self.dispatcher)
+        self.sipListener = batchudp.listenUDP(0, self.channel, '127.0.0.1',
+                                              kind='sip')
+        self.sip.transport = _DispatchedTransport(self.channel,
+                                    self.getPref('localip') or '0.0.0.0',
+                                    self.getPref('listenport') or 5060)
+        self._reporter = LoopingCall(self.channel.report)
+        self._reporter.start(REPORT_INTERVAL)
+        log.msg('worker %d started, RTP ports %r'%(self.workerIndex,
+                                        self.portRange), system='worker')
+
+class DougSupervisor:
+    "Forks the workers, and dispatches SIP to them"
+
+    def __init__(self, voiceappClass, workers, configFileName='', args=None,
+                 mainhack=False):
+        self.voiceappClass = voiceappClass
+        self.workerCount = workers
+        self.configFileName = configFileName
+        self.args = args
+        self.mainhack = mainhack
+        self.workers = []
+
+    def start(self):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("supervisor mode needs os.fork()")
+        from shtoom import batchudp
+        # For the preferences, and the logging
+        app = DougApplication(self.voiceappClass)
+        if self.configFileName != '':
+            app.configFileName = self.configFileName
+        app.initOptions(args=self.args)
+        self.app = app
+        getPref = app.getPref
+        from shtoom.rtp.portpool import DEFAULT_LOW_PORT, DEFAULT_HIGH_PORT
+        ranges = splitPortRange(getPref('rtp_port_min') or DEFAULT_LOW_PORT,
+                                getPref('rtp_port_max') or DEFAULT_HIGH_PORT,
+                                self.workerCount)
+        maxCalls = getPref('worker_max_calls')
+        self.workers = [ WorkerInfo(i, maxCalls=maxCalls)
+                                        for i in range(self.workerCount) ]
+        self.dispatcher = SipDispatcher(self.workers)
+        # The workers need to know where to find us, so this is bound
+        # before they're forked.
+        self.workerListener = batchudp.listenUDP(0,
+                        self.dispatcher.workerSide, '127.0.0.1', kind='sip')
+        dispatcherAddr = ('127.0.0.1', self.workerListener.getHost().port)
+        muxPort = getPref('rtp_mux_port')
+        for worker in self.workers:
+            if muxPort:
+                wmux = muxPort + worker.index
+            else:
+                wmux = None
+            pid = os.fork()
+            if pid == 0:
+                self._runWorker(worker.index, dispatcherAddr,
+                                ranges[worker.index], wmux)
+            worker.pid = pid
+        self._startLogging()
+        lport = getPref('listenport')
+        if lport is None:
+            lport = 5060
+        batchudp.configureFromPrefs(app)
+        self.sipListener = batchudp.listenUDP(lport, self.dispatcher,
+                                              kind='sip')
+        log.msg('dispatching SIP on port %d to %d workers'%(
+                    self.sipListener.getHost().port, self.workerCount),
+                                                        system='dispatch')
+        self._monitor = LoopingCall(self.checkWorkers)
+        self._monitor.start(REPORT_INTERVAL, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        if not hasattr(reactor, 'running') or not reactor.running:
+            reactor.run()
+
+    def _runWorker(self, index, dispatcherAddr, portRange, muxPort):
+        "In the child: run a worker until the reactor stops, then exit"
+        status = 0
+        try:
+            cleanForkedReactor()
+            app = DougWorkerApplication(self.voiceappClass, index,
+                                        dispatcherAddr, portRange, muxPort)
+            if self.configFileName != '':
+                app.configFileName = self.configFileName
+            if self.mainhack:
+                import __main__
+                __main__.app = app
+            if self.args is None:
+                app.boot()
+            else:
+                app.boot(args=self.args)
+            app.start()
+        except:
+            log.err()
+            status = 1
+        os._exit(status)
+
+    def _startLogging(self):
+        import sys
+        import shtoom.log
+        logfile = self.app.getPref('logfile')
+        if logfile:
+            shtoom.log.startLogging(open(logfile, 'aU'))
+        else:
+            shtoom.log.startLogging(sys.stdout)
+
+    def checkWorkers(self):
+        "Reap any dead workers, and forget their calls"
+        for worker in self.workers:
+            if worker.dead or worker.pid is None:
+                continue
+            try:
+                pid, status = os.waitpid(worker.pid, os.WNOHANG)
+            except OSError:
+                pid, status = worker.pid, None
+            if pid:
+                worker.dead = True
+                log.msg("worker %d (pid %d) died, status %r"%(worker.index,
+                                    worker.pid, status), system='dispatch')
+        self.dispatcher.expireDialogs()
+
+    def stop(self):
+        import signal
+        for worker in self.workers:
+            if not worker.dead and worker.pid:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except OSError:
+                    pass
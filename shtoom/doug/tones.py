@@ -0,0 +1,218 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" Precomputed tones.
+
+    DTMF digits and call progress tones (ringback, busy) are the same
+    audio every time they're played, so the ToneBank synthesises each
+    one once, as 20ms frames of 16 bit audio, and encodes it once per
+    codec. A ToneSource plays a sequence of tones and silences from the
+    bank - every call playing the same tone shares the same frames.
+"""
+
+import math, struct
+
+from shtoom.audio.converters import Codecker, MediaSample
+from shtoom.doug.dtmf import dtmf2freq, HZ
+from shtoom.doug.source import Source
+from shtoom.rtp.formats import PT_RAW
+
+FRAME_SAMPLES = 160
+FRAME_SECONDS = FRAME_SAMPLES / HZ
+
+# Each of a tone's frequencies is a sine wave of this amplitude
+TONE_AMPLITUDE = 2**13
+
+# Call progress tones: name -> (frequencies, cadence), where cadence is
+# a list of (seconds on, seconds off). These are the North American ones.
+PROGRESS_TONES = {
+    'dialtone':     ((350, 440), ((1.0, 0),)),
+    'ringback':     ((440, 480), ((2.0, 4.0),)),
+    'busy':         ((480, 620), ((0.5, 0.5),)),
+    'congestion':   ((480, 620), ((0.24, 0.26),)),
+}
+
+# The default length of a DTMF digit, and the gap after it
+DTMF_DURATION = 0.1
+DTMF_DELAY = 0.05
+
+def secondsToFrames(seconds):
+    return int(round(seconds / FRAME_SECONDS))
+
+def synthesise(frequencies, samples):
+    "samples of the sum of sine waves at frequencies, as 16 bit audio"
+    ws = [ 2.0 * math.pi * f / HZ for f in frequencies ]
+    out = []
+    for n in xrange(samples):
+        v = 0.0
+        for w in ws:
+            v += math.sin(w * n)
+        out.append(int(TONE_AMPLITUDE * v))
+    return struct.pack('%dh'%samples, *out)
+
+def splitIntoFrames(audio):
+    size = FRAME_SAMPLES * 2
+    return [ audio[i:i+size] for i in range(0, len(audio), size) ]
+
+class ToneBank:
+    """ Tones, by name: a DTMF digit, one of PROGRESS_TONES, or None for
+        silence. Each is made the first time it's asked for, and kept.
+    """
+
+    def __init__(self):
+        # (name, frames) -> [ frame, ... ]
+        self._pcm = {}
+        # (name, frames, format) -> [ frame, ... ], or None
+        self._encoded = {}
+        self._silence = '\0' * FRAME_SAMPLES * 2
+
+    def getPCM(self, name, frames=None):
+        """ Returns a list of frames of 16 bit audio. For a DTMF digit or
+            silence, frames says how many; a progress tone is one whole
+            cycle of its cadence.
+        """
+        key = (name, frames)
+        pcm = self._pcm.get(key)
+        if pcm is None:
+            pcm = self._pcm[key] = self._make(name, frames)
+        return pcm
+
+    def getFrames(self, name, format, frames=None):
+        """ Returns the tone (see getPCM) as a list of frames encoded in
+            format, or None if format's encoder keeps state between
+            frames - those can't be shared, so each leg must encode the
+            audio itself.
+        """
+        if format == PT_RAW:
+            return self.getPCM(name, frames)
+        key = (name, frames, format)
+        if key in self._encoded:
+            return self._encoded[key]
+        c = Codecker(format)
+        try:
+            if c.isShared():
+                encoded = []
+                for frame in self.getPCM(name, frames):
+                    encoded.append(c.handle_audio(frame).data)
+            else:
+                encoded = None
+        finally:
+            c.close()
+        self._encoded[key] = encoded
+        return encoded
+
+    def _make(self, name, frames):
+        if name is None:
+            return [ self._silence ] * frames
+        if name in dtmf2freq:
+            if frames is None:
+                frames = secondsToFrames(DTMF_DURATION)
+            return splitIntoFrames(synthesise(dtmf2freq[name],
+                                              frames * FRAME_SAMPLES))
+        if name in PROGRESS_TONES:
+            frequencies, cadence = PROGRESS_TONES[name]
+            out = []
+            for on, off in cadence:
+                on = secondsToFrames(on)
+                out.extend(splitIntoFrames(synthesise(frequencies,
+                                                on * FRAME_SAMPLES)))
+                out.extend([ self._silence ] * secondsToFrames(off))
+            return out
+        raise ValueError("unknown tone %r"%(name,))
+
+    def clear(self):
+        self._pcm = {}
+        self._encoded = {}
+
+_bank = None
+
+def getToneBank():
+    global _bank
+    if _bank is None:
+        _bank = ToneBank()
+    return _bank
+
+class ToneSource(Source):
+    """ A ToneSource plays a sequence of tones from the bank, given as a
+        list of (name, frames) - see ToneBank.getPCM. If loop is true, it
+        plays until it's stopped.
+    """
+
+    def __init__(self, sequence, loop=False, bank=None):
+        super(ToneSource, self).__init__()
+        if bank is None:
+            bank = getToneBank()
+        self.bank = bank
+        self.sequence = sequence
+        self.loop = loop
+        # format -> the whole sequence, as one list of frames
+        self._frames = {}
+        self._pos = 0
+
+    def isPlaying(self):
+        return True
+
+    def isRecording(self):
+        return False
+
+    def close(self):
+        pass
+
+    def write(self, bytes):
+        pass
+
+    def _framesFor(self, format):
+        if format in self._frames:
+            return self._frames[format]
+        frames = []
+        for name, count in self.sequence:
+            tone = self.bank.getFrames(name, format, count)
+            if tone is None:
+                frames = None
+                break
+            frames.extend(tone)
+        self._frames[format] = frames
+        return frames
+
+    def _next(self, frames):
+        if self._pos >= len(frames):
+            if not self.loop or not frames:
+                self.leg._sourceDone(self)
+                return None
+            self._pos = 0
+        frame = frames[self._pos]
+        self._pos += 1
+        return frame
+
+    def read(self):
+        return self._next(self._framesFor(PT_RAW))
+
+    def readShared(self, format):
+        frames = self._framesFor(format)
+        if frames is None or (self._pos >= len(frames) and not self.loop):
+            # read() does the rest (including finishing)
+            return None
+        frame = self._next(frames)
+        if frame is not None:
+            return MediaSample(format, frame)
+
+def progressTone(name):
+    "A ToneSource playing one of PROGRESS_TONES until it's stopped"
+    if name not in PROGRESS_TONES:
+        raise ValueError("unknown tone %r"%(name,))
+    return ToneSource([(name, None)], loop=True)
+
+def digitTones(digits, duration=DTMF_DURATION, delay=DTMF_DELAY):
+    """ A ToneSource playing a string of DTMF digits, each for duration
+        seconds and followed by delay seconds of silence. A ',' is a
+        pause, as long as a digit and its gap.
+    """
+    seq = []
+    for key in digits:
+        if key == ',':
+            seq.append((None, secondsToFrames(duration + delay)))
+        elif key in dtmf2freq:
+            seq.append((key, secondsToFrames(duration)))
+            seq.append((None, secondsToFrames(delay)))
+        else:
+            raise ValueError(key)
+    return ToneSource(seq)
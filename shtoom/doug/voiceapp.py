@@ -75,6 +75,11 @@ class VoiceApp(StateMachine):
             cookie = self.__cookie
         self.__appl.outgoingRTP(cookie, sample)
 
+    def va_relayRTP(self, packet, cookie=None):
+        if cookie is None:
+            cookie = self.__cookie
+        self.__appl.relayRTP(cookie, packet)
+
     def va_start(self, args):
         self._start(callstart=0, args=args)
 
@@ -110,6 +115,7 @@ class VoiceApp(StateMachine):
         #print self, "clearing running legs %r"%(self.__legs.items())#,stack(8)
         for name, leg in self.__legs.items():
             leg._stopAudio()
+            leg.mediaStopRecording()
             del self.__legs[name]
 
     _cleanup = _clear_legs
@@ -124,10 +130,10 @@ class VoiceApp(StateMachine):
             leg = self.getDefaultLeg()
         leg.mediaPlay(playlist)
 
-    def mediaRecord(self, dest, leg=None):
+    def mediaRecord(self, dest, leg=None, encoded=False):
         if leg is None:
             leg = self.getDefaultLeg()
-        leg.mediaRecord(dest)
+        return leg.mediaRecord(dest, encoded)
 
     def mediaStop(self, leg=None):
         if leg is None:
@@ -139,7 +145,7 @@ class VoiceApp(StateMachine):
         if leg is None:
             leg = self.getDefaultLeg()
         if leg is not None:
-            leg.mediaStopRecording()
+            return leg.mediaStopRecording()
 
     def setTimer(self, delay):
         return Timer(self, delay)
@@ -160,8 +166,7 @@ class VoiceApp(StateMachine):
         leg.dtmfMode(single, inband, timeout)
 
     def placeCall(self, toURI, fromURI=None):
-        from shtoom.doug.leg import Leg
-        nleg = Leg(cookie=None, dialog=None, voiceapp=self)
+        nleg = self.__appl.newLeg(cookie=None, dialog=None, voiceapp=self)
         self.__appl.placeCall(self.__cookie, nleg, toURI, fromURI)
 
     def va_hangupCall(self, cookie):
@@ -174,21 +179,54 @@ class VoiceApp(StateMachine):
             leg2 = self.getDefaultLeg()
         if leg1 is leg2:
             raise ValueError, "can't join %r to itself!"%(leg1)
+        elif leg1.media is not None:
+            # The legs' audio is in the media process - join them there
+            return leg1.media.bridgeLegs(leg1, leg2)
         else:
             b = Bridge(leg1, leg2)
             return b
 
-    def sendDTMF(self, digits, cookie=None, duration=0.1, delay=0.05):
-        "Send a string of DTMF keystrokes"
-        for n,key in enumerate(digits):
+    def relayLegs(self, leg1, leg2=None):
+        """ Like connectLegs, but the legs' RTP is relayed between them as
+            it arrives, without being decoded. Neither leg plays or records
+            anything after this. Returns the RTPRelay, for its stats (or
+            None, if the media is in a media process - the stats are
+            logged there when the calls end).
+        """
+        if leg2 is None:
+            leg2 = self.getDefaultLeg()
+        if leg1 is leg2:
+            raise ValueError, "can't join %r to itself!"%(leg1)
+        leg1._stopAudio()
+        leg2._stopAudio()
+        return self.__appl.relayCalls(leg1.getCookie(), leg2.getCookie())
+
+    def sendDTMF(self, digits, cookie=None, duration=0.1, delay=0.05,
+                 inband=None):
+        """ Send a string of DTMF keystrokes. They're sent as RFC 2833
+            events if the other end agreed to them, or as tones in the
+            audio if it didn't (or if inband is True). Tones are played
+            like any other media, so a MediaDoneEvent follows.
+        """
+        for key in digits:
             if key not in ',01234567890#*':
                 raise ValueError, key
+        if cookie is None:
+            cookie = self.__cookie
+        if inband is None:
+            inband = not self.__appl.canSendNTE(cookie)
+        if inband:
+            from shtoom.doug.tones import digitTones
+            leg = self.getLeg(cookie)
+            if leg is None:
+                leg = self.getDefaultLeg()
+            leg.mediaPlay([digitTones(digits, duration, delay)])
+            return
+        for n,key in enumerate(digits):
             if key == ',':
                 # pause
                 continue
             n = float(n) # just in case
-            if cookie is None:
-                cookie = self.__cookie
             i = 0.2
             reactor.callLater(i+n*(duration+delay),
                 lambda k=key: self.__appl.startDTMF(cookie, k))
@@ -32,6 +32,14 @@ def buildOptions(app):
 
     network.add(NumberOption('force_rtp_port',
                             _('force RTP to use this port')))
+    network.add(NumberOption('rtp_port_min',
+                            _('lowest port to use for RTP')))
+    network.add(NumberOption('rtp_port_max',
+                            _('highest port to use for RTP')))
+    network.add(NumberOption('rtp_mux_port',
+                _('multiplex the RTP for all calls onto this one port')))
+    network.add(BooleanOption('rtp_latch',
+                _('send RTP to wherever the other end sends it from'), False))
     opts.add(network)
 
     identity = OptionGroup('identity', _('Identity Settings'))
@@ -54,6 +62,16 @@ def buildOptions(app):
                                         _('Passwd to use for auth')))
     opts.add(register)
 
+    tuning = OptionGroup('tuning', _('Performance Tuning'), gui=False)
+    tuning.add(NumberOption('udp_read_budget',
+                _('read at most this many datagrams per socket wakeup')))
+    for kind in 'sip', 'rtp':
+        tuning.add(NumberOption('%s_rcvbuf'%kind,
+                _('receive buffer size for %s sockets')%kind.upper()))
+        tuning.add(NumberOption('%s_sndbuf'%kind,
+                _('send buffer size for %s sockets')%kind.upper()))
+    opts.add(tuning)
+
     debug = OptionGroup('debug', _('Debugging'), gui=False)
     debug.add(BooleanOption('stdout', _('Log to stdout'), False))
     debug.add(BooleanOption('no_config_file',
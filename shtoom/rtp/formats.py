@@ -95,7 +95,7 @@ class SDPGenerator:
     "Responsible for generating SDP for the RTPProtocol"
 
     def getSDP(self, rtp, extrartp=None):
-        from shtoom.sdp import SDP, MediaDescription
+        from shtoom.sdp import SDP, MediaDescription, parse_a
         if extrartp:
             raise ValueError("can't handle multiple RTP streams in a call yet")
         s = SDP()
@@ -111,6 +111,9 @@ class SDPGenerator:
         md.addRtpMap(PT_PCMU)
         md.addRtpMap(PT_CN)
         md.addRtpMap(PT_NTE)
+        if getattr(rtp, 'rtcpMux', False):
+            # RFC 5761 - RTCP is on the same port as RTP
+            parse_a(md, 'a', 'rtcp-mux')
         return s
 
 RTPDict = {}
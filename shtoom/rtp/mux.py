@@ -0,0 +1,195 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" Multiplexed RTP - many calls sharing one UDP socket.
+
+    Normally each call gets its own RTP and RTCP sockets. With a lot of
+    calls that's a lot of file descriptors for the reactor to poll. In
+    multiplexed mode, every call's RTPProtocol registers with a single
+    SharedRTPSocket, which advertises the same port in every SDP, and
+    demultiplexes inbound packets to the right call. RTCP arrives on the
+    same port (rtcp-mux, RFC 5761).
+
+    Inbound packets are matched by the remote address they came from.
+    Until a call has heard from its far end, a packet from the IP in its
+    SDP is also matched to it if no other call on that IP is waiting (the
+    NAT rewrote the port from the one in the SDP), and the call latches
+    onto the address the packet came from. After that, only packets from
+    exactly that address are the call's - the SSRC in a packet is never
+    trusted, as anyone could send one.
+"""
+
+from twisted.internet import defer
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import log
+
+from shtoom import batchudp
+
+def isRTCP(datagram):
+    "RFC 5761 - RTCP packet types 192-223 don't clash with RTP payload types"
+    return 192 <= ord(datagram[1]) <= 223
+
+class _MuxTransport:
+    "What a multiplexed RTPProtocol sees as its transport"
+
+    def __init__(self, shared):
+        self.shared = shared
+
+    def write(self, datagram, addr=None):
+        return self.shared.transport.write(datagram, addr)
+
+    def getHost(self):
+        return self.shared.transport.getHost()
+
+class SharedRTPSocket(DatagramProtocol):
+    "A single UDP socket carrying RTP and RTCP for many calls"
+
+    def __init__(self):
+        self._byAddr = {}
+        # remote IP -> calls that are yet to see a packet
+        self._pendingByIP = {}
+        # rtp -> {remote address: None}, the keys it has in _byAddr
+        self._calls = {}
+        # The shared socket's address outside the NAT, once we know it
+        self._mapped = None
+        self._mappingWaiters = []
+        self.stats = { 'packets': 0, 'rtcp': 0, 'unmatched': 0, 'bad': 0 }
+
+    def listen(self, port, interface=''):
+        self.listener = batchudp.listenUDP(port, self, interface, kind='rtp')
+        self.port = self.listener.getHost().port
+        return self.port
+
+    def getMapping(self):
+        """ Returns a Deferred that fires with the (ip, port) of the shared
+            socket as seen from outside the NAT. The mapping is only done
+            once, for all calls - unless it fails, when every call waiting
+            for it gets the failure, and the next call tries again.
+        """
+        d = defer.Deferred()
+        if self._mapped is not None:
+            d.callback(self._mapped)
+            return d
+        self._mappingWaiters.append(d)
+        if len(self._mappingWaiters) == 1:
+            from shtoom.nat import getMapper
+            m = getMapper()
+            m.addCallback(lambda mapper: mapper.map(self.listener))
+            m.addCallbacks(self._mappingDone, self._mappingFailed)
+        return d
+
+    def _mappingDone(self, addr):
+        self._mapped = addr
+        waiters, self._mappingWaiters = self._mappingWaiters, []
+        for d in waiters:
+            d.callback(addr)
+
+    def _mappingFailed(self, failure):
+        waiters, self._mappingWaiters = self._mappingWaiters, []
+        for d in waiters:
+            d.errback(failure)
+
+    def register(self, rtp):
+        "Attach an RTPProtocol; returns the transport it should write to"
+        self._calls[rtp] = {}
+        return _MuxTransport(self)
+
+    def unregister(self, rtp):
+        addrs = self._calls.pop(rtp, None)
+        if addrs is None:
+            return
+        for addr in addrs:
+            if self._byAddr.get(addr) is rtp:
+                del self._byAddr[addr]
+            self._notPending(rtp, addr[0])
+
+    def setRemote(self, rtp, addr):
+        "Called when the call's far end (from the SDP) is known"
+        addrs = self._calls.get(rtp)
+        if addrs is None:
+            return
+        self._addAddr(rtp, addr)
+        self._pendingByIP.setdefault(addr[0], []).append(rtp)
+
+    def _addAddr(self, rtp, addr):
+        self._byAddr[addr] = rtp
+        self._calls[rtp][addr] = None
+
+    def _notPending(self, rtp, ip):
+        pending = self._pendingByIP.get(ip)
+        if pending and rtp in pending:
+            pending.remove(rtp)
+            if not pending:
+                del self._pendingByIP[ip]
+
+    def callCount(self):
+        return len(self._calls)
+
+    def _latch(self, rtp, addr):
+        "rtp has heard from its far end, at addr"
+        self._notPending(rtp, addr[0])
+        if rtp.dest != addr:
+            log.msg("rtp mux: latching %r onto %s:%d"%(rtp.cookie,
+                                        addr[0], addr[1]), system='rtp')
+            self._addAddr(rtp, addr)
+            rtp.dest = addr
+
+    def lookup(self, datagram, addr):
+        "Find the RTPProtocol that datagram belongs to, or None"
+        rtp = self._byAddr.get(addr)
+        pending = self._pendingByIP.get(addr[0])
+        if rtp is not None:
+            if pending and rtp in pending:
+                self._latch(rtp, addr)
+            return rtp
+        if pending and len(pending) == 1 and pending[0].looksLikeOurRTP(
+                                                                datagram):
+            rtp = pending[0]
+            self._latch(rtp, addr)
+            return rtp
+        return None
+
+    def datagramsReceived(self, batch):
+        "A batch of (datagram, addr) drained from the socket in one go"
+        received = self.datagramReceived
+        for datagram, addr in batch:
+            # One bad packet mustn't lose the rest of the batch
+            try:
+                received(datagram, addr)
+            except:
+                self.stats['bad'] += 1
+                log.deferr()
+
+    def datagramReceived(self, datagram, addr):
+        stats = self.stats
+        # The smallest RTCP packet is 8 bytes, and RTP 12
+        if len(datagram) < 8:
+            stats['bad'] += 1
+            return
+        if isRTCP(datagram):
+            # RTCP SSRC is at the same offset as RTP's timestamp, so only
+            # match it by address.
+            stats['rtcp'] += 1
+            rtp = self._byAddr.get(addr)
+            if rtp is not None:
+                rtp.RTCP.datagramReceived(datagram, addr)
+            return
+        if len(datagram) < 12:
+            stats['bad'] += 1
+            return
+        rtp = self.lookup(datagram, addr)
+        if rtp is None:
+            stats['unmatched'] += 1
+            return
+        stats['packets'] += 1
+        rtp.datagramReceived(datagram, addr)
+
+_shared = {}
+
+def getSharedSocket(port, interface=''):
+    "Return the SharedRTPSocket listening on port, creating it if needed"
+    shared = _shared.get((interface, port))
+    if shared is None:
+        shared = SharedRTPSocket()
+        shared.listen(port, interface)
+        _shared[(interface, port)] = shared
+    return shared
@@ -2,10 +2,29 @@
 
 import struct
 
+# Precompiled packers for the fixed RTP header and the (single) extension
+# header. Building these once saves re-parsing the format on every packet.
+_hdrStruct = struct.Struct('!BBHII')
+_xhdrStruct = struct.Struct('!HH')
+
+RTP_HEADER_LEN = _hdrStruct.size
+# Big enough for any RTP packet we'd send (an ethernet MTU's worth)
+RTP_MAX_PACKET = 1500
+
 # This class supports extension headers, but only one per packet.
-class RTPPacket:
-    """ Contains RTP data. """
-    class Header:
+class RTPPacket(object):
+    """ Contains RTP data.
+
+        Packets built from the wire by parse_rtppacket() don't copy the
+        payload out of the datagram until someone asks for .data - use
+        getPayloadBuffer() for a zero-copy view.
+    """
+    __slots__ = ('header', '_data', 'authtag', '_buf', '_start', '_end')
+
+    class Header(object):
+        __slots__ = ('ssrc', 'pt', 'ct', 'seq', 'ts', 'marker',
+                     'xhdrtype', 'xhdrdata')
+
         def __init__(self, ssrc, pt, ct, seq, ts, marker=0,
                      xhdrtype=None, xhdrdata=''):
             """
@@ -35,17 +54,36 @@ class RTPPacket:
                 self.pt < 2**8, \
                 "pt is required to be a simple byte, suitable " + \
                 "for stuffing into an RTP packet and sending. pt: %s" % self.pt
+            if self.xhdrtype is not None:
+                return _hdrStruct.pack(0x90,
+                                       self.pt | (self.marker and 128),
+                                       self.seq & 0xffff,
+                                       self.ts, self.ssrc) + \
+                       _xhdrStruct.pack(self.xhdrtype,
+                                        len(self.xhdrdata)/4) + self.xhdrdata
+            return _hdrStruct.pack(0x80, self.pt | (self.marker and 128),
+                                   self.seq & 0xffff, self.ts, self.ssrc)
+
+        def pack_into(self, buf, offset=0):
+            """ Write the network-formatted header into the writable
+                buffer buf (e.g. a bytearray) at offset. Returns the
+                offset just past the header.
+            """
             if self.xhdrtype is not None:
                 firstbyte = 0x90
-                xhdrnetbytes = struct.pack('!HH', self.xhdrtype,
-                                    len(self.xhdrdata)/4) + self.xhdrdata
             else:
                 firstbyte = 0x80
-                xhdrnetbytes = ''
-            return struct.pack('!BBHII', firstbyte,
-                                        self.pt | self.marker << 7,
-                                        self.seq % 2**16,
-                                        self.ts, self.ssrc) + xhdrnetbytes
+            _hdrStruct.pack_into(buf, offset, firstbyte,
+                                 self.pt | (self.marker and 128),
+                                 self.seq & 0xffff, self.ts, self.ssrc)
+            offset += RTP_HEADER_LEN
+            if self.xhdrtype is not None:
+                xlen = len(self.xhdrdata)
+                _xhdrStruct.pack_into(buf, offset, self.xhdrtype, xlen/4)
+                offset += 4
+                buf[offset:offset+xlen] = self.xhdrdata
+                offset += xlen
+            return offset
 
     def __init__(self, ssrc, seq, ts, data, pt=None, ct=None, marker=0,
                  authtag='', xhdrtype=None, xhdrdata=''):
@@ -54,11 +92,29 @@ class RTPPacket:
             "into an RTP packet and sending. pt: %s" % pt
         self.header = RTPPacket.Header(ssrc, pt, ct, seq, ts, marker,
                                        xhdrtype, xhdrdata)
-        self.data = data
+        self._data = data
+        self._buf = None
         # please leave this alone even if it appears unused --
         # it is required for SRTP
         self.authtag = authtag
 
+    def _getData(self):
+        if self._data is None:
+            self._data = self._buf[self._start:self._end]
+        return self._data
+
+    def _setData(self, data):
+        self._data = data
+        self._buf = None
+
+    data = property(_getData, _setData)
+
+    def getPayloadBuffer(self):
+        "Return a read-only view of the payload, without copying it"
+        if self._data is None:
+            return buffer(self._buf, self._start, self._end - self._start)
+        return buffer(self._data)
+
     def __repr__(self):
         if self.header.ct is not None:
             ptrepr = "%r" % (self.header.ct,)
@@ -80,48 +136,79 @@ class RTPPacket:
         "Return network-formatted packet."
         return self.header.netbytes() + self.data + self.authtag
 
-def parse_rtppacket(bytes, authtaglen=0):
+    def pack_into(self, buf, offset=0):
+        """ Write the network-formatted packet into the writable buffer
+            buf at offset. Returns the number of bytes written.
+        """
+        end = self.header.pack_into(buf, offset)
+        for chunk in (self.data, self.authtag):
+            if chunk:
+                buf[end:end+len(chunk)] = chunk
+                end += len(chunk)
+        return end - offset
+
+def pack_rtp_into(buf, ssrc, seq, ts, pt, data, marker=0):
+    """ Fast path for the sender: write a plain (no extension, no CSRC)
+        RTP packet straight into buf without building an RTPPacket.
+        Returns the length of the packet.
+    """
+    _hdrStruct.pack_into(buf, 0, 0x80, pt | (marker and 128),
+                         seq & 0xffff, ts, ssrc)
+    end = RTP_HEADER_LEN + len(data)
+    buf[RTP_HEADER_LEN:end] = data
+    return end
+
+def _newHeader(Header=RTPPacket.Header, new=object.__new__):
+    return new(Header)
+
+def _newPacket(RTPPacket=RTPPacket, new=object.__new__):
+    return new(RTPPacket)
+
+def parse_rtppacket(bytes, authtaglen=0, unpack_from=_hdrStruct.unpack_from):
     # Most variables are named for the fields in the RTP RFC.
-    hdrpieces = struct.unpack('!BBHII', bytes[:12])
+    # The constructors' sanity checks are skipped here - everything comes
+    # straight out of a 12 byte struct, so it's sane by construction.
+    # A datagram too short for its headers raises struct.error or
+    # ValueError.
+    b0, b1, seq, ts, ssrc = unpack_from(bytes)
 
+    hdr = _newHeader()
+    hdr.ssrc, hdr.seq, hdr.ts = ssrc, seq, ts
     # XXX we ignore v (version)
-    # Padding?
-    p = (hdrpieces[0] & 32) and 1 or 0
-    # Extension header present?
-    x = (hdrpieces[0] & 16) and 1 or 0
-    # CSRC Count
-    cc = hdrpieces[0] & 15
     # Marker bit
-    marker = hdrpieces[1] & 128
+    hdr.marker = b1 >> 7
     # Payload type
-    pt = hdrpieces[1] & 127
-    # Sequence number
-    seq = hdrpieces[2]
-    # Timestamp
-    ts = hdrpieces[3]
-    ssrc = hdrpieces[4]
-    headerlen = 12 + cc * 4
+    hdr.pt = b1 & 127
+    hdr.ct = None
+    # CSRC Count
     # XXX throwing away csrc info for now
-    bytes = bytes[headerlen:]
-    if x:
+    start = 12 + (b0 & 15) * 4
+    end = len(bytes)
+    # Extension header present?
+    if b0 & 16:
         # Only one extension header
-        (xhdrtype, xhdrlen,) = struct.unpack('!HH', bytes[:4])
-        xhdrdata = bytes[4:4+xhdrlen*4]
-        bytes = bytes[xhdrlen*4 + 4:]
+        (xhdrtype, xhdrlen,) = _xhdrStruct.unpack_from(bytes, start)
+        start += 4
+        hdr.xhdrtype = xhdrtype
+        hdr.xhdrdata = bytes[start:start+xhdrlen*4]
+        start += xhdrlen*4
     else:
-        xhdrtype, xhdrdata = None, None
+        hdr.xhdrtype, hdr.xhdrdata = None, None
+    packet = _newPacket()
+    packet.header = hdr
     if authtaglen:
-        authtag = bytes[-authtaglen:]
-        bytes = bytes[:-authtaglen]
+        end -= authtaglen
+        packet.authtag = bytes[end:]
     else:
-        authtag = ''
-    if p:
-        # padding
-        padlen = struct.unpack('!B', bytes[-1])[0]
-        if padlen:
-            bytes = bytes[:-padlen]
-    return RTPPacket(ssrc, seq, ts, bytes, marker=marker, pt=pt,
-                     authtag=authtag, xhdrtype=xhdrtype, xhdrdata=xhdrdata)
+        packet.authtag = ''
+    # Padding?
+    if b0 & 32:
+        end -= ord(bytes[end-1])
+    if end < start:
+        raise ValueError("RTP headers run past the end of the packet")
+    packet._data = None
+    packet._buf, packet._start, packet._end = bytes, start, end
+    return packet
 
 
 class NTE:
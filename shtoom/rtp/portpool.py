@@ -0,0 +1,135 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" Allocation of RTP/RTCP port pairs.
+
+    RTP wants an even port, with RTCP on the odd port above it. Picking
+    a random port and walking upwards on every bind failure gets slow
+    when the range is busy, so instead we keep a queue of the free even
+    ports in the range and hand them out from the front, putting freed
+    ports on the back (so a port gets a rest before it's reused, and any
+    late packets for the old call have time to drain away).
+"""
+
+from collections import deque
+
+from twisted.internet.error import CannotListenError
+from twisted.python import log
+
+from shtoom.exceptions import RTPPortsExhausted
+from shtoom import batchudp
+
+DEFAULT_LOW_PORT = 11000
+DEFAULT_HIGH_PORT = 20000
+
+class PortPairPool:
+    "A pool of even/odd UDP port pairs for RTP and RTCP"
+
+    def __init__(self, low=DEFAULT_LOW_PORT, high=DEFAULT_HIGH_PORT):
+        if low % 2:
+            low += 1
+        if high <= low:
+            raise ValueError("empty RTP port range %d-%d"%(low, high))
+        self.low, self.high = low, high
+        ports = range(low, high, 2)
+        self._free = deque(ports)
+        self._inuse = {}
+        self._allocations = 0
+        self._bindFailures = 0
+
+    def size(self):
+        return len(self._free) + len(self._inuse)
+
+    def listenPair(self, rtp, rtcp, preferred=None, interface='',
+                   listenUDP=None):
+        """ Bind rtp and rtcp (DatagramProtocols) to the next free port
+            pair. Returns (rtpPort, rtpListener, rtcpListener). If
+            preferred is given, that pair is tried first. Raises
+            RTPPortsExhausted if no pair could be bound.
+        """
+        if listenUDP is None:
+            listenUDP = _rtpListenUDP
+        if preferred:
+            if preferred % 2:
+                preferred += 1
+            if preferred in self._inuse:
+                log.msg("preferred RTP port %d already in use"%(preferred),
+                                                            system='rtp')
+            else:
+                try:
+                    self._free.remove(preferred)
+                except ValueError:
+                    # Outside our range - the user knows best
+                    pass
+                res = self._tryPair(preferred, rtp, rtcp, interface,
+                                    listenUDP)
+                if res is not None:
+                    return res
+        # Each port gets at most one attempt - if something outside of
+        # us is sitting on it, it goes to the back of the queue.
+        for attempt in range(len(self._free)):
+            port = self._free.popleft()
+            res = self._tryPair(port, rtp, rtcp, interface, listenUDP)
+            if res is not None:
+                return res
+        raise RTPPortsExhausted("no free RTP ports in %d-%d"%(self.low,
+                                                                self.high))
+
+    def _tryPair(self, port, rtp, rtcp, interface, listenUDP):
+        try:
+            rtpListener = listenUDP(port, rtp, interface=interface)
+        except CannotListenError:
+            self._bindFailed(port)
+            return None
+        try:
+            rtcpListener = listenUDP(port+1, rtcp, interface=interface)
+        except CannotListenError:
+            rtpListener.stopListening()
+            self._bindFailed(port)
+            return None
+        self._inuse[port] = True
+        self._allocations += 1
+        return port, rtpListener, rtcpListener
+
+    def _bindFailed(self, port):
+        self._bindFailures += 1
+        if self.low <= port < self.high:
+            self._free.append(port)
+
+    def release(self, port):
+        "Return the pair starting at port to the pool"
+        if port in self._inuse:
+            del self._inuse[port]
+            if self.low <= port < self.high:
+                self._free.append(port)
+        else:
+            log.msg("releasing RTP port %r, which isn't allocated"%(port,),
+                                                            system='rtp')
+
+    def getStats(self):
+        """ Returns a dictionary with the pool's occupancy: size, inUse,
+            free, allocations and bindFailures.
+        """
+        return { 'size': self.size(),
+                 'inUse': len(self._inuse),
+                 'free': len(self._free),
+                 'allocations': self._allocations,
+                 'bindFailures': self._bindFailures,
+               }
+
+def _rtpListenUDP(port, protocol, interface=''):
+    return batchudp.listenUDP(port, protocol, interface, kind='rtp')
+
+_pools = {}
+
+def getPortPool(app=None):
+    """ Return the PortPairPool for the RTP port range configured in the
+        app's preferences (rtp_port_min, rtp_port_max).
+    """
+    low, high = DEFAULT_LOW_PORT, DEFAULT_HIGH_PORT
+    if app is not None:
+        low = app.getPref('rtp_port_min') or low
+        high = app.getPref('rtp_port_max') or high
+    pool = _pools.get((low, high))
+    if pool is None:
+        pool = _pools[(low, high)] = PortPairPool(low, high)
+    return pool
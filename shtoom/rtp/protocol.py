@@ -11,7 +11,8 @@ from twisted.internet.protocol import DatagramProtocol
 from twisted.python import log
 
 from shtoom.rtp.formats import SDPGenerator, PT_CN, PT_xCN, PT_NTE, PT_PCMU
-from shtoom.rtp.packets import RTPPacket, parse_rtppacket
+from shtoom.rtp.packets import RTPPacket, parse_rtppacket, pack_rtp_into
+from shtoom.rtp.packets import RTP_MAX_PACKET
 from shtoom.audio.converters import MediaSample
 
 TWO_TO_THE_16TH = 2L<<16
@@ -20,6 +21,21 @@ TWO_TO_THE_48TH = 2L<<48
 
 from shtoom.rtp.packets import NTE
 
+def sdpPTDict(sdp):
+    """ A dictionary of payload type number -> PTMarker, and the other way
+        round, for the audio in sdp
+    """
+    rtpmap = sdp.getMediaDescription('audio').rtpmap
+    ptdict = {}
+    for pt, (text, marker) in rtpmap.items():
+        ptdict[pt] = marker
+        ptdict[marker] = pt
+    if PT_PCMU not in ptdict:
+        # Goddam Asterisk has no idea about content negotiation
+        ptdict[0] = PT_PCMU
+        ptdict[PT_PCMU] = 0
+    return ptdict
+
 class RTPProtocol(DatagramProtocol):
     """Implementation of the RTP protocol.
 
@@ -31,6 +47,25 @@ class RTPProtocol(DatagramProtocol):
     _cbDone = None
 
     dest = None
+    _rtpPort = None
+    # The SharedRTPSocket we're multiplexed onto, if any
+    _shared = None
+    rtcpMux = False
+    # If latch is set, the far end's address from the SDP is only a
+    # guess - we send to wherever its first RTP packet (in a payload type
+    # the SDP agreed) comes from.
+    latch = False
+    _latchPending = False
+    # The RTPRelay our packets are passed to, undecoded, if any
+    relay = None
+    # The stream we're relaying (see handle_relayed_packet), if any, and
+    # how far its timestamps are from ours
+    _relaySSRC = None
+    _relayOffset = 0
+    _relayTS = None
+    # Datagrams we've received that were too short, or too mangled, to
+    # be RTP
+    badPackets = 0
 
     Done = False
     def __init__(self, app, cookie, *args, **kwargs):
@@ -43,6 +78,9 @@ class RTPProtocol(DatagramProtocol):
         self.ts = self.genInitTS()
         self.ssrc = self.genSSRC()
         self._silent = None
+        # Outbound packets are serialised into this, rather than building
+        # a new string (and RTPPacket) for every 20ms frame.
+        self._sendbuf = bytearray(RTP_MAX_PACKET)
         # only for debugging -- the way to prevent the sending of RTP packets
         # onto the Net is to reopen the audio device with a None (default)
         # media sample handler instead of this RTP object as the media sample handler.
@@ -58,16 +96,7 @@ class RTPProtocol(DatagramProtocol):
     def setSDP(self, sdp):
         "This is the canonical SDP for the call"
         self.app.selectDefaultFormat(self.cookie, sdp)
-        rtpmap = sdp.getMediaDescription('audio').rtpmap
-        self.ptdict = {}
-        for pt, (text, marker) in rtpmap.items():
-            self.ptdict[pt] = marker
-            self.ptdict[marker] = pt
-        if PT_PCMU not in self.ptdict:
-            # Goddam Asterisk has no idea about content negotiation
-            self.ptdict[0] = PT_PCMU
-            self.ptdict[PT_PCMU] = 0
-
+        self.ptdict = sdpPTDict(sdp)
 
     def createRTPSocket(self, locIP, needSTUN=False):
         """ Start listening on UDP ports for RTP and RTCP.
@@ -78,47 +107,75 @@ class RTPProtocol(DatagramProtocol):
             port.) We don't guarantee a working RTCP port, just RTP.
         """
         self.needSTUN=needSTUN
+        self.latch = bool(self.app.getPref('rtp_latch'))
         d = defer.Deferred()
         self._socketCompleteDef = d
-        self._socketCreationAttempt(locIP)
+        muxPort = self.app.getPref('rtp_mux_port')
+        if muxPort:
+            self._muxSocketAttempt(locIP, muxPort)
+        else:
+            self._socketCreationAttempt(locIP)
         return d
 
+    def _muxSocketAttempt(self, locIP, muxPort):
+        """ Multiplexed mode - rather than our own sockets, share one
+            with every other call (see shtoom.rtp.mux). RTCP is muxed
+            onto the same port.
+        """
+        from shtoom.rtp import rtcp
+        from shtoom.rtp.mux import getSharedSocket
+        self.RTCP = rtcp.RTCPProtocol()
+        self._shared = getSharedSocket(muxPort)
+        self.transport = self._shared.register(self)
+        self.RTCP.transport = self.transport
+        self.rtcpMux = True
+        if self.needSTUN is False:
+            self._extIP, self._extRTPPort = locIP, self._shared.port
+            d = self._socketCompleteDef
+            del self._socketCompleteDef
+            d.callback(self.cookie)
+        else:
+            # The shared socket is only mapped once, for all calls
+            d = self._shared.getMapping()
+            d.addCallbacks(self._cb_muxMapped, self._eb_muxMapped)
+
+    def _cb_muxMapped(self, addr):
+        log.msg("rtp mux: shared socket is visible as %r"%(addr,),
+                                                        system='rtp')
+        self._extIP, self._extRTPPort = addr
+        d = self._socketCompleteDef
+        del self._socketCompleteDef
+        d.callback(self.cookie)
+
+    def _eb_muxMapped(self, failure):
+        log.msg("rtp mux: couldn't map the shared socket: %s"%(
+                            failure.getErrorMessage(),), system='rtp')
+        d = self._socketCompleteDef
+        del self._socketCompleteDef
+        d.errback(failure)
+
     def _socketCreationAttempt(self, locIP=None):
-        from twisted.internet.error import CannotListenError
         from shtoom.rtp import rtcp
+        from shtoom.rtp.portpool import getPortPool
+        from shtoom.exceptions import RTPPortsExhausted
         self.RTCP = rtcp.RTCPProtocol()
 
         # RTP port must be even, RTCP must be odd
-        # We select a RTP port at random, and try to get a pair of ports
-        # next to each other. What fun!
-        # Note that it's kinda pointless when we're behind a NAT that
-        # rewrites ports. We can at least send RTCP out in that case,
+        # The port pool hands us the next free pair of ports next to each
+        # other. Note that it's kinda pointless when we're behind a NAT
+        # that rewrites ports. We can at least send RTCP out in that case,
         # but there's no way we'll get any back.
-        rtpPort = self.app.getPref('force_rtp_port')
-        if not rtpPort:
-            rtpPort = 11000 + random.randint(0, 9000)
-        if (rtpPort % 2) == 1:
-            rtpPort += 1
-        while True:
-            try:
-                self.rtpListener = reactor.listenUDP(rtpPort, self)
-            except CannotListenError:
-                rtpPort += 2
-                continue
-            else:
-                break
-        rtcpPort = rtpPort + 1
-        while True:
-            try:
-                self.rtcpListener = reactor.listenUDP(rtcpPort, self.RTCP)
-            except CannotListenError:
-                # Not quite right - if it fails, re-do the RTP listen
-                self.rtpListener.stopListening()
-                rtpPort = rtpPort + 2
-                rtcpPort = rtpPort + 1
-                continue
-            else:
-                break
+        self._portPool = getPortPool(self.app)
+        try:
+            (rtpPort, self.rtpListener, self.rtcpListener) = \
+                    self._portPool.listenPair(self, self.RTCP,
+                                    preferred=self.app.getPref('force_rtp_port'))
+        except RTPPortsExhausted:
+            d = self._socketCompleteDef
+            del self._socketCompleteDef
+            d.errback()
+            return
+        self._rtpPort = rtpPort
         #self.rtpListener.stopReading()
         if self.needSTUN is False:
             # The pain can stop right here
@@ -155,7 +212,7 @@ class RTPProtocol(DatagramProtocol):
 
     def unmapRTP(self):
         from shtoom.nat import getMapper
-        if self.needSTUN is False:
+        if self.needSTUN is False or self._shared is not None:
             return defer.succeed(None)
         # Currently removing an already-fired trigger doesn't hurt,
         # but this seems likely to change.
@@ -215,6 +272,8 @@ class RTPProtocol(DatagramProtocol):
                             self.rtpListener.stopListening).addCallback(
                                     lambda x:self.rtcpListener.stopListening()
                                                           ).addCallback(
+                                    lambda x:self._releasePorts()
+                                                          ).addCallback(
                                     lambda x:self._socketCreationAttempt()
                                                           )
                 #self.rtpListener.stopListening()
@@ -239,23 +298,39 @@ class RTPProtocol(DatagramProtocol):
 
     def stopSendingAndReceiving(self):
         self.Done = 1
+        if self._shared is not None:
+            self._shared.unregister(self)
+            return
         d = self.unmapRTP()
         d.addCallback(lambda x: self.rtpListener.stopListening())
         d.addCallback(lambda x: self.rtcpListener.stopListening())
+        d.addCallback(lambda x: self._releasePorts())
+
+    def _releasePorts(self):
+        "Hand our RTP/RTCP ports back to the pool"
+        if self._rtpPort is not None:
+            port, self._rtpPort = self._rtpPort, None
+            self._portPool.release(port)
 
     def _send_packet(self, pt, data, marker=0, xhdrtype=None, xhdrdata=''):
-        packet = RTPPacket(self.ssrc, self.seq, self.ts, data, pt=pt,
+        if xhdrtype is None:
+            n = pack_rtp_into(self._sendbuf, self.ssrc, self.seq, self.ts,
+                              pt, data, marker)
+            bytes = buffer(self._sendbuf, 0, n)
+        else:
+            packet = RTPPacket(self.ssrc, self.seq, self.ts, data, pt=pt,
                                     marker=marker,
                                     xhdrtype=xhdrtype, xhdrdata=xhdrdata)
+            bytes = packet.netbytes()
 
         self.seq += 1
-        # Note that seqno gets modulo 2^16 in RTPPacket, so it doesn't need
+        # Note that seqno gets modulo 2^16 when packed, so it doesn't need
         # to be wrapped at 16 bits here.
         if self.seq >= TWO_TO_THE_48TH:
             self.seq = self.seq - TWO_TO_THE_48TH
 
         try:
-            self.transport.write(packet.netbytes(), self.dest)
+            self.transport.write(bytes, self.dest)
         except Exception, le:
             pass
 
@@ -281,16 +356,73 @@ class RTPProtocol(DatagramProtocol):
 
         self.Done = False
         self.sending = True
-        if hasattr(self.transport, 'connect'):
+        if self._shared is not None:
+            self._shared.setRemote(self, dest)
+        elif self.latch:
+            # A connected socket would drop packets from anywhere else
+            self._latchPending = True
+        elif hasattr(self.transport, 'connect'):
             self.transport.connect(*self.dest)
 
         # Now send a single CN packet to seed any firewalls that might
         # need an outbound packet to let the inbound back.
         self._send_cn_packet(logit=True)
 
+    def latchOnto(self, addr):
+        "Send to addr, where the far end's first packet came from"
+        self._latchPending = False
+        if addr != self.dest:
+            log.msg("rtp: latching %r onto %s:%d"%(self.cookie,
+                                        addr[0], addr[1]), system='rtp')
+            self.dest = addr
+
+    def looksLikeOurRTP(self, datagram):
+        "Worth latching onto: RTP, in a payload type the SDP agreed"
+        return (len(datagram) >= 12 and (ord(datagram[0]) & 0xc0) == 0x80
+                and (ord(datagram[1]) & 0x7f) in self.ptdict)
+
+    def _latchOntoRTP(self, batch):
+        # Not onto just anything - a stray datagram would take the
+        # call's media (and any relayed stream) with it
+        for datagram, addr in batch:
+            if self.looksLikeOurRTP(datagram):
+                self.latchOnto(addr)
+                return
+
     def datagramReceived(self, datagram, addr, t=time):
-        packet = parse_rtppacket(datagram)
+        if self._latchPending:
+            self._latchOntoRTP(((datagram, addr),))
+        if self.relay is not None:
+            self.relay.relayDatagrams(self, ((datagram, addr),))
+            return
+        try:
+            packet = parse_rtppacket(datagram)
+        except (struct.error, ValueError):
+            self.badPackets += 1
+            return
+        self._handle_packet(packet)
+
+    def datagramsReceived(self, batch):
+        "A batch of (datagram, addr) drained from the socket in one go"
+        if self._latchPending:
+            self._latchOntoRTP(batch)
+        if self.relay is not None:
+            self.relay.relayDatagrams(self, batch)
+            return
+        handle = self._handle_packet
+        for datagram, addr in batch:
+            # One bad packet mustn't lose the rest of the batch
+            try:
+                packet = parse_rtppacket(datagram)
+            except (struct.error, ValueError):
+                self.badPackets += 1
+                continue
+            try:
+                handle(packet)
+            except:
+                log.deferr()
 
+    def _handle_packet(self, packet):
         try:
             packet.header.ct = self.ptdict[packet.header.pt]
         except KeyError:
@@ -337,6 +469,10 @@ class RTPProtocol(DatagramProtocol):
         ts = ts & (2**32 - 1)
         return ts
 
+    def canSendNTE(self):
+        "Did the other end agree to RFC 2833 DTMF events?"
+        return PT_NTE in self.ptdict
+
     def startDTMF(self, digit):
         self._pendingDTMF.append(NTE(digit, self.ts))
 
@@ -356,6 +492,44 @@ class RTPProtocol(DatagramProtocol):
             hex = m.hexdigest()
         return int(hex[:bits//4],16)
 
+    def _send_pending_dtmf(self):
+        payload = self._pendingDTMF[0].getPayload(self.ts)
+        if payload:
+            ntept = self.ptdict.get(PT_NTE)
+            if ntept is not None:
+                self._send_packet(pt=ntept, data=payload)
+            else:
+                print "no PT_NTE? can't send packet", payload
+            if self._pendingDTMF[0].isDone():
+                self._pendingDTMF = self._pendingDTMF[1:]
+
+    def handle_relayed_packet(self, packet):
+        """ Send packet, an RTPPacket received on another RTP session,
+            without decoding it. The payload goes out untouched - only the
+            SSRC, sequence number and timestamp are rewritten, and the
+            timestamps keep the spacing the sender gave them.
+        """
+        if self.Done or not self.sending:
+            return
+        h = packet.header
+        pt = self.ptdict.get(h.ct)
+        if pt is None:
+            log.msg('trying to relay packet with CT %r, which was not in the negotiated SDP'%(h.ct,), system='rtp')
+            return
+        if h.ssrc != self._relaySSRC or self.ts != self._relayTS:
+            # A new stream, or we've sent audio of our own since the
+            # last one - carry on from our own timestamp.
+            self._relaySSRC = h.ssrc
+            self._relayOffset = self.ts - h.ts
+        self.ts = (h.ts + self._relayOffset) % TWO_TO_THE_32ND
+        self._silent = None
+        self._send_packet(pt, packet.getPayloadBuffer(), marker=h.marker)
+        if self._pendingDTMF:
+            self._send_pending_dtmf()
+        # Leave room for this packet's audio, should our own follow it
+        self.ts = (self.ts + 160) % TWO_TO_THE_32ND
+        self._relayTS = self.ts
+
     def handle_media_sample(self, sample):
         if self.Done:
             if self._cbDone:
@@ -399,15 +573,7 @@ class RTPProtocol(DatagramProtocol):
         # Now send any pending DTMF keystrokes
         if self._pendingDTMF:
             incrTS = True
-            payload = self._pendingDTMF[0].getPayload(self.ts)
-            if payload:
-                ntept = self.ptdict.get(PT_NTE)
-                if ntept is not None:
-                    self._send_packet(pt=ntept, data=payload)
-                else:
-                    print "no PT_NTE? can't send packet", payload
-                if self._pendingDTMF[0].isDone():
-                    self._pendingDTMF = self._pendingDTMF[1:]
+            self._send_pending_dtmf()
 
         if incrTS:
             self.ts += 160
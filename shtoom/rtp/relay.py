@@ -0,0 +1,170 @@
+# Copyright (C) 2005 Anthony Baxter
+
+""" RTP media relay.
+
+    When Doug is a B2BUA that just joins two calls together, there's no
+    need for the media to be decoded, buffered and encoded again - each
+    call's packets can be sent straight out on the other call. An
+    RTPRelay pairs the RTPProtocols of two calls: the datagrams each one
+    receives are written out of the other's socket, to the other's far
+    end, as soon as they arrive. No RTPPacket is built, no codec is
+    touched, and nothing runs off the media clock.
+
+    The only change made to a packet is its payload type number, and
+    only if the two calls' SDP gave the same codec different numbers.
+    The SSRC, sequence numbers and timestamps are left alone - to the
+    far end, the relayed stream is a new source, and its numbering is
+    continuous.
+
+    To send each call's media to wherever its far end's packets come
+    from (for far ends behind a NAT), set the rtp_latch preference.
+
+    RTCP is not relayed: each call's RTCP ends at its RTPProtocol.
+"""
+
+import struct
+
+from twisted.python import log
+
+# seq, then (skipping the timestamp) the SSRC
+_seqSSRCStruct = struct.Struct('!H4xI')
+
+class RelayDirection:
+    "The packets from one call that are sent out on the other"
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self._ptmap = self._makePTMap(src.ptdict, dst.ptdict)
+        self.packets = 0
+        self.bytes = 0
+        # Datagrams we couldn't send, or that weren't RTP
+        self.dropped = 0
+        # For the loss count - see RFC 3550, appendix A.1
+        self._ssrc = None
+        self._baseSeq = self._maxSeq = None
+        self._cycles = 0
+        self._received = 0
+        # Packets expected from the SSRCs we're no longer hearing
+        self._expectedBefore = 0
+        self._receivedBefore = 0
+
+    def _makePTMap(self, srcpt, dstpt):
+        """ A table from the second byte of a packet from src (marker bit
+            and payload type) to what it should be when sent by dst, or
+            None if the two calls number every payload type the same.
+        """
+        table = []
+        changed = False
+        for pt in range(128):
+            ct = srcpt.get(pt)
+            out = pt
+            if ct is not None:
+                out = dstpt.get(ct, pt)
+            if out != pt:
+                changed = True
+            table.append(out)
+        if not changed:
+            return None
+        return ''.join([ chr(pt) for pt in table ] +
+                       [ chr(pt | 128) for pt in table ])
+
+    def relay(self, batch, unpack_from=_seqSSRCStruct.unpack_from):
+        dst = self.dst
+        dest = dst.dest
+        if dst.Done or dest is None:
+            self.dropped += len(batch)
+            return
+        write = dst.transport.write
+        ptmap = self._ptmap
+        for datagram, addr in batch:
+            if len(datagram) < 12 or (ord(datagram[0]) & 0xc0) != 0x80:
+                # Not RTP
+                self.dropped += 1
+                continue
+            seq, ssrc = unpack_from(datagram, 2)
+            if ssrc != self._ssrc:
+                self._newSource(ssrc, seq)
+            else:
+                delta = (seq - self._maxSeq) & 0xffff
+                if 0 < delta < 0x8000:
+                    if seq < self._maxSeq:
+                        self._cycles += 0x10000
+                    self._maxSeq = seq
+            self._received += 1
+            if ptmap is not None:
+                datagram = (datagram[0] + ptmap[ord(datagram[1])] +
+                            datagram[2:])
+            try:
+                write(datagram, dest)
+            except Exception:
+                self.dropped += 1
+                continue
+            self.packets += 1
+            self.bytes += len(datagram)
+
+    def _newSource(self, ssrc, seq):
+        if self._ssrc is not None:
+            self._expectedBefore += self._expected()
+            self._receivedBefore += self._received
+        self._ssrc = ssrc
+        self._baseSeq = self._maxSeq = seq
+        self._cycles = 0
+        self._received = 0
+
+    def _expected(self):
+        if self._ssrc is None:
+            return 0
+        return self._cycles + self._maxSeq - self._baseSeq + 1
+
+    def getLost(self):
+        "Packets lost before they got to us (never less than 0)"
+        expected = self._expectedBefore + self._expected()
+        received = self._receivedBefore + self._received
+        return max(expected - received, 0)
+
+    def getStats(self):
+        return { 'packets': self.packets,
+                 'bytes': self.bytes,
+                 'lost': self.getLost(),
+                 'dropped': self.dropped,
+               }
+
+class RTPRelay:
+    "Relays the media of two calls to each other"
+
+    def __init__(self, rtp1, rtp2):
+        if rtp1 is rtp2:
+            raise ValueError("can't relay %r to itself"%(rtp1,))
+        self._directions = { rtp1: RelayDirection(rtp1, rtp2),
+                             rtp2: RelayDirection(rtp2, rtp1) }
+        self.rtps = (rtp1, rtp2)
+        for rtp in self.rtps:
+            if rtp.relay is not None:
+                rtp.relay.stop()
+            rtp.relay = self
+        log.msg("relaying RTP between %r and %r"%(rtp1.cookie, rtp2.cookie),
+                                                        system='rtp')
+
+    def relayDatagrams(self, rtp, batch):
+        "Called by rtp with the datagrams it's received"
+        direction = self._directions.get(rtp)
+        if direction is not None:
+            direction.relay(batch)
+
+    def getStats(self):
+        """ Returns a dictionary of call cookie -> the counts for the
+            packets received on that call and sent on the other: packets,
+            bytes, lost (before they reached us) and dropped (by us).
+        """
+        stats = {}
+        for rtp, direction in self._directions.items():
+            stats[rtp.cookie] = direction.getStats()
+        return stats
+
+    def stop(self):
+        "Stop relaying - each call's packets go back to its own app"
+        for rtp in self.rtps:
+            if rtp.relay is self:
+                rtp.relay = None
+        self._directions = {}
@@ -202,6 +202,15 @@ class EchoRTP:
             reactor.callLater(0, lambda : self.app.incomingRTP(self.cookie,
                                                               packet))
 
+class FakeLeg:
+    "A fake Leg, that keeps the Sources that tell it they're done"
+
+    def __init__(self):
+        self.done = []
+
+    def _sourceDone(self, source):
+        self.done.append(source)
+
 def main():
     from shtoom.app.phone import Phone
     import sys
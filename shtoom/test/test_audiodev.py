@@ -55,3 +55,34 @@ class AudioDevsTest(unittest.TestCase):
         m.reopen()
         m.close()
         a_(m.playout is None)
+
+    def test_pull(self):
+        from shtoom.audio import getAudioDevice
+        from shtoom.audio.baseaudio import PULL_PRIME_BYTES
+        ae = self.assertEquals
+
+        dummymod = _dummy()
+        dev = FakeDevice()
+        dev.pull = True
+        dummymod.Device = lambda: dev
+        m = getAudioDevice(dummymod)
+        m.close()
+        m.selectDefaultFormat([PT_PCMU,])
+        m.reopen()
+        ae(dev.playout, m.playout)
+        ae(m.playout.pullmode, True)
+        reads = []
+        supply = ['', '\x00' * 2000, '\x00' * 320]
+        class FakePlayout:
+            def read(self, nbytes):
+                reads.append(nbytes)
+                return supply.pop(0)[:nbytes]
+        dev.playout = FakePlayout()
+        # The device asks for its priming audio on top of what it needs,
+        # and for anything it was short last time, until it's caught up.
+        ae(dev._pull_audio(320), '')
+        ae(len(dev._pull_audio(320)), 320 + PULL_PRIME_BYTES)
+        ae(len(dev._pull_audio(320)), 320)
+        ae(reads, [320 + PULL_PRIME_BYTES, 320 + PULL_PRIME_BYTES, 320])
+        m.close()
+        ae(dev.playout, None)
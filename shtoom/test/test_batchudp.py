@@ -0,0 +1,56 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.batchudp
+"""
+
+import socket, errno
+
+from twisted.trial import unittest
+
+from shtoom.batchudp import BatchPort
+
+class FakeSocket:
+    def __init__(self, datagrams):
+        self.datagrams = datagrams
+    def recvfrom(self, size):
+        if not self.datagrams:
+            raise socket.error(errno.EAGAIN, 'would block')
+        return self.datagrams.pop(0)
+
+class BatchProtocol:
+    def __init__(self):
+        self.batches = []
+    def datagramsReceived(self, batch):
+        self.batches.append(batch)
+
+class SingleProtocol:
+    def __init__(self):
+        self.got = []
+    def datagramReceived(self, data, addr):
+        self.got.append(data)
+
+class BatchUDPTest(unittest.TestCase):
+
+    def _port(self, proto, datagrams, budget):
+        p = BatchPort(0, proto)
+        p.readBudget = budget
+        p.socket = FakeSocket([ (d, ('127.0.0.1', 1)) for d in datagrams ])
+        return p
+
+    def test_batching(self):
+        ae = self.assertEquals
+        proto = BatchProtocol()
+        p = self._port(proto, ['a', 'b', 'c', 'd', 'e'], 3)
+        p.doRead()
+        ae([ d for (d, a) in proto.batches[0] ], ['a', 'b', 'c'])
+        p.doRead()
+        ae([ d for (d, a) in proto.batches[1] ], ['d', 'e'])
+        # Nothing waiting, no empty batches
+        p.doRead()
+        ae(len(proto.batches), 2)
+
+    def test_fallback(self):
+        ae = self.assertEquals
+        proto = SingleProtocol()
+        p = self._port(proto, ['a', 'b'], 64)
+        p.doRead()
+        ae(proto.got, ['a', 'b'])
@@ -3,6 +3,8 @@ from twisted.trial import unittest
 
 from shtoom.audio.converters import Codecker, _Codec, MediaLayer, DougConverter
 from shtoom.audio.converters import MulawCodec, NullCodec, PassthruCodec
+from shtoom.audio.converters import FrameBuffer, splitFrames
+from shtoom.audio.converters import CodecPool, CodecSet
 from shtoom.rtp.formats import PT_PCMU, PT_RAW, PT_CN, PT_QCELP, PT_GSM, PT_SPEEX
 from shtoom.rtp.packets import RTPPacket
 
@@ -38,6 +40,31 @@ class CodecTest(unittest.TestCase):
         ae(c.getDefaultFormat(), PT_PCMU)
         ar(ValueError, Codecker, PT_QCELP)
 
+    def testCodecPool(self):
+        a_ = self.assert_
+        ae = self.assertEquals
+        class Stateful(_Codec):
+            def __init__(self):
+                _Codec.__init__(self, 4)
+        pool = CodecPool({PT_PCMU: MulawCodec, PT_GSM: Stateful})
+        ae(pool.acquire(PT_QCELP), None)
+        # Nothing's created until it's asked for
+        ae(pool.getStats()['created'], 0)
+        c1, c2 = CodecSet(pool), CodecSet(pool)
+        a_(c1.get(PT_PCMU) is c2.get(PT_PCMU))
+        s1, s2 = c1.get(PT_GSM), c2.get(PT_GSM)
+        a_(s1 is not s2)
+        ae(pool.getStats(), {'created': 3, 'free': 0})
+        s1.buffer_and_encode('ab')
+        c1.release()
+        ae(c1.values(), [])
+        ae(pool.getStats()['free'], 1)
+        # A released codec is reused, without its old buffered audio
+        c3 = CodecSet(pool)
+        a_(c3.get(PT_GSM) is s1)
+        ae(len(s1.b), 0)
+        ae(pool.getStats(), {'created': 3, 'free': 0})
+
     def testNullCodec(self):
         ae = self.assertEquals
         ar = self.assertRaises
@@ -68,6 +95,31 @@ class CodecTest(unittest.TestCase):
 
         c.handle_audio('farnarkling')
 
+    def testFrameBuffer(self):
+        ae = self.assertEquals
+        b = FrameBuffer(4)
+        b.write('abc')
+        ae(b.frames(), ('', 0))
+        b.write('defghij')
+        ae(b.frames(), ('abcdefgh', 2))
+        ae(len(b), 2)
+        b.write('kl' + 'x' * 401)
+        data, count = b.frames()
+        ae(count, 101)
+        ae(data[:6], 'ijklxx')
+        ae(len(b), 1)
+        ae(splitFrames('aabbcc', 3), ['aa', 'bb', 'cc'])
+
+    def testMuLawBatch(self):
+        if codecs.mulaw is None:
+            raise unittest.SkipTest("no mulaw support")
+        ae = self.assertEquals
+        m = MulawCodec()
+        frames = m.buffer_and_encode(instr * 3 + instr[:100])
+        ae(len(frames), 3)
+        ae(frames, [m._encode(instr)] * 3)
+        ae(len(m.buffer_and_encode(instr[100:])), 1)
+
     # XXX testing other codecs - endianness issues? crap.
 
     def testMuLawCodec(self):
@@ -156,5 +208,20 @@ class CodecTest(unittest.TestCase):
         p = RTPPacket(0, 0, 0, data=test, ct=PT_RAW)
         ae(d.convertInbound(p), test)
 
+    def testDougConverterClose(self):
+        ae = self.assertEquals
+        d = DougConverter()
+        codecs = d.codecker.format_to_codec
+        p = RTPPacket(0, 0, 0, data='\xff'*160, ct=PT_PCMU)
+        ae(len(d.convertInbound(p)), 320)
+        d.close()
+        ae(codecs.values(), [])
+        # Packets that turn up after the call's over don't take codecs
+        # back out of the pool
+        ae(d.convertInbound(p), None)
+        ae(d.convertOutbound('\0'*320), None)
+        ae(codecs.values(), [])
+        ae((d.closed, d.format), (True, PT_PCMU))
+
 
 ulawout = '\x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 \x9f\x87\x07 '
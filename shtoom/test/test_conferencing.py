@@ -0,0 +1,181 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.conferencing
+"""
+
+import struct
+from sets import Set
+
+from twisted.trial import unittest
+
+from shtoom.doug.conferencing import Room, ConfSource
+from shtoom.doug.conferencing import mixMinusOne, fitFrame, FRAME_BYTES
+from shtoom.rtp.formats import PT_PCMU, PT_PCMA, PT_CN
+from shtoom.audio import g711
+
+def frame(*samples):
+    "A frame of the given samples, repeated"
+    samples = samples * (FRAME_BYTES // (2 * len(samples)))
+    return struct.pack('%dh'%len(samples), *samples)
+
+def samples(bytes):
+    return struct.unpack('%dh'%(len(bytes)//2), bytes)
+
+class FakeLeg:
+    "Just enough of a leg (and its dialog) for a ConfSource"
+    def getDialog(self):
+        return self
+    def getRemoteTag(self):
+        return self
+    def getURI(self):
+        return 'sip:someone@example.com'
+
+class FakeHeader:
+    def __init__(self, ct):
+        self.ct = ct
+
+class FakePacket:
+    def __init__(self, ct, data):
+        self.header = FakeHeader(ct)
+        self.data = data
+
+class MixTest(unittest.TestCase):
+
+    def test_mixMinusOne(self):
+        ae = self.assertEquals
+        total, others = mixMinusOne([frame(100), frame(-20), frame(7)])
+        ae(samples(total)[0], 87)
+        ae([ samples(o)[0] for o in others ], [-13, 107, 80])
+        ae(len(total), FRAME_BYTES)
+
+    def test_clipping(self):
+        ae = self.assertEquals
+        # Clipped once, at the end - not after each addition
+        total, others = mixMinusOne([frame(30000), frame(30000),
+                                     frame(-30000), frame(-32768, 32767)])
+        ae(samples(total)[:2], (-2768, 32767))
+        ae([ samples(o)[:2] for o in others ],
+           [(-32768, 32767), (-32768, 32767), (27232, 32767),
+            (30000, 30000)])
+
+    def test_lengths(self):
+        ae = self.assertEquals
+        ae(mixMinusOne([]), ('', []))
+        ae(mixMinusOne([frame(5)]), (frame(5), ['']))
+        short = frame(10)[:100]
+        total, others = mixMinusOne([short, frame(1) + frame(2)])
+        ae(len(total), FRAME_BYTES)
+        ae(samples(total)[49:51], (11, 1))
+        ae(fitFrame('ab', 4), 'ab\0\0')
+
+class RoomTest(unittest.TestCase):
+
+    def setUp(self):
+        self.room = Room('testroom', MaxSpeakers=2)
+
+    def tearDown(self):
+        if self.room.isOpen():
+            self.room.shutdown()
+
+    def member(self):
+        return ConfSource(self.room, FakeLeg())
+
+    def test_speakers(self):
+        ae = self.assertEquals
+        room = self.room
+        loud, medium, quiet, silent = [ self.member() for x in range(4) ]
+        loud.write(frame(3000))
+        medium.write(frame(2000))
+        quiet.write(frame(10))
+        room.mixAudio()
+        ae(samples(room.readAudio(loud))[0], 2000)
+        ae(samples(room.readAudio(medium))[0], 3000)
+        # Not one of the two loudest, so hears them both
+        ae(samples(room.readAudio(quiet))[0], 5000)
+        ae(room.readAudio(silent), room.readAudio(quiet))
+
+    def test_alone(self):
+        room = self.room
+        m = self.member()
+        m.write(frame(1000))
+        room.mixAudio()
+        self.assertEquals(room.readAudio(m), '')
+
+    def test_quietSkipped(self):
+        ae = self.assertEquals
+        room = self.room
+        talker, quiet = self.member(), self.member()
+        # Below the VAD threshold, so not mixed at all
+        quiet.write(frame(50) * 3)
+        talker.write(frame(1000))
+        room.mixAudio()
+        ae(room._speakers, Set([talker]))
+        ae(samples(room.readAudio(talker)), ())
+        ae(samples(room.readAudio(quiet))[0], 1000)
+        # Once they've nothing more to say, they're not looked at
+        for i in range(200):
+            room.mixAudio()
+        ae(room._live, Set())
+        talker.write(frame(1000))
+        ae(room._live, Set([talker]))
+
+    def test_hysteresis(self):
+        ae = self.assertEquals
+        room = Room('testroom2', MaxSpeakers=1)
+        try:
+            a, b = ConfSource(room, FakeLeg()), ConfSource(room, FakeLeg())
+            for i in range(10):
+                a.write(frame(2000))
+                room.mixAudio()
+            ae(room._speakers, Set([a]))
+            # A click from b doesn't take over
+            a.write(frame(2000))
+            b.write(frame(5000))
+            room.mixAudio()
+            ae(room._speakers, Set([a]))
+            # but someone talking over a for long enough does
+            for i in range(5):
+                a.write(frame(2000))
+                b.write(frame(5000))
+                room.mixAudio()
+            ae(room._speakers, Set([b]))
+        finally:
+            room.shutdown()
+
+    def test_encodedInput(self):
+        ae = self.assertEquals
+        room = self.room
+        a, b = self.member(), self.member()
+        ulaw = g711.encode(PT_PCMU, frame(4000))
+        # A 40ms packet, taken a frame at a time
+        a.writeEncoded(FakePacket(PT_PCMU, ulaw * 2))
+        room.mixAudio()
+        out = samples(room.readAudio(b))
+        ae(len(out), FRAME_BYTES // 2)
+        self.assert_(3900 < out[0] < 4100)
+        room.mixAudio()
+        ae(room.readAudio(b), room._audioOutDefault)
+        self.assert_(room.readAudio(b))
+        # Comfort noise is ignored
+        a.writeEncoded(FakePacket(PT_CN, 'x'))
+        ae(a.getFrameForRoom(), None)
+
+    def test_sharedEncoding(self):
+        ae = self.assertEquals
+        a_ = self.assert_
+        room = self.room
+        speaker, l1, l2 = [ self.member() for x in range(3) ]
+        speaker.write(frame(3000))
+        room.mixAudio()
+        ae(room.readEncoded(speaker, PT_PCMU), None)
+        s1 = room.readEncoded(l1, PT_PCMU)
+        ae(s1.ct, PT_PCMU)
+        ae(len(s1.data), 160)
+        # One encode, shared by every listener using the codec
+        a_(room.readEncoded(l2, PT_PCMU) is s1)
+        a_(room.readEncoded(l2, PT_PCMA) is not s1)
+        speaker.write(frame(3000))
+        room.mixAudio()
+        a_(room.readEncoded(l1, PT_PCMU) is not s1)
+        # Nothing to encode when there's silence
+        room.mixAudio()
+        ae(room.readEncoded(l1, PT_PCMU), None)
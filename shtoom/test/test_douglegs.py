@@ -6,13 +6,32 @@ from twisted.internet import defer
 from shtoom.doug.leg import Bridge, BridgeSource, Leg
 
 class FakeLegForBridging:
+    sink = None
+
+    def __init__(self, format=None):
+        self.format = format
+        self.relayed = []
+
     def _connectSource(self, source):
         source.leg = self
         self.source = source
 
+    def _connectSink(self, sink):
+        self.sink = sink
+
     def _sourceDone(self, source):
         self.source = None
 
+    def _sinkDone(self, sink):
+        if self.sink is sink:
+            self.sink = None
+
+    def getFormat(self):
+        return self.format
+
+    def _relayPacket(self, packet):
+        self.relayed.append(packet)
+
     def mediaStop(self):
         self.source.close()
 
@@ -42,6 +61,76 @@ class DougLegTests(unittest.TestCase):
         ae(l1.source, None)
         ae(l2.source, None)
 
+    def testLegBridgingPassthrough(self):
+        from shtoom.rtp.formats import PT_PCMU, PT_PCMA
+        from shtoom.rtp.packets import RTPPacket
+        ae = self.assertEquals
+        l1 = FakeLegForBridging(PT_PCMU)
+        l2 = FakeLegForBridging(PT_PCMU)
+        b = Bridge(leg1=l1, leg2=l2)
+        ae(l1.sink, l1.source)
+        ae(l2.source.passthrough, False)
+        # Packets go straight to the other leg
+        p1 = RTPPacket(1, 1, 160, '\xff'*160, pt=0, ct=PT_PCMU)
+        p2 = RTPPacket(2, 1, 160, '\xff'*160, pt=0, ct=PT_PCMU)
+        l1.sink.writeEncoded(p1)
+        l2.sink.writeEncoded(p2)
+        ae(l2.relayed, [p1])
+        ae(l1.relayed, [p2])
+        ae(l2.source.passthrough, True)
+        ae(l1.source.passthrough, True)
+        # Different codecs: the audio is decoded and copied
+        l2.format = PT_PCMA
+        l1.sink.writeEncoded(p1)
+        ae(l2.relayed, [p1])
+        ae(l2.source.passthrough, False)
+        ae(l2.read(), '\0\0'*160)
+        l2.mediaStop()
+        ae(l1.source, None)
+        ae(l1.sink, None)
+        ae(l2.sink, None)
+
+    def testBridgedLegsRelay(self):
+        from shtoom.rtp.formats import PT_PCMU, PT_PCMA
+        from shtoom.rtp.packets import RTPPacket
+        from shtoom.audio import g711
+        from shtoom.audio.clock import getMediaClock
+        ae = self.assertEquals
+        class FakeVoiceApp:
+            def __init__(self):
+                self.sent = []
+                self.relayed = []
+            def va_outgoingRTP(self, sample, cookie):
+                self.sent.append((cookie, sample))
+            def va_relayRTP(self, packet, cookie):
+                self.relayed.append((cookie, packet))
+        v = FakeVoiceApp()
+        l1 = Leg('c1', None, voiceapp=v)
+        l2 = Leg('c2', None, voiceapp=v)
+        try:
+            Bridge(l1, l2)
+            packet = RTPPacket(1, 1, 160, '\xff'*160, pt=0, ct=PT_PCMU)
+            l1.leg_incomingRTP(packet)
+            ae(v.relayed, [('c2', packet)])
+            # Nothing's read or encoded on the media clock's ticks
+            l2._get_some_audio()
+            ae(v.sent, [])
+            # l2 sends PCMU - so PCMA from l1 has to be transcoded
+            packet = RTPPacket(1, 2, 320, '\xd5'*160, pt=8, ct=PT_PCMA)
+            l1.leg_incomingRTP(packet)
+            ae(len(v.relayed), 1)
+            l2._get_some_audio()
+            # G.711 is encoded at the end of the tick
+            batch = g711.getBatch()
+            batch.run()
+            ae(len(v.sent), 1)
+            cookie, sample = v.sent[0]
+            ae((cookie, sample.ct, len(sample.data)), ('c2', PT_PCMU, 160))
+        finally:
+            getMediaClock().remove(g711.getBatch().run)
+            l1._stopAudio()
+            l2._stopAudio()
+
     def test_legConstructor(self):
         from shtoom.sip import Dialog
         ae = self.assertEquals
@@ -0,0 +1,295 @@
+"Tests for running Doug's media in a process of its own"
+
+from twisted.trial import unittest, util
+from twisted.internet import defer, reactor
+
+from shtoom.doug.mediaserver import MediaServer, MediaClient, MediaCall
+from shtoom.doug.mediaserver import packLine, unpackLine
+from shtoom.doug.mediaserver import formatName, formatFromName
+from shtoom.doug.events import MediaPlayContentDoneEvent, DTMFReceivedEvent
+
+class RecordingTransport:
+    "Keeps the lines written to it"
+    disconnecting = False
+    def __init__(self):
+        self.lines = []
+    def write(self, data):
+        self.lines.extend(data.split('\n')[:-1])
+    def setTcpNoDelay(self, on):
+        pass
+
+class Pipe(RecordingTransport):
+    "Hands what's written straight to the other end"
+    def __init__(self, other):
+        RecordingTransport.__init__(self)
+        self.other = other
+    def write(self, data):
+        RecordingTransport.write(self, data)
+        self.other.dataReceived(data)
+
+class FakeMediaApp:
+    "What the media process needs of a DougApplication: preferences"
+    def getPref(self, pref, default=None):
+        return default
+
+class FakeSignalingApp:
+    def __init__(self):
+        self.dtmf = []
+        self.dropped = []
+    def incomingDTMF(self, cookie, key, start):
+        self.dtmf.append((cookie, key, start))
+    def dropCall(self, cookie):
+        self.dropped.append(cookie)
+
+class FakeVoiceApp:
+    def __init__(self):
+        self.events = []
+        self.hungup = []
+    def _triggerEvent(self, event):
+        self.events.append(event)
+    def va_hangupCall(self, cookie):
+        self.hungup.append(cookie)
+
+class FakeDialog:
+    def getRemoteTag(self):
+        return self
+    def getURI(self):
+        return 'sip:bob@10.0.0.9'
+
+class FakeRTPTransport:
+    def __init__(self):
+        self.sent = []
+    def write(self, datagram, addr):
+        self.sent.append((str(datagram), addr))
+
+class FakePacket:
+    def __init__(self, ct, data):
+        self.header = self
+        self.ct = ct
+        self.data = data
+
+def makeSDP(port=4000):
+    from shtoom.rtp.formats import SDPGenerator
+    class DummyRTP:
+        def getVisibleAddress(self):
+            return ('10.0.0.9', port)
+    return SDPGenerator().getSDP(DummyRTP())
+
+def wait(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    util.wait(d)
+
+class MediaServerTest(unittest.TestCase):
+
+    def testLines(self):
+        ae = self.assertEquals
+        line = packLine('play', 'CallCookie1', 'my prompt.raw', '100%\n', 3)
+        ae(line, 'play CallCookie1 my%20prompt.raw 100%25%0A 3')
+        ae(unpackLine(line), ['play', 'CallCookie1', 'my prompt.raw',
+                              '100%\n', '3'])
+
+    def testFormatNames(self):
+        from shtoom.rtp.formats import PT_PCMU, PT_GSM, PT_DVI4_16K
+        ae = self.assertEquals
+        for fmt in PT_PCMU, PT_GSM, PT_DVI4_16K:
+            self.failUnless(formatFromName(formatName(fmt)) is fmt)
+        ae(formatName(PT_PCMU), 'PT_PCMU')
+        self.assertRaises(ValueError, formatFromName, 'SDPGenerator')
+        self.assertRaises(ValueError, formatFromName, 'PT_NOSUCH')
+
+    def testRemoteLeg(self):
+        from shtoom.doug.tones import digitTones, secondsToFrames
+        from shtoom.doug.source import EchoSource
+        ae = self.assertEquals
+        app = FakeSignalingApp()
+        client = MediaClient(app)
+        client.makeConnection(RecordingTransport())
+        sent = client.transport.lines
+        v = FakeVoiceApp()
+        leg = client.newLeg('c1', None, voiceapp=v)
+        # The media process hasn't said yet
+        self.assertRaises(ValueError, leg.getFormat)
+        leg.mediaPlay('hello.raw')
+        ae(leg.isPlaying(), True)
+        leg.mediaPlay(['a.raw', digitTones('1'), 'b.raw'])
+        digit, gap = secondsToFrames(0.1), secondsToFrames(0.05)
+        ae(sent, ['play c1 hello.raw', 'play c1 a.raw',
+                  'tones c1 0 1 %d - %d'%(digit, gap), 'play c1 b.raw'])
+        # Only played out when the last thing queued has been
+        client.lineReceived('played c1 1')
+        ae(v.events, [])
+        client.lineReceived('played c1 4')
+        ae(len(v.events), 1)
+        ae(v.events[0].__class__, MediaPlayContentDoneEvent)
+        ae((v.events[0].source, v.events[0].leg), ('b.raw', leg))
+        ae(leg.isPlaying(), False)
+        # Once stopped, the queue's done with
+        leg.mediaPlay('x.raw')
+        leg.mediaStop()
+        ae(leg.isPlaying(), False)
+        client.lineReceived('played c1 5')
+        ae(len(v.events), 1)
+        ae(sent[-2:], ['play c1 x.raw', 'stop c1'])
+        # Sources here can't be played there
+        del sent[:]
+        self.assertRaises(ValueError, leg.mediaPlay, ['y.raw', EchoSource()])
+        ae(sent, [])
+        # Recording
+        rec = leg.mediaRecord('msg.rec', encoded=True)
+        ae(leg.isRecording(), True)
+        closed = []
+        leg.mediaStopRecording().addCallback(closed.append)
+        ae(leg.isRecording(), False)
+        ae(sent, ['record c1 %s 1 msg.rec'%(rec.id,),
+                  'close c1 %s'%(rec.id,)])
+        ae(closed, [])
+        client.lineReceived('closed c1 %s'%(rec.id,))
+        ae(closed, [None])
+        # DTMF
+        leg.dtmfMode(single=True, inband=True)
+        ae(sent[-1], 'dtmfmode c1 1 1')
+        client.lineReceived('digits c1 123%23')
+        ae(v.events[-1].__class__, DTMFReceivedEvent)
+        ae((v.events[-1].digits, v.events[-1].leg), ('123#', leg))
+        client.lineReceived('keydown c1 5')
+        client.lineReceived('keyup c1 5')
+        ae(app.dtmf, [('c1', '5', True), ('c1', '5', False)])
+        client.lineReceived('drop c1')
+        ae(app.dropped, ['c1'])
+        # Hanging up
+        leg.hangupCall()
+        ae(sent[-1], 'hangup c1')
+        ae(v.hungup, ['c1'])
+        client.lineReceived('load ticks 50 overruns 1 lastTickTime 0.004')
+        ae(client.getStats(), { 'ticks': 50, 'overruns': 1,
+                                'lastTickTime': 0.004 })
+
+    def testMediaCall(self):
+        from shtoom.rtp.formats import PT_NTE
+        from urllib import quote
+        ae = self.assertEquals
+        server = MediaServer(FakeMediaApp())
+        server.makeConnection(RecordingTransport())
+        sent = server.transport.lines
+        call = server.calls['c1'] = MediaCall(server, 'c1')
+        try:
+            call.rtp.transport = FakeRTPTransport()
+            server.lineReceived('sdp c1 %s'%(quote(makeSDP().show(), ''),))
+            self.failUnless(call.rtp.canSendNTE())
+            server.lineReceived('start c1 10.0.0.9 4000')
+            ae(call.rtp.dest, ('10.0.0.9', 4000))
+            # Two frames of a tone, then it's done
+            server.lineReceived('tones c1 0 1 2')
+            ae(call.leg.isPlaying(), True)
+            packets = len(call.rtp.transport.sent)
+            for i in range(3):
+                call.leg._get_some_audio()
+            # The tone's frames, as PCMU, then comfort noise
+            pts = [ ord(d[1]) & 127 for (d, addr) in
+                                        call.rtp.transport.sent[packets:] ]
+            ae(pts, [0, 0, 13])
+            ae(sent, ['played c1 1'])
+            # DTMF, both ways
+            server.lineReceived('startdtmf c1 5')
+            ae(len(call.rtp._pendingDTMF), 1)
+            # (read the way DougApplication.incomingRTP reads them)
+            server.incomingRTP('c1', FakePacket(PT_NTE, '\x05\x8a\x00\xa0'))
+            server.incomingRTP('c1', FakePacket(PT_NTE, '\x05\x0a\x01\x40'))
+            ae(sent[1:], ['keydown c1 5', 'keyup c1 5'])
+            # Calls that have gone
+            server.lineReceived('close c9 7')
+            server.lineReceived('play c9 x.raw')
+            ae(sent[3:], ['closed c9 7'])
+            # Hung up by the voiceapp: the audio stops now, and the
+            # signaling process isn't told to drop the call again
+            server.lineReceived('hangup c1')
+            ae(call.leg.clock, None)
+            ae(sent[4:], [])
+        finally:
+            call.leg._stopAudio()
+
+    def testBridge(self):
+        ae = self.assertEquals
+        server = MediaServer(FakeMediaApp())
+        server.makeConnection(RecordingTransport())
+        calls = [ MediaCall(server, c) for c in ('c1', 'c2') ]
+        try:
+            for call in calls:
+                server.calls[call.cookie] = call
+            server.lineReceived('bridge c1 c2')
+            ae([ c.leg.isPlaying() for c in calls ], [True, True])
+            server.lineReceived('stop c1')
+            ae([ c.leg.isPlaying() for c in calls ], [False, False])
+        finally:
+            for call in calls:
+                call.leg._stopAudio()
+
+    def testConnected(self):
+        from shtoom.doug.conferencing import newConferenceMember
+        from shtoom.doug.conferencing import _RegisterOfAllRooms
+        ae = self.assertEquals
+        app = FakeSignalingApp()
+        server = MediaServer(FakeMediaApp())
+        client = MediaClient(app)
+        # Commands sent before the connection's made are kept
+        rtp = client.newRTP('c1')
+        opened = []
+        rtp.createRTPSocket('127.0.0.1').addCallback(opened.append)
+        server.makeConnection(Pipe(client))
+        client.makeConnection(Pipe(server))
+        ae(opened, ['c1'])
+        call = server.calls['c1']
+        ae(rtp.getVisibleAddress(), call.rtp.getVisibleAddress())
+        rtp.getSDP(makeSDP())
+        ae(call.rtp.ptdict, rtp.ptdict)
+        leg = client.newLeg('c1', FakeDialog(), voiceapp=FakeVoiceApp())
+        self.failUnless(leg.getFormat() is call.leg.getFormat())
+        # A conference, in the media process
+        conf = newConferenceMember('testroom', leg)
+        leg.mediaPlay([conf])
+        leg.mediaRecord(conf)
+        ae(_RegisterOfAllRooms['testroom'].memberCount(), 1)
+        ae((call.leg.isPlaying(), call.leg.isRecording()), (True, True))
+        closed = []
+        conf.close().addCallback(closed.append)
+        ae(closed, [None])
+        ae(call.leg.isRecording(), None)
+        ae(_RegisterOfAllRooms.has_key('testroom'), False)
+        rtp.stopSendingAndReceiving()
+        ae(server.calls, {})
+        self.failUnless(call.rtp.Done)
+        # Still known once the call's over
+        self.failUnless(leg.getFormat() is call.leg.getFormat())
+        # Let the sockets close
+        wait(0.1)
+
+    def testSocketPair(self):
+        import socket
+        from shtoom.doug.mediaserver import _PairConnection
+        ae = self.assertEquals
+        server = MediaServer(FakeMediaApp())
+        client = MediaClient(FakeSignalingApp())
+        a, b = socket.socketpair()
+        conns = [ _PairConnection(a, server, 'MediaServer'),
+                  _PairConnection(b, client, 'MediaClient') ]
+        try:
+            rtp = client.newRTP('c1')
+            opened = []
+            rtp.createRTPSocket('127.0.0.1').addCallback(opened.append)
+            for i in range(20):
+                if opened:
+                    break
+                wait(0.05)
+            ae(opened, ['c1'])
+            ae(rtp.getVisibleAddress(),
+               server.calls['c1'].rtp.getVisibleAddress())
+            rtp.stopSendingAndReceiving()
+            wait(0.05)
+            ae(server.calls, {})
+        finally:
+            # Without losing the connection - that stops the reactor
+            for conn in conns:
+                conn.stopReading()
+                conn.socket.close()
+        wait(0.1)
@@ -0,0 +1,219 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.source
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import log
+
+from shtoom.doug import source
+from shtoom.doug.source import MappedFileSource, FileSource, convertToSource
+from shtoom.doug.source import RecordingSource
+from shtoom.test.harness import FakeLeg
+
+class MappedFileSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.name = os.path.abspath('mapped.raw')
+        fp = open(self.name, 'wb')
+        fp.write('a' * 320 + 'b' * 100)
+        fp.close()
+
+    def tearDown(self):
+        os.unlink(self.name)
+
+    def test_shared(self):
+        ae = self.assertEquals
+        a_ = self.assert_
+        s1 = convertToSource(self.name)
+        s2 = convertToSource(self.name)
+        a_(isinstance(s1, MappedFileSource))
+        # one mapping, two users
+        a_(s1._mapping is s2._mapping)
+        ae(s1._mapping.refs, 2)
+        leg = FakeLeg()
+        s1.leg = leg
+        # Frames are strings, not buffers onto the mapping
+        ae('' + s1.read(), 'a' * 320)
+        ae(s1.read(), 'b' * 100)
+        ae(s1.read(), None)
+        ae(leg.done, [s1])
+        ae(s2._mapping.refs, 1)
+        s2.close()
+        s2.close()
+        ae(source._mappings, {})
+
+    def test_empty(self):
+        open(self.name, 'wb').close()
+        s = convertToSource(self.name)
+        self.assert_(isinstance(s, FileSource))
+        s.close()
+
+class FakeFile:
+    def __init__(self):
+        self.data = []
+        self.closed = False
+    def write(self, data):
+        self.data.append(data)
+    def close(self):
+        self.closed = True
+
+class FakeThreads:
+    "Runs the jobs when told to, rather than in threads"
+    def __init__(self):
+        self.jobs = []
+    def __call__(self, f, *args):
+        d = defer.Deferred()
+        self.jobs.append((f, args, d))
+        return d
+    def runOne(self):
+        f, args, d = self.jobs.pop(0)
+        defer.maybeDeferred(f, *args).chainDeferred(d)
+
+class RecordingSourceTest(unittest.TestCase):
+
+    def test_blocks(self):
+        ae = self.assertEquals
+        fp = FakeFile()
+        r = RecordingSource(fp, blockSize=640, maxQueued=1280)
+        r.runInThread = t = FakeThreads()
+        r.write('a' * 320)
+        ae(t.jobs, [])
+        r.write('b' * 320)
+        ae(len(t.jobs), 1)
+        # While that block's being written, more audio queues up...
+        r.write('c' * 320)
+        r.write('d' * 320)
+        ae(r.getStats()['queued'], 1280)
+        # ... and anything over the limit is dropped
+        r.write('e' * 320)
+        ae(r.getStats()['dropped'], 320)
+        t.runOne()
+        ae(fp.data, ['a' * 320 + 'b' * 320])
+        # the next block goes straight away
+        t.runOne()
+        r.close()
+        ae(r.isRecording(), False)
+        t.runOne()
+        ae(fp.closed, True)
+        ae(''.join(fp.data), 'a' * 320 + 'b' * 320 + 'c' * 320 + 'd' * 320)
+        stats = r.getStats()
+        ae(stats['written'], 1280)
+        ae(stats['blocks'], 2)
+        ae(stats['queued'], 0)
+
+    def test_closeFlushes(self):
+        ae = self.assertEquals
+        fp = FakeFile()
+        r = RecordingSource(fp)
+        r.runInThread = t = FakeThreads()
+        r.write('a' * 320)
+        r.close()
+        t.runOne()
+        ae(fp.data, ['a' * 320])
+        t.runOne()
+        ae(fp.closed, True)
+
+    def test_writeFailed(self):
+        ae = self.assertEquals
+        class FullDisk(FakeFile):
+            def write(self, data):
+                raise IOError(28, 'No space left on device')
+        fp = FullDisk()
+        r = RecordingSource(fp, blockSize=640)
+        r.runInThread = t = FakeThreads()
+        r.leg = leg = FakeLeg()
+        r.write('a' * 640)
+        t.runOne()
+        ae(len(log.flushErrors(IOError)), 1)
+        ae(leg.done, [r])
+        # Nothing more is queued for the broken file
+        r.write('b' * 640)
+        ae((t.jobs, r.getStats()['queued']), ([], 0))
+        r.close()
+        t.runOne()
+        ae(fp.closed, True)
+
+class FakeHeader:
+    def __init__(self, ct, ts):
+        self.ct, self.ts = ct, ts
+
+class FakePacket:
+    def __init__(self, ct, ts, data):
+        self.header = FakeHeader(ct, ts)
+        self.data = data
+
+class EncodedRecordingTest(unittest.TestCase):
+
+    def test_recordAndPlay(self):
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEquals
+        name = os.path.abspath('encoded.rec')
+        r = convertToSource(name, 'w', encoded=True)
+        ae(r.wantsEncoded, True)
+        r.runInThread = defer.execute
+        for n in range(3):
+            r.writeEncoded(FakePacket(PT_PCMU, n * 160, '\xff' * 160))
+        closed = []
+        r.close().addCallback(closed.append)
+        ae(closed, [None])
+        # Half the size of the audio, with the headers and index
+        self.failUnless(os.path.getsize(name) < 3 * 320 * 0.6)
+        s = convertToSource(name)
+        s.leg = leg = FakeLeg()
+        ae(s.read(), '\x00' * 320)
+        s.read()
+        s.read()
+        ae(s.read(), None)
+        ae(leg.done, [s])
+        os.unlink(name)
+
+    def test_playThroughLeg(self):
+        from shtoom.doug.leg import Leg
+        from shtoom.doug.promptcache import getPromptCache
+        from shtoom.rtp.packets import RTPPacket
+        from shtoom.rtp.formats import PT_PCMU
+        from shtoom.audio import g711
+        ae = self.assertEquals
+        class FakeVoiceApp:
+            def __init__(self):
+                self.sent = []
+                self.events = []
+            def va_outgoingRTP(self, sample, cookie):
+                if sample is not None:
+                    self.sent.append(sample.data)
+            def _triggerEvent(self, event):
+                self.events.append(event)
+        cache = getPromptCache()
+        # The prompt cache is on, as it is by default
+        self.failUnless(cache.maxBytes)
+        misses = cache.getStats()['misses']
+        name = os.path.abspath('leg.rec')
+        frames = [ ''.join([ chr((n * 50 + i) & 0xff) for i in range(160) ])
+                                                        for n in range(3) ]
+        v = FakeVoiceApp()
+        leg = Leg('c1', None, voiceapp=v)
+        batch = g711.getBatch()
+        try:
+            r = leg.mediaRecord(name, encoded=True)
+            r.runInThread = defer.execute
+            for n, data in enumerate(frames):
+                leg.leg_incomingRTP(RTPPacket(1, n, n * 160, data, pt=0,
+                                              ct=PT_PCMU))
+            leg.mediaStopRecording()
+            leg.mediaPlay(name)
+            while not v.events:
+                leg._get_some_audio()
+                batch.run()
+        finally:
+            leg._stopAudio()
+            # Let the batch leave the media clock
+            batch.run()
+            batch.run()
+            os.unlink(name)
+        # The recording was decoded, not encoded as if it were audio
+        ae(g711.decode(PT_PCMU, ''.join(v.sent)),
+           g711.decode(PT_PCMU, ''.join(frames)))
+        ae(cache.getStats()['misses'], misses)
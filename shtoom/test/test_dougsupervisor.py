@@ -0,0 +1,240 @@
+"Tests for multi-process Doug's SIP dispatcher"
+
+from twisted.trial import unittest
+
+from shtoom.doug.supervisor import SipDispatcher, WorkerInfo, WorkerChannel
+from shtoom.doug.supervisor import parseSIP, splitPortRange, packSIP
+from shtoom.doug.supervisor import unpackFrame, TRANSACTION_TIMEOUT
+
+def message(first, callid, cseq, extra=''):
+    return ('%s\r\nVia: SIP/2.0/UDP 10.0.0.9:5060;branch=z9hG4bK1\r\n'
+            'From: <sip:a@10.0.0.9>;tag=1\r\nTo: <sip:doug@10.0.0.1>\r\n'
+            'Call-ID: %s\r\nCSeq: %s\r\n%s\r\nv=0\r\n'%(first, callid,
+                                                         cseq, extra))
+
+def invite(callid):
+    return message('INVITE sip:doug@10.0.0.1 SIP/2.0', callid, '1 INVITE')
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+    def write(self, datagram, addr):
+        self.sent.append((datagram, addr))
+
+class FakeClock:
+    now = 1000.0
+    def __call__(self):
+        return self.now
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.workers = [ WorkerInfo(i, maxCalls=10) for i in range(3) ]
+        self.d = SipDispatcher(self.workers, clock=self.clock)
+        self.d.transport = FakeTransport()
+        self.d.workerSide.transport = FakeTransport()
+        for w in self.workers:
+            self.report(w.index, 0)
+
+    def report(self, index, calls, tickload=0.1, overruns=0):
+        self.d.workerDatagramReceived('LOAD %d %d %0.3f %d\n'%(index, calls,
+                                tickload, overruns), ('127.0.0.1', 7000+index))
+
+    def routed(self):
+        "The workers the dispatcher has passed datagrams to, in order"
+        return [ addr[1] - 7000 for (d, addr) in
+                                        self.d.workerSide.transport.sent ]
+
+    def testParseSIP(self):
+        ae = self.assertEquals
+        ae(parseSIP(invite('abc@host')), ('INVITE', None, 'abc@host',
+                                          'INVITE'))
+        resp = 'SIP/2.0 200 OK\r\ni: xyz\r\ncseq: 2 bye\r\n\r\n'
+        ae(parseSIP(resp), (None, 200, 'xyz', 'BYE'))
+        # Only the headers are looked at
+        ae(parseSIP('BYE sip:x SIP/2.0\r\n\r\nCall-ID: body'),
+           ('BYE', None, None, None))
+
+    def testSplitPortRange(self):
+        ae = self.assertEquals
+        ae(splitPortRange(11000, 20000, 3), [(11000, 14000), (14000, 17000),
+                                             (17000, 20000)])
+        ae(splitPortRange(11001, 11011, 2), [(11002, 11006), (11006, 11010)])
+        self.assertRaises(ValueError, splitPortRange, 11000, 11004, 4)
+
+    def testFraming(self):
+        ae = self.assertEquals
+        frame = packSIP(('10.0.0.9', 5060), 'SIP/2.0 200 OK\r\n\r\n')
+        ae(unpackFrame(frame), ('SIP', ['10.0.0.9', '5060'],
+                                'SIP/2.0 200 OK\r\n\r\n'))
+        self.assertRaises(ValueError, unpackFrame, 'no newline')
+
+    def testDialogsStick(self):
+        ae = self.assertEquals
+        addr = ('10.0.0.9', 5060)
+        callids = [ 'call%d@10.0.0.9'%i for i in range(12) ]
+        for callid in callids:
+            self.d.datagramReceived(invite(callid), addr)
+        first = self.routed()
+        # Spread across the workers, by hash
+        ae(len(dict.fromkeys(first)), 3)
+        # Frames carry the far end's address
+        kind, args, body = unpackFrame(self.d.workerSide.transport.sent[0][0])
+        ae((kind, args, body), ('SIP', ['10.0.0.9', '5060'],
+                                invite(callids[0])))
+        # A worker gets overloaded - its calls stay with it
+        self.report(first[0], 0, tickload=0.9)
+        for callid in callids:
+            self.d.datagramReceived(message('BYE sip:doug@10.0.0.1 SIP/2.0',
+                                            callid, '2 BYE'), addr)
+        ae(self.routed()[12:], first)
+        ae(self.d.stats['in'], 24)
+
+    def testLoadAvoidance(self):
+        ae = self.assertEquals
+        addr = ('10.0.0.9', 5060)
+        callid = 'busy@10.0.0.9'
+        self.d.datagramReceived(invite(callid), addr)
+        home = self.routed()[0]
+        self.d.expireDialogs()
+        ae(self.d.dialogCount(), 1)
+        # The same Call-ID, were it new, would go elsewhere while its
+        # worker is full
+        del self.d._dialogs[callid]
+        self.report(home, 10)
+        self.d.datagramReceived(invite(callid), addr)
+        ae(self.routed()[1], (home + 1) % 3)
+        # All full - the least loaded gets it
+        del self.d._dialogs[callid]
+        self.report(0, 10, tickload=0.5)
+        self.report(1, 10, tickload=0.2)
+        self.report(2, 12, tickload=0.3)
+        self.d.datagramReceived(invite(callid), addr)
+        ae(self.routed()[2], 1)
+        # No reports for a while: no one's healthy, so the call's refused
+        del self.d._dialogs[callid]
+        self.clock.now += 10
+        self.d.datagramReceived(invite(callid), addr)
+        ae(len(self.routed()), 3)
+        resp, dest = self.d.transport.sent[0]
+        ae(dest, addr)
+        ae(parseSIP(resp), (None, 503, callid, 'INVITE'))
+        ae(self.d.stats['rejected'], 1)
+
+    def testWorkerRequests(self):
+        ae = self.assertEquals
+        far = ('10.0.0.20', 5060)
+        # A worker places a call - the dispatcher sends it out, and the
+        # replies come back to that worker
+        out = message('INVITE sip:bob@10.0.0.20 SIP/2.0', 'out@doug',
+                      '1 INVITE')
+        self.d.workerDatagramReceived(packSIP(far, out), ('127.0.0.1', 7002))
+        ae(self.d.transport.sent, [(out, far)])
+        for i in range(5):
+            self.d.datagramReceived(message('SIP/2.0 200 OK', 'out@doug',
+                                            '1 INVITE'), far)
+        ae(self.routed(), [2] * 5)
+        # Frames from unknown workers are dropped
+        self.d.workerDatagramReceived(packSIP(far, out), ('127.0.0.1', 1))
+        self.d.workerDatagramReceived('garbage', ('127.0.0.1', 7000))
+        ae(len(self.d.transport.sent), 1)
+        ae(self.d.stats['bad'], 2)
+
+    def testDialogExpiry(self):
+        ae = self.assertEquals
+        addr = ('10.0.0.9', 5060)
+        self.d.datagramReceived(invite('c1'), addr)
+        self.d.datagramReceived(invite('c2'), addr)
+        self.d.datagramReceived(message('OPTIONS sip:doug@10.0.0.1 SIP/2.0',
+                                        'c3', '1 OPTIONS'), addr)
+        worker = self.routed()[0]
+        # c1 is answered and later hung up; c2 is refused
+        for resp, callid, cseq in (('200 OK', 'c1', '1 INVITE'),
+                                   ('200 OK', 'c1', '2 BYE'),
+                                   ('486 Busy Here', 'c2', '1 INVITE')):
+            self.d.workerDatagramReceived(packSIP(addr,
+                        message('SIP/2.0 '+resp, callid, cseq)),
+                        ('127.0.0.1', 7000 + self.d.getWorkerFor(callid).index))
+        self.d.expireDialogs()
+        ae(self.d.dialogCount(), 3)
+        self.clock.now += TRANSACTION_TIMEOUT + 1
+        for w in self.workers:
+            self.report(w.index, 0)
+        self.d.expireDialogs()
+        ae(self.d.dialogCount(), 0)
+        # A confirmed call outlives a failed re-INVITE
+        self.d.datagramReceived(invite('c4'), addr)
+        w = self.d.getWorkerFor('c4')
+        for resp in '200 OK', '491 Request Pending':
+            self.d.workerDatagramReceived(packSIP(addr,
+                        message('SIP/2.0 '+resp, 'c4', '1 INVITE')),
+                        ('127.0.0.1', 7000 + w.index))
+        self.clock.now += TRANSACTION_TIMEOUT + 1
+        self.d.expireDialogs()
+        ae(self.d.getWorkerFor('c4'), w)
+        # A dead worker's calls are forgotten
+        w.dead = True
+        self.d.expireDialogs()
+        ae(self.d.dialogCount(), 0)
+
+    def testWorkerChannel(self):
+        ae = self.assertEquals
+        class FakeSip:
+            def __init__(self):
+                self.got = []
+            def datagramReceived(self, datagram, addr):
+                self.got.append((datagram, addr))
+        class FakeApp:
+            sip = FakeSip()
+            def getCallCount(self):
+                return 3
+            def getMediaStats(self):
+                return { 'overruns': 2, 'members': 4, 'lastTickTime': 0.01 }
+        app = FakeApp()
+        dispatcher = ('127.0.0.1', 6000)
+        c = WorkerChannel(app, 1, dispatcher)
+        c.transport = FakeTransport()
+        c.datagramReceived(packSIP(('10.0.0.9', 5060), 'hello'), dispatcher)
+        c.datagramReceived(packSIP(('10.0.0.9', 5060), 'spoof'),
+                           ('10.0.0.9', 5060))
+        ae(app.sip.got, [('hello', ('10.0.0.9', 5060))])
+        c.sendSIP('reply', ('10.0.0.9', 5060))
+        c.report()
+        ae(c.transport.sent[0], (packSIP(('10.0.0.9', 5060), 'reply'),
+                                 dispatcher))
+        kind, args, body = unpackFrame(c.transport.sent[1][0])
+        ae((kind, args), ('LOAD', ['1', '3', '0.500', '2']))
+
+class ForkTest(unittest.TestCase):
+
+    def testCleanForkedReactor(self):
+        import os, socket
+        from twisted.internet import reactor
+        from twisted.internet.protocol import DatagramProtocol
+        from shtoom.doug.supervisor import cleanForkedReactor
+        ae = self.assertEquals
+        port = reactor.listenUDP(0, DatagramProtocol(), interface='127.0.0.1')
+        waker = reactor.waker
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            result = 'failed'
+            try:
+                cleanForkedReactor()
+                try:
+                    port.socket.fileno()
+                except socket.error:
+                    if reactor.waker not in (None, waker):
+                        result = 'ok'
+            finally:
+                os.write(w, result)
+                os._exit(0)
+        os.close(w)
+        got = os.read(r, 100)
+        os.close(r)
+        os.waitpid(pid, 0)
+        ae(got, 'ok')
+        # The parent's own are left alone
+        self.failUnless(reactor.waker is waker)
+        return port.stopListening()
@@ -7,13 +7,36 @@ def getDTMFAudioFile():
     from twisted.python.util import sibpath
     return sibpath(__file__, 'dtmftestfile.raw')
 
+def tone(key, samples=320, amplitude=8192):
+    "Generate a DTMF tone without numarray"
+    import math, struct
+    from shtoom.doug import dtmf
+    f1, f2 = dtmf.dtmf2freq[key]
+    w1 = 2 * math.pi * f1 / dtmf.HZ
+    w2 = 2 * math.pi * f2 / dtmf.HZ
+    return struct.pack('%dh'%samples, *[
+        int(amplitude * (math.sin(w1 * n) + math.sin(w2 * n)))
+                                                for n in range(samples) ])
+
+class FakeLeg:
+    def __init__(self):
+        self.events = []
+    def leg_startDTMFevent(self, digit):
+        self.events.append(('start', digit))
+    def leg_stopDTMFevent(self, digit):
+        self.events.append(('stop', digit))
+
+class FakeClock:
+    def __init__(self):
+        self.members = []
+    def add(self, callable, priority):
+        self.members.append(callable)
+    def remove(self, callable):
+        self.members.remove(callable)
+    def isMember(self, callable):
+        return callable in self.members
+
 class DTMFDetectTest(unittest.TestCase):
-    def setUp(self):
-        try:
-            import numarray
-            import numarray.fft
-        except:
-            raise unittest.SkipTest('numarray needed for dtmf detection')
 
     def test_dtmfdetection_canned(self):
         from shtoom.doug.dtmf import DtmfDetector
@@ -82,3 +105,68 @@ class DTMFDetectTest(unittest.TestCase):
             silence = '\0'*320
             for frame in codec.buffer_and_encode(silence):
                 codec.decode(frame)
+
+    def test_tones(self):
+        from shtoom.doug import dtmf
+        ae = self.assertEquals
+        detect = dtmf.DtmfDetector()
+        keys = dtmf.dtmf2freq.keys()
+        for k in keys:
+            ae(detect.detect(tone(k)), k)
+            # Too quiet
+            ae(detect.detect(tone(k, amplitude=50)), '')
+        ae(detect.detectMany([ tone(k) for k in keys ] + ['\0' * 640]),
+           keys + [''])
+        self.assertRaises(ValueError, detect.detect, tone('1', 160))
+
+    def test_notDigits(self):
+        import math, struct
+        from shtoom.doug import dtmf
+        ae = self.assertEquals
+        detect = dtmf.DtmfDetector()
+        def wave(*freqs):
+            ws = [ (2 * math.pi * f / dtmf.HZ, a) for (f, a) in freqs ]
+            return struct.pack('320h', *[
+                int(sum([ a * math.sin(w * n) for (w, a) in ws ]))
+                                                for n in range(320) ])
+        # One tone
+        ae(detect.detect(wave((1000, 8000))), '')
+        ae(detect.detect(wave((697, 8000))), '')
+        # Two rows at once
+        ae(detect.detect(wave((697, 6000), (770, 6000), (1209, 6000))), '')
+        # Too much twist
+        ae(detect.detect(wave((697, 1000), (1209, 8000))), '')
+        # A digit, but drowned out by something else
+        ae(detect.detect(wave((697, 4000), (1209, 4000), (400, 8000))), '')
+
+    def test_inband(self):
+        from shtoom.doug.leg import InbandDtmfDetector
+        ae = self.assertEquals
+        leg = FakeLeg()
+        d = InbandDtmfDetector(leg)
+        silence = '\0' * 320
+        # 20ms and 40ms packets both work
+        for packet in silence, tone('5', 640), silence, \
+                      silence, tone('9', 480), silence, silence, silence:
+            d(packet)
+        ae(leg.events, [('start', '5'), ('stop', '5'),
+                        ('start', '9'), ('stop', '9')])
+
+    def test_batch(self):
+        from shtoom.doug.leg import InbandDtmfDetector
+        from shtoom.doug.dtmf import DtmfBatch
+        ae = self.assertEquals
+        clock = FakeClock()
+        b = DtmfBatch(clock)
+        legs = [ FakeLeg(), FakeLeg() ]
+        dets = [ InbandDtmfDetector(l, b) for l in legs ]
+        dets[0](tone('1', 320))
+        dets[1](tone('2', 320))
+        ae(b.pending(), 2)
+        ae(legs[0].events, [])
+        b.run()
+        ae(legs[0].events, [('start', '1')])
+        ae(legs[1].events, [('start', '2')])
+        b.run()
+        b.run()
+        ae(clock.members, [])
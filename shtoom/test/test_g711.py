@@ -0,0 +1,94 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.g711
+"""
+
+from twisted.trial import unittest
+
+from shtoom.audio import g711
+from shtoom.audio.g711 import G711Batch, transcode
+from shtoom.rtp.formats import PT_PCMU, PT_PCMA, PT_RAW
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+lin = ''.join([ chr((x * 37) & 0xff) for x in range(640) ])
+
+class FakeClock:
+    def __init__(self):
+        self.members = []
+    def add(self, callable, priority):
+        self.members.append(callable)
+    def remove(self, callable):
+        self.members.remove(callable)
+    def isMember(self, callable):
+        return callable in self.members
+
+class G711Test(unittest.TestCase):
+
+    def setUp(self):
+        if audioop is None:
+            raise unittest.SkipTest("no audioop")
+
+    def test_transcode(self):
+        ae = self.assertEquals
+        ulaw = audioop.lin2ulaw(lin, 2)
+        alaw = audioop.lin2alaw(lin, 2)
+        ae(transcode(PT_RAW, PT_PCMU, lin), ulaw)
+        ae(transcode(PT_RAW, PT_PCMA, lin), alaw)
+        ae(transcode(PT_PCMU, PT_RAW, ulaw), audioop.ulaw2lin(ulaw, 2))
+        ae(transcode(PT_PCMA, PT_RAW, alaw), audioop.alaw2lin(alaw, 2))
+        ae(transcode(PT_PCMU, PT_PCMU, ulaw), ulaw)
+        # Straight between the two laws is the same as going via linear
+        ae(transcode(PT_PCMU, PT_PCMA, ulaw),
+           audioop.lin2alaw(audioop.ulaw2lin(ulaw, 2), 2))
+        ae(transcode(PT_PCMA, PT_PCMU, alaw),
+           audioop.lin2ulaw(audioop.alaw2lin(alaw, 2), 2))
+
+    def test_batch(self):
+        ae = self.assertEquals
+        clock = FakeClock()
+        b = G711Batch(clock)
+        ulaw, alaw = [], []
+        b.add(PT_RAW, PT_PCMU, lin[:320], ulaw.append)
+        b.add(PT_RAW, PT_PCMU, lin[320:], ulaw.append)
+        b.add(PT_PCMU, PT_PCMA, '\x00' * 160, alaw.append)
+        ae(b.pending(), 3)
+        ae(clock.members, [b.run])
+        b.run()
+        ae(b.pending(), 0)
+        ae(len(ulaw), 2)
+        ae(''.join(ulaw), audioop.lin2ulaw(lin, 2))
+        ae(alaw, [g711.ulaw2alaw('\x00' * 160)])
+        # Once there's nothing more to do, it comes off the clock
+        b.run()
+        b.run()
+        ae(clock.members, [])
+
+    def test_codeckerBatched(self):
+        from shtoom.audio.converters import Codecker
+        ae = self.assertEquals
+        clock = FakeClock()
+        b = G711Batch(clock)
+        c = Codecker(PT_PCMU)
+        samples = []
+        c.handle_audio_batched(lin[:100], samples.append, b)
+        # No complete frame yet
+        ae(samples, [None])
+        c.handle_audio_batched(lin[100:], samples.append, b)
+        ae(samples, [None])
+        b.run()
+        ae(len(samples), 3)
+        ae(samples[1].ct, PT_PCMU)
+        ae(samples[1].data + samples[2].data, audioop.lin2ulaw(lin, 2))
+        c.close()
+
+    def test_level(self):
+        ae = self.assertEquals
+        for fmt in PT_PCMU, PT_PCMA:
+            coded = g711.encode(fmt, lin)
+            exact = audioop.rms(g711.decode(fmt, coded), 2)
+            # Within 256 of the true figure
+            self.assert_(abs(g711.level(fmt, coded) - exact) < 256)
+        ae(g711.level(PT_PCMU, g711.encode(PT_PCMU, '\0' * 320)), 0)
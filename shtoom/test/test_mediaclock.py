@@ -0,0 +1,75 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.clock
+"""
+
+from twisted.trial import unittest
+from twisted.python import log
+
+from shtoom.audio.clock import MediaClock, PRIORITY_MIX, PRIORITY_SOURCE
+
+class MediaClockTest(unittest.TestCase):
+
+    def test_ordering(self):
+        ae = self.assertEquals
+        calls = []
+        c = MediaClock()
+        source = lambda: calls.append('source')
+        mixer = lambda: calls.append('mix')
+        c.add(source, PRIORITY_SOURCE)
+        c.add(mixer, PRIORITY_MIX)
+        ae(c.isRunning(), True)
+        ae(c.memberCount(), 2)
+        c.tick()
+        ae(calls, ['mix', 'source'])
+        c.remove(source)
+        ae(c.isRunning(), True)
+        c.remove(mixer)
+        ae(c.isRunning(), False)
+        ae(c.getStats()['ticks'], 1)
+
+    def test_removeDuringTick(self):
+        ae = self.assertEquals
+        calls = []
+        c = MediaClock()
+        def second():
+            calls.append('second')
+        def first():
+            calls.append('first')
+            c.remove(second)
+        c.add(first, PRIORITY_MIX)
+        c.add(second, PRIORITY_SOURCE)
+        c.tick()
+        ae(calls, ['first'])
+        c.remove(first)
+        ae(c.isRunning(), False)
+
+    def test_brokenMember(self):
+        ae = self.assertEquals
+        c = MediaClock()
+        def broken():
+            raise ZeroDivisionError()
+        calls = []
+        ok = lambda: calls.append(1)
+        c.add(broken)
+        c.add(ok)
+        c.tick()
+        log.flushErrors(ZeroDivisionError)
+        ae(c.isMember(broken), False)
+        c.tick()
+        ae(calls, [1, 1])
+        c.remove(ok)
+
+    def test_overrunStats(self):
+        ae = self.assertEquals
+        c = MediaClock()
+        times = [0.0, 0.5]
+        c.add(lambda: None)
+        c.tick(t=lambda: times.pop(0))
+        stats = c.getStats()
+        ae(stats['ticks'], 1)
+        ae(stats['overruns'], 1)
+        ae(stats['maxTickTime'], 0.5)
+        ae(stats['members'], 1)
+        c.resetStats()
+        ae(c.getStats()['overruns'], 0)
+        c.remove(c._order[0])
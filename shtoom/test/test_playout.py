@@ -0,0 +1,150 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.playout
+"""
+
+from twisted.trial import unittest
+
+from shtoom.audio import playout
+from shtoom.audio.playout import Playout, seqdiff
+
+# 20ms of 16 bit 8KHz audio
+PACKETSIZE = 320
+# packets needed to fill the jitter buffer
+FILL = int(playout.JITTER_BUFFER_SECONDS * playout.BYTES_PER_SECOND /
+                                                                PACKETSIZE)
+
+class DummyWriter:
+    def __init__(self):
+        self.b = []
+    def write(self, data):
+        self.b.append(data)
+
+class DummyMediaLayer:
+    def __init__(self):
+        self._d = DummyWriter()
+
+def packet(n):
+    return str(n) + ('\x00' * (PACKETSIZE - len(str(n))))
+
+class PlayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ml = DummyMediaLayer()
+        self.p = Playout(self.ml)
+
+    def tearDown(self):
+        if self.p.nextcheckscheduled:
+            self.p.nextcheckscheduled.cancel()
+
+    def played(self):
+        return [ int(x.rstrip('\x00')) for x in self.ml._d.b ]
+
+    def test_seqdiff(self):
+        ae = self.assertEquals
+        ae(seqdiff(5, 3), 2)
+        ae(seqdiff(3, 5), -2)
+        ae(seqdiff(2, 65534), 4)
+        ae(seqdiff(65534, 2), -4)
+
+    def test_wraparound(self):
+        ae = self.assertEquals
+        seqs = [ (65530 + i) & 0xffff for i in range(FILL + 5) ]
+        for s in seqs[:FILL-1]:
+            self.p.write(packet(s), s)
+        ae(self.p.refillmode, True)
+        ae(self.played(), [])
+        for s in seqs[FILL-1:]:
+            self.p.write(packet(s), s)
+        ae(self.p.refillmode, False)
+        played = self.played()
+        self.failUnless(played)
+        ae(played, seqs[:len(played)])
+
+    def test_reordered(self):
+        ae = self.assertEquals
+        # The first packets arrive out of order, before anything's played
+        order = [2, 1, 0] + range(3, FILL)
+        for s in order:
+            self.p.write(packet(s), s)
+        played = self.played()
+        ae(played, range(len(played)))
+        # A duplicate is ignored
+        self.p.write(packet(FILL-1), FILL-1)
+        ae(len(self.p), FILL - len(played))
+
+    def test_holeInHead(self):
+        ae = self.assertEquals
+        # packet 2 never arrives, so we play from the run after the hole
+        for s in [0, 1] + range(3, FILL + 3):
+            self.p.write(packet(s), s)
+        ae(self.p.refillmode, False)
+        ae(self.played()[0], 3)
+
+    def test_latePacket(self):
+        ae = self.assertEquals
+        for s in range(FILL):
+            self.p.write(packet(s), s)
+        played = self.played()
+        # Anything before what's been played is too late to use
+        self.p.write(packet(60000), 60000)
+        ae(self.played(), played)
+    def test_jitterEstimator(self):
+        ae = self.assertEquals
+        e = playout.JitterEstimator()
+        ae(e.getDelay(), None)
+        # Evenly spaced packets - no jitter
+        for i in range(10):
+            e.update(i * 160, i * 0.02)
+        ae(e.jitter, 0.0)
+        ae(e.getDelay(), 0.0)
+        # One packet arrives 40ms late
+        e.update(10 * 160, 10 * 0.02 + 0.04)
+        ae(e.jitter, 320 / 16.0)
+        ae(e.getDelay(1.0), 0.04)
+        ae(e.getDelay(0.5), 0.0)
+
+    def test_adaptive(self):
+        ae = self.assertEquals
+        self.p = p = playout.AdaptivePlayout(self.ml)
+        ae(p.getTargetDelay(), playout.ADAPTIVE_INITIAL_SECONDS)
+        # A smooth network - at the next talkspurt, the buffer shrinks to
+        # the minimum
+        now = [0.0]
+        clock = lambda: now[0]
+        for s in range(20):
+            now[0] = s * 0.02
+            p.write(packet(s), s, s * 160, s == 0, t=clock)
+        ae(p.refillmode, False)
+        now[0] = 1.0
+        p.write(packet(20), 20, 50 * 160, 1, t=clock)
+        ae(p.getTargetDelay(), playout.ADAPTIVE_MIN_SECONDS)
+        # A jittery one - it grows again
+        for s in range(21, 40):
+            now[0] = 1.0 + (s - 20) * 0.02 + (s % 2) * 0.2
+            p.write(packet(s), s, (s + 30) * 160, 0, t=clock)
+        now[0] = 2.0
+        p.write(packet(40), 40, 100 * 160, 1, t=clock)
+        self.failUnless(p.getTargetDelay() > 0.2)
+        ae(p.refillmode, True)
+
+    def test_pullMode(self):
+        ae = self.assertEquals
+        self.p.pullmode = True
+        # Nothing to play while refilling
+        ae(self.p.read(PACKETSIZE), '')
+        for s in range(FILL):
+            self.p.write(packet(s), s)
+        ae(self.p.refillmode, False)
+        # The device hasn't asked for anything, so nothing's been pushed
+        ae(self.played(), [])
+        ae(self.p.nextcheckscheduled, None)
+        ae(self.p.read(PACKETSIZE), packet(0))
+        # Reads needn't line up with packets
+        ae(self.p.read(PACKETSIZE/2), packet(1)[:PACKETSIZE/2])
+        ae(self.p.read(PACKETSIZE), packet(1)[PACKETSIZE/2:] +
+                                    packet(2)[:PACKETSIZE/2])
+        # Running dry gives back what's there, and goes back to refilling
+        rest = self.p.read(FILL * PACKETSIZE)
+        ae(len(rest), (FILL - 3) * PACKETSIZE + PACKETSIZE/2)
+        ae(self.p.refillmode, True)
+        ae(self.p.read(PACKETSIZE), '')
@@ -0,0 +1,109 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.promptcache
+"""
+
+import os
+
+from twisted.trial import unittest
+
+from shtoom.doug.promptcache import PromptCache, EncodedSource, CachingSource
+from shtoom.doug.source import MappedFileSource
+from shtoom.rtp.formats import PT_PCMU
+from shtoom.test.harness import FakeLeg
+
+class PromptCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.files = []
+
+    def tearDown(self):
+        for f in self.files:
+            os.unlink(f)
+
+    def makePrompt(self, name, frames):
+        name = os.path.abspath(name)
+        fp = open(name, 'wb')
+        # plus a partial frame, which doesn't get played
+        fp.write('\x00\x01' * (160 * frames + 10))
+        fp.close()
+        self.files.append(name)
+        return name
+
+    def play(self, c, name, frames=None):
+        "Play the prompt, or that many frames of it; returns its frames"
+        leg = FakeLeg()
+        s = c.getSource(name, PT_PCMU)
+        s.leg = leg
+        out = []
+        while not leg.done and len(out) != frames:
+            sample = s.readEncoded()
+            if sample is not None:
+                out.append(sample.data)
+        s.close()
+        return s, out
+
+    def test_cache(self):
+        ae = self.assertEquals
+        a_ = self.assert_
+        p1 = self.makePrompt('prompt1.raw', 10)
+        c = PromptCache()
+        # It's encoded from the file's shared mapping
+        s = c.getSource(p1, PT_PCMU)
+        a_(isinstance(s._source, MappedFileSource))
+        s.close()
+        # Nothing's cached until it's been played all the way through
+        s1, f1 = self.play(c, p1, frames=3)
+        a_(isinstance(s1, CachingSource))
+        ae(c.getStats()['prompts'], 0)
+        s1, f1 = self.play(c, p1)
+        ae(len(f1), 10)
+        ae(len(f1[0]), 160)
+        s2, f2 = self.play(c, p1)
+        a_(isinstance(s2, EncodedSource))
+        ae(f2, f1)
+        stats = c.getStats()
+        ae((stats['hits'], stats['misses']), (1, 3))
+        ae(stats['bytes'], 1600)
+        # A changed file is encoded afresh
+        os.utime(p1, (0, 0))
+        a_(isinstance(self.play(c, p1)[0], CachingSource))
+
+    def test_eviction(self):
+        ae = self.assertEquals
+        a_ = self.assert_
+        p1 = self.makePrompt('prompt1.raw', 10)
+        p2 = self.makePrompt('prompt2.raw', 10)
+        p3 = self.makePrompt('prompt3.raw', 10)
+        c = PromptCache(maxBytes=3200)
+        self.play(c, p1)
+        self.play(c, p2)
+        self.play(c, p1)
+        # p2 is the least recently used
+        self.play(c, p3)
+        stats = c.getStats()
+        ae(stats['evictions'], 1)
+        ae(stats['prompts'], 2)
+        self.play(c, p1)
+        ae(c.getStats()['hits'], 2)
+        # Too big to keep at all - it's encoded as it's played, then
+        # played straight from the file after that
+        c.setMaxBytes(1000)
+        s, frames = self.play(c, p1)
+        ae(len(frames), 10)
+        ae(c.getStats()['prompts'], 0)
+        s = c.getSource(p1, PT_PCMU)
+        a_(isinstance(s, MappedFileSource))
+        s.close()
+        ae(c.getStats()['uncached'], 1)
+
+    def test_encodedSource(self):
+        ae = self.assertEquals
+        leg = FakeLeg()
+        s = EncodedSource(['a' * 160, 'b' * 160], PT_PCMU)
+        s.leg = leg
+        ae(s.encoded, PT_PCMU)
+        ae(s.readEncoded().data, 'a' * 160)
+        ae(len(s.read()), 320)
+        ae(s.readEncoded(), None)
+        ae(leg.done, [s])
+        s.close()
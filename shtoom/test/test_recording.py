@@ -0,0 +1,89 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.recording
+"""
+
+from StringIO import StringIO
+
+from twisted.trial import unittest
+
+from shtoom.audio.recording import RecordingWriter, Recording, MAGIC
+from shtoom.rtp.formats import PT_PCMU, PT_CN
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+class RecordingTest(unittest.TestCase):
+
+    def record(self, frames, finish=True):
+        out = []
+        w = RecordingWriter(out.append)
+        for ct, ts, data in frames:
+            w.addFrame(ct, ts, data)
+        if finish:
+            w.finish()
+        return StringIO(''.join(out)), w
+
+    def test_frames(self):
+        ae = self.assertEquals
+        # The RTP timestamp wraps during the recording
+        base = 0xffffffff - 8000
+        frames = [ (PT_PCMU, (base + n * 160) & 0xffffffff, chr(n) * 160)
+                                                    for n in range(200) ]
+        fp, w = self.record(frames + [(PT_CN, 0, 'x')])
+        ae(w.frames, 200)
+        # An index entry a second
+        ae(len(w.index), 4)
+        r = Recording(fp)
+        ae(r.index, w.index)
+        got = list(r.frames())
+        ae(len(got), 200)
+        ae(got[0], (0, PT_PCMU, '\x00' * 160))
+        ae(got[-1], (199 * 160, PT_PCMU, chr(199) * 160))
+        # Seeking starts at the index entry before
+        got = list(r.frames(start=16100))
+        ae(got[0][0], 16000)
+
+    def test_unfinished(self):
+        ae = self.assertEquals
+        frames = [ (PT_PCMU, n * 160, 'a' * 160) for n in range(10) ]
+        fp, w = self.record(frames, finish=False)
+        # and the last frame was only half written
+        fp = StringIO(fp.getvalue()[:-80])
+        r = Recording(fp)
+        ae(r.index, [])
+        ae(len(list(r.frames())), 9)
+
+    def test_decode(self):
+        if audioop is None:
+            raise unittest.SkipTest("no audioop")
+        ae = self.assertEquals
+        ulaw = audioop.lin2ulaw('\x10\x00' * 160, 2)
+        # a lost packet in the middle
+        frames = [ (PT_PCMU, 0, ulaw), (PT_PCMU, 320, ulaw) ]
+        fp, w = self.record(frames)
+        out = StringIO()
+        Recording(fp).export(out)
+        pcm = audioop.ulaw2lin(ulaw, 2)
+        ae(out.getvalue(), pcm + '\x00' * 320 + pcm)
+
+    def test_dropped(self):
+        ae = self.assertEquals
+        out = []
+        accept = [True]
+        def write(bytes):
+            if accept[0]:
+                out.append(bytes)
+                return True
+            return False
+        w = RecordingWriter(write)
+        w.addFrame(PT_PCMU, 0, 'a' * 160)
+        accept[0] = False
+        w.addFrame(PT_PCMU, 160, 'b' * 160)
+        accept[0] = True
+        w.addFrame(PT_PCMU, 8000, 'c' * 160)
+        w.finish()
+        r = Recording(StringIO(''.join(out)))
+        ae([ x[2][0] for x in r.frames() ], ['a', 'c'])
+        ae(r.index, [(0, len(MAGIC)), (8000, len(MAGIC) + 7 + 160)])
@@ -69,6 +69,352 @@ class TestRTP(unittest.TestCase):
             ae(rpack.header.ts, ts)
             ae(rpack.header.ssrc, ssrc)
 
+    def testRTPPacketPackInto(self):
+        from shtoom.rtp.packets import RTPPacket, parse_rtppacket
+        from shtoom.rtp.packets import pack_rtp_into
+        ae = self.assertEquals
+
+        data = ''.join([chr(x) for x in range(160)])
+        pack = RTPPacket(100001, 70000, 12345678, data, 0, marker=1)
+        buf = bytearray(1500)
+        n = pack.pack_into(buf)
+        ae(str(buf[:n]), pack.netbytes())
+        n = pack_rtp_into(buf, 100001, 70000, 12345678, 0, data, marker=1)
+        ae(str(buf[:n]), pack.netbytes())
+        rpack = parse_rtppacket(str(buf[:n]))
+        ae(rpack.header.seq, 70000 % 2**16)
+        ae(rpack.header.marker, 1)
+        ae(str(rpack.getPayloadBuffer()), data)
+        ae(rpack.data, data)
+
+        pack = RTPPacket(1, 2, 3, 'abcd', 8, xhdrtype=7, xhdrdata='wxyz')
+        n = pack.pack_into(buf)
+        ae(str(buf[:n]), pack.netbytes())
+        rpack = parse_rtppacket(pack.netbytes())
+        ae(rpack.header.xhdrtype, 7)
+        ae(rpack.header.xhdrdata, 'wxyz')
+        ae(rpack.data, 'abcd')
+
+    def testRTPPacketPadding(self):
+        from shtoom.rtp.packets import parse_rtppacket
+        import struct
+        ae = self.assertEquals
+        # padding bit, one CSRC, 3 bytes of padding and a 2 byte auth tag
+        bytes = struct.pack('!BBHII', 0xa1, 0, 1, 2, 3) + 'CSRC' + \
+                    'payload' + '\0\0\3' + 'AT'
+        rpack = parse_rtppacket(bytes, authtaglen=2)
+        ae(rpack.data, 'payload')
+        ae(rpack.authtag, 'AT')
+        ae(rpack.header.ssrc, 3)
+
+    def testPortPairPool(self):
+        from shtoom.rtp.portpool import PortPairPool
+        from shtoom.exceptions import RTPPortsExhausted
+        from twisted.internet.error import CannotListenError
+        ae = self.assertEquals
+        bound = {}
+        class FakeListener:
+            def __init__(self, port):
+                self.port = port
+            def stopListening(self):
+                del bound[self.port]
+        def listenUDP(port, proto, interface=''):
+            if port in bound or port == 20005:
+                raise CannotListenError(interface, port, 'in use')
+            bound[port] = proto
+            return FakeListener(port)
+
+        pool = PortPairPool(20001, 20010)
+        ae(pool.size(), 4)
+        lU = listenUDP
+        port, rtpL, rtcpL = pool.listenPair('rtp', 'rtcp', listenUDP=lU)
+        ae((port, bound[port], bound[port+1]), (20002, 'rtp', 'rtcp'))
+        # 20005 is taken by someone else, so 20004 is skipped
+        port2, rtpL2, rtcpL2 = pool.listenPair('rtp', 'rtcp', listenUDP=lU)
+        ae(port2, 20006)
+        ae(bound.has_key(20004), False)
+        port3 = pool.listenPair('rtp', 'rtcp', listenUDP=lU)[0]
+        ae(port3, 20008)
+        stats = pool.getStats()
+        ae(stats['inUse'], 3)
+        ae(stats['bindFailures'], 1)
+        # Only the broken pair is left
+        self.assertRaises(RTPPortsExhausted, pool.listenPair, 'rtp', 'rtcp',
+                          listenUDP=lU)
+        rtpL.stopListening(); rtcpL.stopListening()
+        pool.release(port)
+        ae(pool.getStats()['inUse'], 2)
+        ae(pool.listenPair('rtp', 'rtcp', listenUDP=lU)[0], port)
+        # A preferred port, if free, is used first
+        pool.release(port3)
+        del bound[port3], bound[port3+1]
+        ae(pool.listenPair('rtp', 'rtcp', preferred=port3,
+                           listenUDP=lU)[0], port3)
+
+    def testRTPMultiplexing(self):
+        from shtoom.rtp.mux import SharedRTPSocket
+        from shtoom.rtp.packets import RTPPacket
+        ae = self.assertEquals
+        class FakeRTCP:
+            def __init__(self):
+                self.got = []
+            def datagramReceived(self, datagram, addr):
+                self.got.append(addr)
+        class FakeRTP:
+            def __init__(self, cookie):
+                self.cookie = cookie
+                self.dest = None
+                self.got = []
+                self.RTCP = FakeRTCP()
+            def datagramReceived(self, datagram, addr):
+                self.got.append((datagram, addr))
+            def looksLikeOurRTP(self, datagram):
+                return (ord(datagram[0]) & 0xc0) == 0x80
+        shared = SharedRTPSocket()
+        r1, r2, r3 = FakeRTP('c1'), FakeRTP('c2'), FakeRTP('c3')
+        for r, addr in ((r1, ('10.0.0.1', 4000)), (r2, ('10.0.0.1', 4002)),
+                        (r3, ('10.0.0.3', 4000))):
+            shared.register(r)
+            r.dest = addr
+            shared.setRemote(r, addr)
+        ae(shared.callCount(), 3)
+        p1 = RTPPacket(1111, 1, 1, 'x'*160, 0).netbytes()
+        p3 = RTPPacket(3333, 1, 1, 'y'*160, 0).netbytes()
+        shared.datagramReceived(p1, ('10.0.0.1', 4000))
+        ae(r1.got, [(p1, ('10.0.0.1', 4000))])
+        # Something that isn't RTP, from r3's IP, isn't latched onto
+        shared.datagramReceived('\x00\x01' + 'z'*18, ('10.0.0.3', 7777))
+        ae((r3.got, r3.dest), ([], ('10.0.0.3', 4000)))
+        # r3 is behind a NAT that rewrote its port - match on IP & latch
+        shared.datagramReceived(p3, ('10.0.0.3', 5555))
+        ae(len(r3.got), 1)
+        ae(r3.dest, ('10.0.0.3', 5555))
+        shared.datagramReceived(p3, ('10.0.0.3', 5555))
+        ae(len(r3.got), 2)
+        # Once latched, the same SSRC from anywhere else isn't r3's, and
+        # doesn't move its media
+        shared.datagramReceived(p3, ('10.0.0.3', 5557))
+        shared.datagramReceived(p3, ('10.6.6.6', 5555))
+        ae(len(r3.got), 2)
+        ae(r3.dest, ('10.0.0.3', 5555))
+        ae(shared.stats['unmatched'], 3)
+        # r1 has heard from its far end, so it's no longer waiting to latch
+        # - and r2, on the same IP, now is the only one that is
+        p2 = RTPPacket(2222, 1, 1, 'w'*160, 0).netbytes()
+        shared.datagramReceived(p2, ('10.0.0.1', 6000))
+        ae(r2.got, [(p2, ('10.0.0.1', 6000))])
+        shared.datagramReceived(p1, ('10.0.0.1', 6002))
+        ae(len(r1.got), 1)
+        # RTCP (PT 200) goes to the call's RTCP protocol
+        shared.datagramReceived('\x80\xc8' + '\0'*26, ('10.0.0.1', 4000))
+        ae(r1.RTCP.got, [('10.0.0.1', 4000)])
+        ae(len(r1.got), 1)
+        shared.unregister(r3)
+        shared.datagramReceived(p3, ('10.0.0.3', 5555))
+        ae(len(r3.got), 2)
+        ae(shared.callCount(), 2)
+        for r in r1, r2:
+            shared.unregister(r)
+        ae((shared._byAddr, shared._pendingByIP), ({}, {}))
+
+    def testRTPMultiplexingMapping(self):
+        from twisted.internet import defer
+        from shtoom import nat
+        from shtoom.rtp.mux import SharedRTPSocket
+        ae = self.assertEquals
+        class FakeMapper:
+            def __init__(self):
+                self.results = []
+            def map(self, port):
+                return self.results.pop(0)
+        mapper = FakeMapper()
+        mapper.results = [defer.fail(ValueError('no NAT')),
+                          defer.succeed(('1.2.3.4', 5000))]
+        shared = SharedRTPSocket()
+        shared.listener = None
+        orig, nat.getMapper = nat.getMapper, lambda: defer.succeed(mapper)
+        try:
+            got = []
+            shared.getMapping().addErrback(lambda f: got.append(f.type))
+            # The failure isn't kept - the next call tries again
+            shared.getMapping().addCallback(got.append)
+            shared.getMapping().addCallback(got.append)
+        finally:
+            nat.getMapper = orig
+        ae(got, [ValueError, ('1.2.3.4', 5000), ('1.2.3.4', 5000)])
+
+    def testRelayedPacket(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.packets import RTPPacket, parse_rtppacket
+        from shtoom.rtp.formats import PT_PCMU, PT_GSM
+        from shtoom.audio.converters import MediaSample
+        ae = self.assertEquals
+        class FakeTransport:
+            def __init__(self):
+                self.sent = []
+            def write(self, bytes, dest):
+                self.sent.append(parse_rtppacket(str(bytes)))
+        rtp = RTPProtocol(None, 'c1')
+        rtp.transport = t = FakeTransport()
+        rtp.dest = ('127.0.0.1', 4000)
+        rtp.ptdict = {PT_PCMU: 0}
+        rtp.sending = True
+        rtp.seq, rtp.ts = 100, 5000
+        def relay(seq, ts, data, marker=0, ct=PT_PCMU, ssrc=42):
+            rtp.handle_relayed_packet(RTPPacket(ssrc, seq, ts, data, pt=0,
+                                                ct=ct, marker=marker))
+        relay(7, 80000, 'a'*160, marker=1)
+        # A packet went missing - the gap in timestamps is kept
+        relay(9, 80320, 'b'*160)
+        relay(10, 80480, 'c'*240)
+        ae([ p.data for p in t.sent ], ['a'*160, 'b'*160, 'c'*240])
+        ae([ p.header.seq for p in t.sent ], [100, 101, 102])
+        ae([ p.header.ts for p in t.sent ], [5000, 5320, 5480])
+        ae([ p.header.ssrc for p in t.sent ], [rtp.ssrc] * 3)
+        ae(t.sent[0].header.marker, 1)
+        # Not negotiated: dropped
+        relay(11, 80720, 'd'*33, ct=PT_GSM)
+        ae(len(t.sent), 3)
+        # Our own audio carries on after the relayed packets, and
+        # relaying after that carries on from there.
+        rtp.handle_media_sample(MediaSample(PT_PCMU, 'e'*160))
+        relay(12, 80880, 'f'*160)
+        relay(1, 10, 'g'*160, ssrc=43)
+        ae([ p.header.ts for p in t.sent[3:] ], [5640, 5800, 5960])
+        ae([ p.header.seq for p in t.sent[3:] ], [103, 104, 105])
+
+    def testRTPRelay(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.relay import RTPRelay
+        from shtoom.rtp.packets import RTPPacket
+        from shtoom.rtp.formats import PT_PCMU, PT_NTE
+        ae = self.assertEquals
+        class FakeTransport:
+            def __init__(self):
+                self.sent = []
+            def write(self, bytes, dest):
+                self.sent.append((str(bytes), dest))
+        a, b = RTPProtocol(None, 'a'), RTPProtocol(None, 'b')
+        for rtp, nte, dest in (a, 101, ('10.0.0.1', 4000)), \
+                              (b, 96, ('10.0.0.2', 5000)):
+            rtp.transport = FakeTransport()
+            rtp.ptdict = {0: PT_PCMU, PT_PCMU: 0, nte: PT_NTE, PT_NTE: nte}
+            rtp.dest = dest
+        relay = RTPRelay(a, b)
+        p1 = RTPPacket(1234, 10, 1600, 'x'*160, 0, marker=1).netbytes()
+        a.datagramReceived(p1, ('10.0.0.1', 4000))
+        # Sent on by b, untouched
+        ae(b.transport.sent, [(p1, ('10.0.0.2', 5000))])
+        ae(a.transport.sent, [])
+        # Payload types are renumbered for the other call
+        p2 = RTPPacket(1234, 13, 1760, 'd'*4, 101).netbytes()
+        p3 = RTPPacket(5678, 1, 1, 'y'*160, 0).netbytes()
+        a.datagramsReceived([(p2, ('10.0.0.1', 4000)),
+                             ('junk', ('10.0.0.1', 4000))])
+        b.datagramsReceived([(p3, ('10.0.0.2', 5000))])
+        ae(b.transport.sent[1][0], RTPPacket(1234, 13, 1760, 'd'*4,
+                                             96).netbytes())
+        ae(a.transport.sent, [(p3, ('10.0.0.1', 4000))])
+        stats = relay.getStats()
+        ae(stats['a'], {'packets': 2, 'bytes': 12+160+12+4, 'lost': 2,
+                        'dropped': 1})
+        ae(stats['b'], {'packets': 1, 'bytes': 12+160, 'lost': 0,
+                        'dropped': 0})
+        # Late packet - no longer lost
+        a.datagramReceived(RTPPacket(1234, 11, 1760, 'x'*160, 0).netbytes(),
+                           ('10.0.0.1', 4000))
+        ae(relay.getStats()['a']['lost'], 1)
+        relay.stop()
+        ae(a.relay, None)
+        ae(b.relay, None)
+
+    def testRTPLatching(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.packets import RTPPacket
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEquals
+        class FakeTransport:
+            def write(self, bytes, dest):
+                pass
+            def connect(self, host, port):
+                raise AssertionError("latching RTP shouldn't connect")
+        class FakeApp:
+            def __init__(self):
+                self.got = []
+            def incomingRTP(self, cookie, packet):
+                self.got.append(packet)
+        app = FakeApp()
+        rtp = RTPProtocol(app, 'c1')
+        rtp.transport = FakeTransport()
+        rtp.ptdict = {0: PT_PCMU, PT_PCMU: 0}
+        rtp.latch = True
+        rtp.start(('10.0.0.1', 4000))
+        p = RTPPacket(1, 1, 1, 'x'*160, 0).netbytes()
+        # Neither a stray datagram, nor RTP in a payload type the SDP
+        # didn't agree, is latched onto
+        rtp.datagramReceived('\x00\x01' + 'z'*18, ('10.6.6.6', 6666))
+        rtp.datagramsReceived([(RTPPacket(1, 1, 1, 'x'*160, 34).netbytes(),
+                                ('10.6.6.6', 6666))])
+        ae(rtp.dest, ('10.0.0.1', 4000))
+        ae(len(app.got), 0)
+        rtp.datagramReceived(p, ('192.168.1.1', 6000))
+        ae(rtp.dest, ('192.168.1.1', 6000))
+        # Only the first packet is latched onto
+        rtp.datagramReceived(p, ('192.168.1.1', 6002))
+        ae(rtp.dest, ('192.168.1.1', 6000))
+        ae(len(app.got), 2)
+        # Relaying, a batch's stray datagram is passed on to the relay
+        # (which drops it), but only the RTP after it is latched onto
+        class FakeRelay:
+            def __init__(self):
+                self.got = []
+            def relayDatagrams(self, rtp, batch):
+                self.got.extend(batch)
+        rtp.relay = FakeRelay()
+        rtp._latchPending = True
+        rtp.datagramsReceived([('junk'*5, ('10.6.6.6', 6666)),
+                               (p, ('192.168.1.2', 7000))])
+        ae(rtp.dest, ('192.168.1.2', 7000))
+        ae(len(rtp.relay.got), 2)
+
+    def testBadPacketInBatch(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.mux import SharedRTPSocket
+        from shtoom.rtp.packets import RTPPacket
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEquals
+        class FakeApp:
+            def __init__(self):
+                self.got = []
+            def incomingRTP(self, cookie, packet):
+                self.got.append(packet.header.seq)
+        app = FakeApp()
+        rtp = RTPProtocol(app, 'c1')
+        rtp.ptdict = {0: PT_PCMU, PT_PCMU: 0}
+        addr = ('10.0.0.1', 4000)
+        good = [ RTPPacket(1, seq, 1, 'x'*160, 0).netbytes()
+                                                for seq in (1, 2, 3) ]
+        # Too short, and an extension header that runs off the end
+        runt = good[0][:8]
+        mangled = '\x90' + good[0][1:12] + '\0\0\0\x09'
+        rtp.datagramsReceived([(good[0], addr), (runt, addr),
+                               (good[1], addr), (mangled, addr),
+                               (good[2], addr)])
+        ae(app.got, [1, 2, 3])
+        ae(rtp.badPackets, 2)
+        # Multiplexed, too
+        shared = SharedRTPSocket()
+        shared.register(rtp)
+        shared.setRemote(rtp, addr)
+        rtp.dest = addr
+        app.got = []
+        shared.datagramsReceived([(good[0], addr), (runt, addr),
+                                  ('\x80', addr), (mangled, addr),
+                                  (good[2], addr)])
+        ae(app.got, [1, 3])
+        ae(shared.stats['bad'], 2)
+        ae(rtp.badPackets, 3)
+
     def testSDPGen(self):
         from shtoom.rtp.formats import SDPGenerator, PTMarker
         from shtoom.sdp import SDP
@@ -81,3 +427,6 @@ class TestRTP(unittest.TestCase):
         rtpmap = sdp.getMediaDescription('audio').rtpmap
         for pt, (entry, ptmarker) in rtpmap.items():
             a_(isinstance(ptmarker, PTMarker))
+        a_('a=rtcp-mux' not in sdp.show())
+        rtp.rtcpMux = True
+        a_('a=rtcp-mux' in SDPGenerator().getSDP(rtp).show())
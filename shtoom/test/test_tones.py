@@ -0,0 +1,86 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.tones
+"""
+
+from twisted.trial import unittest
+
+from shtoom.doug.tones import ToneBank, ToneSource, digitTones, progressTone
+from shtoom.doug.dtmf import DtmfDetector, dtmfGenerator
+from shtoom.rtp.formats import PT_PCMU, PT_RAW
+from shtoom.test.harness import FakeLeg
+
+class ToneBankTest(unittest.TestCase):
+
+    def test_bank(self):
+        ae = self.assertEquals
+        a_ = self.assert_
+        bank = ToneBank()
+        five = bank.getPCM('5', 5)
+        ae(len(five), 5)
+        ae([ len(f) for f in five ], [320] * 5)
+        a_(bank.getPCM('5', 5) is five)
+        ae(DtmfDetector().detect(five[1] + five[2]), '5')
+        ulaw = bank.getFrames('5', PT_PCMU, 5)
+        ae([ len(f) for f in ulaw ], [160] * 5)
+        a_(bank.getFrames('5', PT_PCMU, 5) is ulaw)
+        a_(bank.getFrames('5', PT_RAW, 5) is five)
+        # A whole cycle: 2s on, 4s off
+        ringback = bank.getPCM('ringback')
+        ae(len(ringback), 300)
+        ae(ringback[100:], ['\0' * 320] * 200)
+        self.assertRaises(ValueError, bank.getPCM, 'nosuchtone')
+
+    def test_generator(self):
+        ae = self.assertEquals
+        s = dtmfGenerator('#', 320)
+        ae(len(s), 640)
+        ae(DtmfDetector().detect(s), '#')
+        self.assertRaises(ValueError, dtmfGenerator, 'x')
+
+class ToneSourceTest(unittest.TestCase):
+
+    def test_digits(self):
+        ae = self.assertEquals
+        bank = ToneBank()
+        s = digitTones('1,2', duration=0.04, delay=0.02)
+        s.bank = bank
+        s.leg = leg = FakeLeg()
+        out = []
+        while True:
+            frame = s.read()
+            if frame is None:
+                break
+            out.append(frame)
+        # two frames of tone and one of silence, for each of the three
+        ae(len(out), 9)
+        ae(out[2:6], ['\0' * 320] * 4)
+        ae(leg.done, [s])
+
+    def test_shared(self):
+        ae = self.assertEquals
+        a_ = self.assert_
+        s1 = ToneSource([('9', 2)])
+        s2 = ToneSource([('9', 2)])
+        s1.leg, s2.leg = FakeLeg(), FakeLeg()
+        f1 = s1.readShared(PT_PCMU)
+        ae(f1.ct, PT_PCMU)
+        a_(s2.readShared(PT_PCMU).data is f1.data)
+        ae(len(s1.read()), 320)
+        # At the end, readShared leaves it to read() to finish up
+        ae(s1.readShared(PT_PCMU), None)
+        ae(s1.leg.done, [])
+        ae(s1.read(), None)
+        ae(s1.leg.done, [s1])
+
+    def test_loop(self):
+        ae = self.assertEquals
+        s = progressTone('busy')
+        s.leg = FakeLeg()
+        first = s.read()
+        for i in range(99):
+            s.read()
+        # one second round, and back to the start
+        ae(s.read(), first)
+        ae(s.readShared(PT_PCMU).ct, PT_PCMU)
+        ae(s.leg.done, [])
+        self.assertRaises(ValueError, progressTone, 'nosuchtone')